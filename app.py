@@ -8,25 +8,22 @@ App Template for static publishing.
 """
 
 import app_config
-import json
 import oauth
+import os
 import static
+import watcher
 
-from flask import Flask, make_response, render_template
-from render_utils import make_context, smarty_filter, urlencode_filter
+from flask import Flask, abort, make_response, render_template
+from render_utils import configure_jinja, load_json, make_context
 from werkzeug.debug import DebuggedApplication
 
 # This is needed by the response_minify() function below
-from htmlmin.main import minify
-
-# This is needed by the less() function below
-from fabric.api import local
+from minifier import minify_html
 
 app = Flask(__name__)
 app.debug = app_config.DEBUG
 
-app.add_template_filter(smarty_filter, name='smarty')
-app.add_template_filter(urlencode_filter, name='urlencode')
+configure_jinja(app)
 
 @app.route('/')
 @oauth.oauth_required
@@ -37,8 +34,7 @@ def index():
     context = make_context()
     context['directory_depth'] = 0
 
-    with open('data/featured.json') as f:
-        context['featured'] = json.load(f)
+    context['featured'] = load_json('data/featured.json')
 
     return make_response(render_template('index.html', **context))
 
@@ -63,25 +59,26 @@ def less(path):
     """
     file_prefix = path.split('.')[0]
     srcfile = 'less/%s.less' % file_prefix
-    outfile = 'www/css/%s.min.css' % file_prefix
-    name = '%s.min.css' % file_prefix
+
+    # Don't compile (or cache a payload for) files that aren't there
+    if not os.path.exists(srcfile):
+        abort(404)
+
     try:
-        # run the LESS compiler, with --clean-css option set to minify, to generate static .css file
-        local('node_modules/less/bin/lessc --clean-css %s %s' % (srcfile, outfile))
-        # use Flask's send_from_directory to serve the static .css file
-        return send_from_directory('www/css', name)
-    except Exception as e:
+        # run the LESS compiler, with compression on to minify. Cached until a file it imports changes
+        return static.less_response(srcfile, compress=True)
+    except OSError:
         print('It looks like "lessc" isn\'t installed. Try running: "npm install"')
-        print(e)
+        raise
 
 @app.after_request
 def response_minify(response):
     """
     Minify html response to decrease site traffic
     """
-    if response.content_type == 'text/html; charset=utf-8':
+    if response.content_type == 'text/html; charset=utf-8' and not response.is_streamed:
         response.set_data(
-            minify(response.get_data(as_text=True))
+            minify_html(response.get_data(as_text=True))
         )
 
         return response
@@ -91,6 +88,10 @@ def response_minify(response):
 app.register_blueprint(static.static)
 app.register_blueprint(oauth.oauth)
 
+# Rebuild assets in the background as they change. Set by "fab app"
+if os.environ.get('WATCH_FILES'):
+    watcher.watch_app(app)
+
 # Enable Werkzeug debug pages
 if app_config.DEBUG:
     wsgi_app = DebuggedApplication(app, evalex=False)
@@ -74,6 +74,22 @@ S3_USER = 'newsroom'
 DEFAULT_MAX_AGE = 20 
 ASSETS_MAX_AGE = 86400
 
+# Fingerprinted bundles (see FINGERPRINT_ASSETS) never change once written,
+# so they can be cached for a year. Everything else gets ASSETS_MAX_AGE.
+FINGERPRINTED_MAX_AGE = 31536000
+
+# Write compiled JS/CSS bundles with a content hash in their filenames
+# (e.g. js/app.1a2b3c4d5e.min.js) instead of adding a timestamp querystring.
+# Unchanged bundles keep their URLs, so they can be cached for a long time.
+FINGERPRINT_ASSETS = True
+
+# How rendered HTML is minified: 'htmlmin' or the much faster 'fast'
+# (see minifier.py). Run "fab benchmark.minify" to compare them.
+HTML_MINIFIER = 'htmlmin'
+
+# Maps logical bundle names to their fingerprinted filenames
+ASSET_MANIFEST_PATH = 'www/asset-manifest.json'
+
 PRODUCTION_SERVERS = ['graphics.stltoday.com']
 STAGING_SERVERS = ['staging-graphics.stltoday.com']
 
@@ -94,6 +110,11 @@ DEPLOY_CRONTAB = False
 # If True, DEPLOY_TO_SERVERS must also be True
 DEPLOY_SERVICES = False
 
+# Does the graphics server's nginx have the ngx_brotli module? Stock nginx
+# rejects the whole config if it sees brotli_static, so leave this off
+# unless it does. gzip_static works everywhere.
+NGINX_BROTLI_STATIC = False
+
 UWSGI_SOCKET_PATH = '/tmp/%s.uwsgi.sock' % PROJECT_FILENAME
 
 # Services are the server-side services we want to enable and configure.
@@ -120,6 +141,11 @@ COPY EDITING
 COPY_GOOGLE_DOC_KEY = '1e-LKA5kIqumSbl79sNd9NDPFcLDxlZdzAfZ_UTHQWFM'
 COPY_PATH = 'data/copy.xlsx'
 
+# Apply smartypants to every cell (except keys) once when copy is loaded,
+# so templates get typeset text without using |smarty. Off by default
+# because it also changes copy used in URLs, attributes and scripts.
+SMARTYPANTS_COPY = False
+
 """
 SHARING
 """
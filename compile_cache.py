@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache for compiled Javascript and CSS.
+
+Running Babel or lessc means starting Node, which is slow, and most
+sources (especially vendored libraries) never change between renders.
+Outputs are keyed by the compiler's version, its options and the
+contents of every file it reads, so a cache hit is always safe to reuse.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+CACHE_PATH = '.compile_cache'
+
+# Least recently used entries are evicted once the cache grows past this
+MAX_CACHE_SIZE = 100 * 1024 * 1024
+
+_tool_versions = {}
+
+def tool_version(package):
+    """
+    Read the installed version of an npm package without starting Node.
+    """
+    if package not in _tool_versions:
+        try:
+            with open('node_modules/%s/package.json' % package) as f:
+                _tool_versions[package] = json.load(f).get('version')
+        except (IOError, ValueError):
+            _tool_versions[package] = None
+
+    return _tool_versions[package]
+
+def cache_key(package, options, source_paths):
+    """
+    Build a cache key from a compiler package, its options and the
+    paths and contents of the files it will read.
+    """
+    key = hashlib.md5()
+    key.update(json.dumps([package, tool_version(package), options]).encode('utf-8'))
+
+    for path in source_paths:
+        key.update(path.encode('utf-8'))
+
+        try:
+            with open(path, 'rb') as f:
+                key.update(hashlib.md5(f.read()).digest())
+        except IOError:
+            key.update(b'missing')
+
+    return key.hexdigest()
+
+def get(key):
+    """
+    Get a cached output, or None if it isn't cached.
+    """
+    path = os.path.join(CACHE_PATH, key)
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            output = f.read()
+
+        # Mark as recently used for eviction
+        os.utime(path, None)
+    except OSError:
+        # Missing, or evicted by another process since we read it
+        return None
+
+    return output
+
+def put(key, output):
+    """
+    Store an output in the cache, then evict old entries if needed.
+    """
+    os.makedirs(CACHE_PATH, exist_ok=True)
+
+    # Write to a temp file and rename, so parallel renders never see a partial entry
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_PATH, prefix='.tmp-')
+
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(output)
+
+    os.replace(tmp_path, os.path.join(CACHE_PATH, key))
+
+    evict()
+
+def evict(max_size=None):
+    """
+    Delete least recently used entries until the cache fits in `max_size` bytes.
+    """
+    if max_size is None:
+        max_size = MAX_CACHE_SIZE
+
+    if not os.path.isdir(CACHE_PATH):
+        return
+
+    entries = []
+    total_size = 0
+
+    for name in os.listdir(CACHE_PATH):
+        if name.startswith('.'):
+            continue
+
+        try:
+            stat = os.stat(os.path.join(CACHE_PATH, name))
+        except OSError:
+            continue
+
+        entries.append((stat.st_mtime, stat.st_size, name))
+        total_size += stat.st_size
+
+    entries.sort()
+
+    while entries and total_size > max_size:
+        mtime, size, name = entries.pop(0)
+
+        try:
+            os.remove(os.path.join(CACHE_PATH, name))
+        except OSError:
+            pass
+
+        total_size -= size
+
+def clear():
+    """
+    Empty the cache.
+    """
+    evict(0)
+
+def cached(package, options, source_paths, compile):
+    """
+    Return the cached output for these inputs, calling `compile` to
+    build (and cache) it on a miss.
+    """
+    key = cache_key(package, options, source_paths)
+    output = get(key)
+
+    if output is None:
+        output = compile()
+        put(key, output)
+
+    return output
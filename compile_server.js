@@ -0,0 +1,59 @@
+/*
+ * Long-lived Babel and LESS compiler. Started and owned by compiler.py.
+ *
+ * Reads one JSON request per line on stdin:
+ *
+ *   {"id": 1, "jobs": [{"type": "babel", "filename": "www/js/app.js", "options": {"minified": true}}]}
+ *
+ * and writes one JSON response per line on stdout:
+ *
+ *   {"id": 1, "results": [{"code": "..."}]}
+ *
+ * A job that fails gets {"error": "..."} in place of its result.
+ */
+
+const fs = require('fs');
+const readline = require('readline');
+
+const babel = require('@babel/core');
+const less = require('less');
+
+// stdout is reserved for responses
+console.log = console.error;
+console.warn = console.error;
+
+async function compile(job) {
+    const source = fs.readFileSync(job.filename, 'utf8');
+    const options = Object.assign({ filename: job.filename }, job.options);
+
+    if (job.type === 'babel') {
+        const result = await babel.transformAsync(source, options);
+
+        return { code: result.code };
+    }
+
+    if (job.type === 'less') {
+        const result = await less.render(source, options);
+
+        return { code: result.css, imports: result.imports };
+    }
+
+    throw new Error('Unknown job type: ' + job.type);
+}
+
+async function handle(line) {
+    const request = JSON.parse(line);
+
+    const results = await Promise.all(request.jobs.map((job) => {
+        return compile(job).catch((e) => ({ error: e.message || String(e) }));
+    }));
+
+    process.stdout.write(JSON.stringify({ id: request.id, results: results }) + '\n');
+}
+
+const input = readline.createInterface({ input: process.stdin });
+
+input.on('line', handle);
+
+// The Python side closes stdin to shut us down
+input.on('close', () => process.exit(0));
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+Compile Javascript with Babel and CSS with LESS.
+
+Rather than starting Node for every file, all compile jobs are sent in
+batches to one long-lived Node process (see compile_server.js), which
+is restarted if it crashes and shut down when Python exits. Outputs
+are cached on disk by compile_cache.
+"""
+
+import atexit
+from glob import glob
+import json
+import os
+import subprocess
+import threading
+
+import compile_cache
+
+COMPILE_SERVER_COMMAND = ['node', 'compile_server.js']
+
+# Files that change Babel's output without changing the source being compiled
+BABEL_CONFIG_PATHS = [
+    'babel.config.js',
+    'node_modules/@babel/preset-env/package.json',
+]
+
+JST_COMMAND = ['node_modules/universal-jst/bin/jst.js', '--template', 'underscore', 'jst']
+
+# Files each LESS entry file imported the last time it was compiled
+LESS_IMPORTS_PATH = '.less_imports.json'
+
+# How many times to restart a crashed server before giving up on a batch
+MAX_RESTARTS = 2
+
+class CompileError(Exception):
+    pass
+
+class CompileServer(object):
+    """
+    Owns a compile_server.js child process and talks to it
+    over a line-delimited JSON protocol.
+    """
+    def __init__(self, command=None):
+        self.command = command or COMPILE_SERVER_COMMAND
+        self.process = None
+        self.pid = None
+        self.request_id = 0
+        self.lock = threading.Lock()
+
+    def _running(self):
+        # A forked child (e.g. a render worker) must not share its parent's pipes
+        return self.process is not None and self.pid == os.getpid() and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding='utf-8',
+            bufsize=1
+        )
+        self.pid = os.getpid()
+
+    def stop(self):
+        """
+        Close the server's stdin so it exits, killing it if it doesn't.
+        """
+        if not self._running():
+            self.process = None
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+        self.process = None
+
+    def _request(self, jobs):
+        self.request_id += 1
+
+        self.process.stdin.write(json.dumps({ 'id': self.request_id, 'jobs': jobs }) + '\n')
+        self.process.stdin.flush()
+
+        line = self.process.stdout.readline()
+
+        if not line:
+            raise BrokenPipeError('Compile server exited')
+
+        response = json.loads(line)
+
+        if response['id'] != self.request_id:
+            raise CompileError('Compile server answered request %s, expected %s' % (response['id'], self.request_id))
+
+        return response['results']
+
+    def run(self, jobs):
+        """
+        Run a batch of compile jobs, returning one result dict per job.
+        Jobs that failed have an 'error' instead of 'code'.
+        """
+        with self.lock:
+            for attempt in range(MAX_RESTARTS + 1):
+                if not self._running():
+                    self.start()
+
+                try:
+                    results = self._request(jobs)
+                    break
+                except (BrokenPipeError, ValueError):
+                    print('Compile server crashed, restarting')
+                    self.stop()
+            else:
+                raise CompileError('Compile server crashed %i times' % (MAX_RESTARTS + 1))
+
+        return results
+
+    def compile(self, jobs):
+        """
+        Run a batch of compile jobs, raising CompileError if any failed.
+        """
+        results = self.run(jobs)
+
+        _raise_errors(jobs, results)
+
+        return results
+
+def _raise_errors(jobs, results):
+    for job, result in zip(jobs, results):
+        if 'error' in result:
+            raise CompileError('%s: %s' % (job['filename'], result['error']))
+
+_server = CompileServer()
+
+atexit.register(_server.stop)
+
+def _load_less_imports():
+    try:
+        with open(LESS_IMPORTS_PATH) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+_less_imports = _load_less_imports()
+_less_imports_lock = threading.Lock()
+
+def _record_less_imports(src, imports):
+    """
+    Remember the files a LESS entry file imported when it was last compiled.
+    """
+    imports = sorted(set(os.path.relpath(path) for path in imports))
+
+    with _less_imports_lock:
+        if _less_imports.get(src) == imports:
+            return
+
+        _less_imports[src] = imports
+
+        # Write to a temp file and rename, so parallel renders never see a partial file
+        tmp_path = '%s.%i.tmp' % (LESS_IMPORTS_PATH, os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            json.dump(_less_imports, f, indent=4, sort_keys=True)
+
+        os.replace(tmp_path, LESS_IMPORTS_PATH)
+
+def less_source_paths(src):
+    """
+    Files that compiling a LESS entry file may read: the entry itself
+    and everything it imported the last time it was compiled.
+    """
+    paths = [src]
+
+    if not src.endswith('.less'):
+        return paths
+
+    with _less_imports_lock:
+        imports = _less_imports.get(src)
+
+    if imports is None:
+        # Never compiled, so assume it could import any partial under less/
+        imports = sorted(glob('less/**/*.less', recursive=True))
+
+    paths.extend(path for path in imports if path != src)
+
+    return paths
+
+def _stat_signature(paths):
+    """
+    Modification times and sizes of a list of files.
+    """
+    signature = []
+
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            signature.append((path, None))
+        else:
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+
+    return tuple(signature)
+
+def less_signature(src):
+    """
+    Modification times and sizes of every file in a LESS entry file's
+    import graph. Cheap enough to check on every request.
+    """
+    return _stat_signature(less_source_paths(src))
+
+def _compile_cached(job_type, paths, options, package, source_paths):
+    """
+    Compile a list of files, sending only cache misses to the compile server.
+    """
+    keys = [compile_cache.cache_key(package, [job_type, options], source_paths(path)) for path in paths]
+    outputs = [compile_cache.get(key) for key in keys]
+
+    misses = [i for i, output in enumerate(outputs) if output is None]
+
+    if misses:
+        jobs = [{ 'type': job_type, 'filename': paths[i], 'options': options } for i in misses]
+        results = _server.run(jobs)
+
+        for i, result in zip(misses, results):
+            # Cache what did compile, so one broken file doesn't cost the whole batch next time
+            if 'error' in result:
+                continue
+
+            outputs[i] = result['code']
+
+            if 'imports' in result:
+                _record_less_imports(paths[i], result['imports'])
+
+                # The key depends on the import graph, which may have just changed
+                keys[i] = compile_cache.cache_key(package, [job_type, options], source_paths(paths[i]))
+
+            compile_cache.put(keys[i], outputs[i])
+
+        _raise_errors(jobs, results)
+
+    return outputs
+
+def compile_js(paths, minified=True):
+    """
+    Compile Javascript files down to ES5 with Babel.
+    """
+    return _compile_cached('babel', paths, { 'minified': minified }, '@babel/core', lambda path: [path] + BABEL_CONFIG_PATHS)
+
+def compile_less(paths, compress=False):
+    """
+    Compile LESS files to CSS.
+    """
+    return _compile_cached('less', paths, { 'compress': compress }, 'less', less_source_paths)
+
+def jst_source_paths():
+    """
+    The templates compiled into templates.js.
+    """
+    return sorted(path for path in glob('jst/**/*', recursive=True) if os.path.isfile(path))
+
+def jst_signature():
+    """
+    Modification times and sizes of every JST template.
+    """
+    return _stat_signature(jst_source_paths())
+
+def compile_jst():
+    """
+    Compile the underscore templates in jst/ into one script defining `JST`.
+    """
+    return compile_cache.cached('universal-jst', JST_COMMAND, jst_source_paths(), lambda: subprocess.check_output(JST_COMMAND).decode('utf-8'))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Precompiled snapshots of the copytext spreadsheet.
+
+Parsing the XLSX with openpyxl is slow, so when a new spreadsheet is
+downloaded we also write a JSON snapshot next to it (`data/copy.xlsx`
+gets `data/copy.json`) holding every sheet's rows and the ready-made
+`window.COPY = ...` payload for /js/copy.js. Loading falls back to the
+XLSX when the snapshot is missing or older than the spreadsheet.
+"""
+
+import json
+import os
+import tempfile
+
+import copytext
+
+def snapshot_path(path):
+    """
+    Path of the snapshot for a spreadsheet.
+    """
+    return '%s.json' % os.path.splitext(path)[0]
+
+def _source_signature(path):
+    """
+    Identify a version of the spreadsheet by modification time and size.
+    """
+    stat = os.stat(path)
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+class SnapshotCopy(copytext.Copy):
+    """
+    A copytext.Copy loaded from a snapshot instead of an XLSX file.
+    """
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self.js = snapshot['js']
+
+        copytext.Copy.__init__(self, snapshot['source']['path'])
+
+    def load(self):
+        for name, sheet in self._snapshot['sheets'].items():
+            columns = sheet['columns']
+            rows = [dict(zip(columns, row)) for row in sheet['rows']]
+
+            self._copy[name] = copytext.Sheet(name, rows, columns)
+
+def write_snapshot(path):
+    """
+    Parse a spreadsheet and write its snapshot. Returns the parsed copy.
+    """
+    copy = copytext.Copy(path)
+
+    _save_snapshot(path, copy)
+
+    return copy
+
+def _save_snapshot(path, copy):
+    """
+    Write the snapshot of an already-parsed spreadsheet.
+    """
+    sheets = {}
+
+    for name, sheet in copy._copy.items():
+        sheets[name] = {
+            'columns': sheet._columns,
+            'rows': [row._row for row in sheet]
+        }
+
+    snapshot = {
+        'source': {
+            'path': path,
+            'signature': _source_signature(path)
+        },
+        'sheets': sheets,
+        'js': 'window.COPY = ' + copy.json()
+    }
+
+    out_path = snapshot_path(path)
+
+    # Write to a temp file and rename, so readers never see a partial snapshot
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out_path) or '.', prefix='.tmp-')
+
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+
+    os.replace(tmp_path, out_path)
+
+def read_snapshot(path):
+    """
+    Load the snapshot for a spreadsheet, or None if it is missing or stale.
+    """
+    try:
+        with open(snapshot_path(path), encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    # A snapshot with no spreadsheet next to it (e.g. on a server) is still good
+    if os.path.exists(path) and snapshot['source']['signature'] != _source_signature(path):
+        return None
+
+    return SnapshotCopy(snapshot)
+
+def load_copy(path):
+    """
+    Load copytext from its snapshot, falling back to (and re-snapshotting)
+    the XLSX when the snapshot is missing or stale.
+    """
+    copy = read_snapshot(path)
+
+    if copy is not None:
+        return copy
+
+    copy = copytext.Copy(path)
+
+    try:
+        _save_snapshot(path, copy)
+    except IOError:
+        # Can't write the snapshot (e.g. read-only checkout), carry on with the parsed copy
+        pass
+
+    return copy
+
+def copy_js(copy):
+    """
+    The `window.COPY = ...` payload served as /js/copy.js.
+    """
+    # Snapshots (and typeset copy, see render_utils.typeset_copy) keep theirs
+    if getattr(copy, 'js', None) is not None:
+        return copy.js
+
+    return 'window.COPY = ' + copy.json()
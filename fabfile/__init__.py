@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import os
+import shlex
+import tempfile
 
 from fabric.api import local, require, settings, task, run
 from fabric.state import env
@@ -10,7 +12,10 @@ import app_config
 
 # Other fabfiles
 from . import assets
+from . import benchmark
+from . import compress
 from . import data
+from . import deploy_manifest
 from . import flat
 from . import issues
 from . import render
@@ -103,14 +108,19 @@ def branch(branch_name):
 Running the app
 """
 @task
-def app(port='8000'):
+def app(port='8000', watch=True):
     """
     Serve app.py.
+
+    LESS, copy and templates are rebuilt in the background as they change.
+    Pass `watch=False` to build them when requested instead.
     """
+    watch_env = 'WATCH_FILES=1 ' if str(watch).lower() not in ('false', '0', 'no') else ''
+
     if app_config.USE_SSL_DEV == True:
-        local(f'gunicorn -b 0.0.0.0:{port} --certfile={app_config.SSL_CERT} --keyfile={app_config.SSL_KEY} --timeout 3600 --reload app:wsgi_app')
+        local(f'{watch_env}gunicorn -b 0.0.0.0:{port} --certfile={app_config.SSL_CERT} --keyfile={app_config.SSL_KEY} --timeout 3600 --reload app:wsgi_app')
     else:
-        local(f'gunicorn -b 0.0.0.0:{port} --timeout 3600 --reload app:wsgi_app')
+        local(f'{watch_env}gunicorn -b 0.0.0.0:{port} --timeout 3600 --reload app:wsgi_app')
 
 @task
 def public_app(port='8001'):
@@ -133,8 +143,36 @@ Changes to deployment requires a full-stack test. Deployment
 has two primary functions: Pushing flat files to S3 and deploying
 code to a remote server if required.
 """
-def _deploy_to_graphics():
+# Files deleted from the graphics server per command, to keep command lines short
+DELETE_BATCH_SIZE = 100
+
+# rsync won't try to compress these any further
+SKIP_COMPRESS_EXTENSIONS = ['gz', 'br', 'zip', 'jpg', 'jpeg', 'png', 'gif', 'webp', 'mp3', 'mp4', 'm4a', 'mov', 'webm', 'woff', 'woff2', 'eot', 'pdf']
+
+def _deploy_manifest_path():
+    """
+    Path of the local record of what was last deployed to the current target.
+    """
+    return '.deploy-manifest.%s.json' % app_config.DEPLOYMENT_TARGET
+
+def _deploy_to_graphics(full=False):
+    """
+    Sync www/ to the graphics server.
+
+    A manifest of what was last deployed to each target is kept locally,
+    so only new and changed files are sent, and files deleted since are
+    deleted from the server. It can't see changes made on the server (or
+    by deploys from another checkout), so if the remote copy is wrong,
+    pass `full` for a full rsync of www/ with --delete, which repairs it.
+    A full sync also happens when the remote directory doesn't exist.
+    """
     require('settings', provided_by=['production', 'staging'])
+
+    # A missing remote directory means it was destroyed (or never deployed), whatever the manifest says
+    with settings(warn_only=True):
+        if run('test -d %s' % app_config.S3_BASE_URL).failed:
+            full = True
+
     # -p creates any uncreated directories in the path. avoids errors.
     # -m ### creates the directories with whatever permission level you specify
     mkdir = ('mkdir -p -m 755 %s ') % (
@@ -142,17 +180,64 @@ def _deploy_to_graphics():
     )
     run(mkdir)
 
+    manifest_path = _deploy_manifest_path()
+
+    with open('confs/exclude-from.txt', 'r') as f:
+        exclude = [l.strip() for l in f if l.strip()]
+
+    previous = deploy_manifest.load_manifest(manifest_path)
+    manifest = deploy_manifest.build_manifest('www', exclude, previous)
+
     # -v verbose mode
     # -a stands for "archive" and syncs recursively and preserves symbolic links, special and device files, modification times, group, owner, and permissions.
     # -z compresses files for faster network transfer
-    # -P combines the flags --progress and --partial. The first gives you a progress bar for transfers; the second allows you to resume interrupted transfers
-    # --delete removes files on receiving side that don't exist on the sending side
-    # --exclude lets you specify a file/pattern you don't want to transfer
+    # --skip-compress lists extensions that are already compressed, so -z doesn't waste time on them
     # --exclude-from lets you specify a textfile containing multiple files/patterns you don't want to transfer
-    sync = ('rsync -vaz --exclude-from="confs/exclude-from.txt" www/ %s ') % (
+    # --delete removes files on receiving side that don't exist on the sending side (excluded files are left alone)
+    # --files-from only transfers the listed files (paths relative to www/), so rsync doesn't have to compare the whole tree
+    sync = 'rsync -vaz --skip-compress=%s %%s www/ %s ' % (
+        '/'.join(SKIP_COMPRESS_EXTENSIONS),
         app_config.S3_DEPLOY_URL # Deploy_URL DOES include the "user@server:" part, which we need for rsync
     )
-    local(sync)
+
+    if full:
+        # Let rsync compare the whole tree against the server
+        print('Deploying all %i files' % len(manifest))
+
+        local(sync % '--delete --exclude-from="confs/exclude-from.txt"')
+    else:
+        changed = deploy_manifest.changed_files(manifest, previous)
+        removed = deploy_manifest.removed_files(manifest, previous)
+
+        if not changed and not removed:
+            print('Nothing has changed since the last deploy. If the server is missing files, deploy with full=True')
+            return
+
+        print('Deploying %i of %i files, deleting %i' % (len(changed), len(manifest), len(removed)))
+
+        if changed:
+            with tempfile.NamedTemporaryFile('w', suffix='.txt') as files_from:
+                files_from.write('\n'.join(changed) + '\n')
+                files_from.flush()
+
+                local(sync % ('--files-from="%s"' % files_from.name))
+
+        _delete_from_graphics(removed)
+
+    # Only remember what was deployed once the sync has succeeded
+    deploy_manifest.save_manifest(manifest_path, manifest)
+
+def _delete_from_graphics(paths):
+    """
+    Delete files (paths relative to www/) from the deployed copy on the graphics server.
+    """
+    for i in range(0, len(paths), DELETE_BATCH_SIZE):
+        batch = paths[i:i + DELETE_BATCH_SIZE]
+
+        for path in batch:
+            print('Deleting %s' % path)
+
+        run('cd %s && rm -f -- %s' % (shlex.quote(app_config.S3_BASE_URL), ' '.join(shlex.quote(path) for path in batch)))
 
 
 def _install_crontab():
@@ -191,15 +276,21 @@ def _uninstall_crontab():
 def update():
     """
     Update all application data not in repository (copy, assets, etc).
+    Returns True if anything changed.
     """
-    text.update()
+    changed = text.update()
     # assets.sync()
     # data.update()
 
+    return changed
+
 @task
-def deploy(remote='origin'):
+def deploy(remote='origin', full=False):
     """
     Deploy the latest app to S3 and, if configured, to our servers.
+
+    Only files that changed since the last deploy are sent. Pass `full=True`
+    to rsync all of www/ instead, e.g. to repair a server that is missing files.
     """
     require('settings', provided_by=[production, staging])
 
@@ -226,8 +317,9 @@ def deploy(remote='origin'):
 
     update()
     render.render_all()
+    compress.precompress()
 
-    _deploy_to_graphics()
+    _deploy_to_graphics(str(full).lower() in ('true', '1', 'yes'))
 
 
 """
@@ -252,6 +344,10 @@ def shiva_the_destroyer():
     with settings(warn_only=True):
         flat.delete_folder(app_config.PROJECT_SLUG)
 
+        # The next deploy has to send everything again
+        if os.path.exists(_deploy_manifest_path()):
+            os.remove(_deploy_manifest_path())
+
         if app_config.DEPLOY_TO_SERVERS:
             servers.delete_project()
 
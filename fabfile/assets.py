@@ -4,17 +4,45 @@
 Commands related to the syncing assets.
 """
 
+import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from glob import glob
+import hashlib
+import io
+import json
 import os
+import shutil
+import threading
 
 import boto
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
 from fabric.api import prompt, task
 import app_config
 from fnmatch import fnmatch
 from . import utils
+from .flat import DigestCache, file_md5
 
 ASSETS_ROOT = 'www/assets'
 
+# Number of transfers (and S3 checksum lookups) run at once
+ASSETS_WORKERS = 8
+
+# Caches MD5s of local assets by modification time and size
+ASSETS_CACHE_PATH = '.assets-cache.sqlite'
+
+# Files at least this big are transferred in parts, in parallel,
+# and resumed from a journal if interrupted. S3 parts must be >= 5MB
+ASSETS_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+ASSETS_PART_SIZE = 16 * 1024 * 1024
+ASSETS_PART_WORKERS = 4
+
+# Progress of interrupted multipart transfers
+ASSETS_JOURNAL_PATH = '.assets-journal'
+
+_local = threading.local()
+
 @task
 def sync():
     """
@@ -25,7 +53,7 @@ def sync():
     with open('%s/assetsignore' % ASSETS_ROOT, 'r') as f:
         ignore_globs = [l.strip() for l in f]
 
-    local_paths = []
+    local_paths = set()
     not_lowercase = []
 
     for local_path, subdirs, filenames in os.walk(ASSETS_ROOT):
@@ -47,7 +75,7 @@ def sync():
             if name.lower() != name:
                 not_lowercase.append(full_path)
 
-            local_paths.append(full_path)
+            local_paths.add(full_path)
 
     # Prevent case sensitivity differences between OSX and S3 from screwing us up
     if not_lowercase:
@@ -59,67 +87,78 @@ def sync():
         return
 
     bucket = _assets_get_bucket()
-    keys = bucket.list(app_config.ASSETS_SLUG)
 
-    which = None
-    always = False
-
-    for key in keys:
-        download = False
-        upload = False
+    # Map local paths to S3 key names and sizes
+    remote_paths = {}
+    remote_sizes = {}
 
+    for key in bucket.list(app_config.ASSETS_SLUG):
         local_path = key.name.replace(app_config.ASSETS_SLUG, ASSETS_ROOT, 1)
 
         # Skip root key
         if local_path == '%s/' % ASSETS_ROOT:
             continue
 
-        print(local_path)
+        remote_paths[local_path] = key.name
+        remote_sizes[local_path] = key.size
 
-        if local_path in local_paths:
-            # A file can only exist once, this speeds up future checks
-            # and provides a list of non-existing files when complete
-            local_paths.remove(local_path)
+    both = sorted(local_paths & set(remote_paths))
 
-            # We need an actual key, not a "list key"
-            # http://stackoverflow.com/a/18981298/24608
-            key = bucket.get_key(key.name)
+    # Hash local files and fetch S3 checksums at the same time
+    digests = DigestCache(ASSETS_CACHE_PATH)
 
-            with open(local_path, 'rb') as f:
-                local_md5 = key.compute_md5(f)[0]
+    try:
+        with ThreadPoolExecutor(ASSETS_WORKERS) as executor:
+            local_md5s = executor.map(lambda local_path: _assets_local_md5(local_path, digests), both)
+            remote_md5s = executor.map(lambda local_path: _assets_remote_md5(remote_paths[local_path]), both)
 
-            # Hashes are different
-            if key.get_metadata('md5') != local_md5:
-                if not always:
-                    # Ask user which file to take
-                    which, always = _assets_confirm(local_path)
+            local_md5s = dict(zip(both, local_md5s))
+            remote_md5s = dict(zip(both, remote_md5s))
+    finally:
+        digests.close()
 
-                if not which:
-                    print('Cancelling!')
+    # Deleted from S3 since we listed the bucket, so only the local copy is left
+    for local_path in both:
+        if remote_md5s[local_path] is None:
+            del remote_paths[local_path]
 
-                    return
+    both = [local_path for local_path in both if local_path in remote_paths]
 
-                if which == 'remote':
-                    download = True
-                elif which == 'local':
-                    upload = True
-        else:
-            download = True
+    downloads = sorted(set(remote_paths) - local_paths)
+    uploads = []
+    deletes = []
+
+    # Ask about every conflict before transferring anything,
+    # so the transfers themselves can run unattended
+    which = None
+    always = False
+
+    for local_path in both:
+        # Hashes are the same
+        if local_md5s[local_path] == remote_md5s[local_path]:
+            continue
+
+        print(local_path)
 
-        if download:
-            _assets_download(key, local_path)
+        if not always:
+            # Ask user which file to take
+            which, always = _assets_confirm(local_path)
+
+        if not which:
+            print('Cancelling!')
+
+            return
 
-        if upload:
-            _assets_upload(local_path, key)
+        if which == 'remote':
+            downloads.append(local_path)
+        elif which == 'local':
+            uploads.append(local_path)
 
     action = None
     always = False
 
-    # Iterate over files that didn't exist on S3
-    for local_path in local_paths:
-        key_name = local_path.replace(ASSETS_ROOT, app_config.ASSETS_SLUG, 1)
-        key = bucket.get_key(key_name, validate=False)
-
+    # Files that didn't exist on S3
+    for local_path in sorted(local_paths - set(remote_paths)):
         print(local_path)
 
         if not always:
@@ -131,9 +170,37 @@ def sync():
             return
 
         if action == 'upload':
-            _assets_upload(local_path, key)
+            uploads.append(local_path)
         elif action == 'delete':
-            _assets_delete(local_path, key)
+            deletes.append(local_path)
+
+    transfers = []
+
+    for local_path in downloads:
+        transfers.append((partial(_assets_download_path, size=remote_sizes[local_path]), local_path))
+
+    for local_path in uploads:
+        transfers.append((partial(_assets_upload_path, local_md5=local_md5s.get(local_path)), local_path))
+
+    for local_path in deletes:
+        transfers.append((_assets_delete_path, local_path))
+
+    failed = []
+
+    with ThreadPoolExecutor(ASSETS_WORKERS) as executor:
+        futures = dict((executor.submit(fn, local_path), local_path) for fn, local_path in transfers)
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('Failed to sync %s (%s)' % (futures[future], e))
+                failed.append(futures[future])
+
+    print('Downloaded %i, uploaded %i, deleted %i, %i failed' % (len(downloads), len(uploads), len(deletes), len(failed)))
+
+    if failed:
+        raise Exception('%i assets failed to sync' % len(failed))
 
 @task
 def rm(path):
@@ -177,11 +244,50 @@ def rm(path):
 
 def _assets_get_bucket():
     """
-    Get a reference to the assets bucket.
+    Get a reference to the assets bucket. Each thread gets its own.
+    """
+    if not hasattr(_local, 'bucket'):
+        s3 = boto.connect_s3()
+
+        _local.bucket = s3.get_bucket(app_config.ASSETS_S3_BUCKET['bucket_name'])
+
+    return _local.bucket
+
+def _assets_key(local_path):
     """
-    s3 = boto.connect_s3()
+    Get the S3 key for a local asset, without making a request.
+    """
+    key_name = local_path.replace(ASSETS_ROOT, app_config.ASSETS_SLUG, 1)
+
+    return _assets_get_bucket().get_key(key_name, validate=False)
+
+def _assets_local_md5(local_path, digests):
+    """
+    MD5 of a local asset, reusing the cached value if the file hasn't changed.
+    """
+    stat = os.stat(local_path)
+    md5 = digests.get(local_path, 'md5', stat)
+
+    if md5 is None:
+        md5 = file_md5(local_path)
+        digests.set(local_path, 'md5', stat, md5)
 
-    return s3.get_bucket(app_config.ASSETS_S3_BUCKET['bucket_name'])
+    return md5
+
+def _assets_remote_md5(key_name):
+    """
+    MD5 of an asset on S3, as recorded by _assets_upload(),
+    or None if it has been deleted.
+    """
+    # We need an actual key, not a "list key"
+    # http://stackoverflow.com/a/18981298/24608
+    key = _assets_get_bucket().get_key(key_name)
+
+    if key is None:
+        return None
+
+    # Keys uploaded some other way have no md5, and never match a local file
+    return key.get_metadata('md5') or ''
 
 def _assets_confirm(local_path):
     """
@@ -225,21 +331,275 @@ def _assets_download(s3_key, local_path):
     dirname = os.path.dirname(local_path)
 
     if not (os.path.exists(dirname)):
-        os.makedirs(dirname)
+        os.makedirs(dirname, exist_ok=True)
+
+    # Keys from a bucket listing already know their size. Multipart
+    # downloads also need the md5 metadata, which listings don't include
+    if s3_key.size is None or s3_key.size >= ASSETS_MULTIPART_THRESHOLD:
+        s3_key = _assets_get_bucket().get_key(s3_key.name)
 
-    s3_key.get_contents_to_filename(local_path)
+    if s3_key.size >= ASSETS_MULTIPART_THRESHOLD:
+        _assets_multipart_download(s3_key, local_path)
+    else:
+        s3_key.get_contents_to_filename(local_path)
 
-def _assets_upload(local_path, s3_key):
+def _assets_upload(local_path, s3_key, local_md5=None):
     """
     Utility method to upload a single asset to S3.
     """
     print('--> Uploading!')
 
+    if os.path.getsize(local_path) >= ASSETS_MULTIPART_THRESHOLD:
+        _assets_multipart_upload(local_path, s3_key.name, local_md5)
+
+        return
+
     with open(local_path, 'rb') as f:
-        local_md5 = s3_key.compute_md5(f)[0]
+        if local_md5:
+            md5 = (local_md5, base64.b64encode(bytes.fromhex(local_md5)).decode('ascii'))
+        else:
+            md5 = s3_key.compute_md5(f)
+
+        s3_key.set_metadata('md5', md5[0])
+
+        # Passing the MD5 saves boto hashing the file again
+        s3_key.set_contents_from_file(f, md5=md5[:2], rewind=True)
+
+def _assets_parts(size):
+    """
+    Split a file of `size` bytes into (part number, offset, size) parts.
+    """
+    return [(offset // ASSETS_PART_SIZE + 1, offset, min(ASSETS_PART_SIZE, size - offset)) for offset in range(0, size, ASSETS_PART_SIZE)]
+
+def _assets_journal_path(direction, key_name):
+    """
+    Path of the journal recording progress of a multipart transfer.
+    """
+    name = hashlib.md5(key_name.encode('utf-8')).hexdigest()
+
+    return os.path.join(ASSETS_JOURNAL_PATH, '%s-%s.json' % (direction, name))
+
+def _assets_read_journal(journal_path):
+    try:
+        with open(journal_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def _assets_write_journal(journal_path, journal):
+    """
+    Write a journal via a temp file, so an interruption never leaves half of one.
+    """
+    os.makedirs(ASSETS_JOURNAL_PATH, exist_ok=True)
+
+    tmp_path = '%s.tmp' % journal_path
+
+    with open(tmp_path, 'w') as f:
+        json.dump(journal, f)
+
+    os.replace(tmp_path, journal_path)
+
+def _assets_remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _assets_multipart(key_name, upload_id):
+    """
+    Get a handle on an in-progress multipart upload, for this thread's connection.
+    """
+    mp = MultiPartUpload(_assets_get_bucket())
+    mp.key_name = key_name
+    mp.id = upload_id
+
+    return mp
+
+def _assets_upload_part(local_path, key_name, upload_id, part_number, offset, size):
+    """
+    Upload one part of a multipart upload. Returns its MD5.
+    """
+    with open(local_path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+
+    md5 = hashlib.md5(data)
+    md5_tuple = (md5.hexdigest(), base64.b64encode(md5.digest()).decode('ascii'))
+
+    # S3 rejects the part if it doesn't match the Content-MD5 boto sends
+    key = _assets_multipart(key_name, upload_id).upload_part_from_file(io.BytesIO(data), part_number, md5=md5_tuple, size=size)
+
+    if key.etag.strip('"') != md5_tuple[0]:
+        raise IOError('Part %i of %s was corrupted in transit' % (part_number, local_path))
+
+    return md5_tuple[0]
+
+def _assets_multipart_upload(local_path, key_name, local_md5=None):
+    """
+    Upload a large asset in parts, in parallel, resuming a previous
+    attempt recorded in the journal.
+    """
+    stat = os.stat(local_path)
+    signature = [stat.st_mtime_ns, stat.st_size, ASSETS_PART_SIZE]
+
+    journal_path = _assets_journal_path('upload', key_name)
+    journal = _assets_read_journal(journal_path)
+
+    uploaded = {}
+
+    if journal and journal['signature'] == signature:
+        # Only trust parts S3 still has with the checksum we recorded
+        try:
+            uploaded = dict((str(part.part_number), part.etag.strip('"')) for part in _assets_multipart(key_name, journal['upload_id']))
+        except S3ResponseError:
+            # The upload was aborted or expired
+            journal = None
+    elif journal:
+        # The file changed since the last attempt
+        try:
+            _assets_multipart(key_name, journal['upload_id']).cancel_upload()
+        except S3ResponseError:
+            pass
+
+        journal = None
+
+    if journal is None:
+        if local_md5 is None:
+            local_md5 = file_md5(local_path)
+
+        mp = _assets_get_bucket().initiate_multipart_upload(key_name, metadata={ 'md5': local_md5 })
+
+        journal = {
+            'upload_id': mp.id,
+            'signature': signature,
+            'parts': {}
+        }
+
+        _assets_write_journal(journal_path, journal)
+    else:
+        print('--> Resuming upload of %s' % local_path)
+
+    pending = []
+
+    for part_number, offset, size in _assets_parts(stat.st_size):
+        md5 = journal['parts'].get(str(part_number))
+
+        if md5 is None or uploaded.get(str(part_number)) != md5:
+            pending.append((part_number, offset, size))
+
+    lock = threading.Lock()
+
+    def upload(part):
+        part_number, offset, size = part
+        md5 = _assets_upload_part(local_path, key_name, journal['upload_id'], part_number, offset, size)
+
+        with lock:
+            journal['parts'][str(part_number)] = md5
+            _assets_write_journal(journal_path, journal)
+
+    with ThreadPoolExecutor(ASSETS_PART_WORKERS) as executor:
+        list(executor.map(upload, pending))
+
+    _assets_multipart(key_name, journal['upload_id']).complete_upload()
+
+    _assets_remove(journal_path)
+
+def _assets_download_part(key_name, data_path, offset, size):
+    """
+    Download one byte range of an asset into the partial file. Returns its MD5.
+    """
+    key = _assets_get_bucket().get_key(key_name, validate=False)
+    data = key.get_contents_as_string(headers={ 'Range': 'bytes=%i-%i' % (offset, offset + size - 1) })
+
+    if len(data) != size:
+        raise IOError('Expected %i bytes of %s, got %i' % (size, key_name, len(data)))
+
+    with open(data_path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+    return hashlib.md5(data).hexdigest()
+
+def _assets_part_intact(data_path, offset, size, md5):
+    """
+    Check a previously downloaded part is still on disk as we left it.
+    """
+    if md5 is None:
+        return False
+
+    with open(data_path, 'rb') as f:
+        f.seek(offset)
+
+        return hashlib.md5(f.read(size)).hexdigest() == md5
+
+def _assets_multipart_download(key, local_path):
+    """
+    Download a large asset in byte ranges, in parallel, resuming a
+    previous attempt recorded in the journal.
+    """
+    signature = [key.etag, key.size, ASSETS_PART_SIZE]
+
+    journal_path = _assets_journal_path('download', key.name)
+    data_path = '%s.data' % os.path.splitext(journal_path)[0]
+    journal = _assets_read_journal(journal_path)
+
+    if journal and journal['signature'] == signature and os.path.exists(data_path):
+        print('--> Resuming download of %s' % local_path)
+    else:
+        journal = {
+            'signature': signature,
+            'parts': {}
+        }
+
+        os.makedirs(ASSETS_JOURNAL_PATH, exist_ok=True)
+
+        with open(data_path, 'wb') as f:
+            f.truncate(key.size)
+
+        _assets_write_journal(journal_path, journal)
+
+    pending = []
+
+    for part_number, offset, size in _assets_parts(key.size):
+        if not _assets_part_intact(data_path, offset, size, journal['parts'].get(str(part_number))):
+            pending.append((part_number, offset, size))
+
+    lock = threading.Lock()
+
+    def download(part):
+        part_number, offset, size = part
+        md5 = _assets_download_part(key.name, data_path, offset, size)
+
+        with lock:
+            journal['parts'][str(part_number)] = md5
+            _assets_write_journal(journal_path, journal)
+
+    with ThreadPoolExecutor(ASSETS_PART_WORKERS) as executor:
+        list(executor.map(download, pending))
+
+    remote_md5 = key.get_metadata('md5')
+
+    if remote_md5 and file_md5(data_path) != remote_md5:
+        _assets_remove(journal_path)
+        _assets_remove(data_path)
+
+        raise IOError('Downloaded %s does not match its MD5 on S3' % local_path)
+
+    shutil.move(data_path, local_path)
+
+    _assets_remove(journal_path)
+
+def _assets_download_path(local_path, size=None):
+    s3_key = _assets_key(local_path)
+    s3_key.size = size
+
+    _assets_download(s3_key, local_path)
+
+def _assets_upload_path(local_path, local_md5=None):
+    _assets_upload(local_path, _assets_key(local_path), local_md5)
 
-    s3_key.set_metadata('md5', local_md5)
-    s3_key.set_contents_from_filename(local_path)
+def _assets_delete_path(local_path):
+    _assets_delete(local_path, _assets_key(local_path))
 
 def _assets_delete(local_path, s3_key):
     """
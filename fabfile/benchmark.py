@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+Commands that time the slow parts of the render pipeline.
+"""
+
+from glob import glob
+import shutil
+import tempfile
+import time
+
+from fabric.api import task
+
+import app
+import compile_cache
+import minifier
+import render_utils
+from render_utils import CSSIncluder, JavascriptIncluder
+
+def _timed(label, fn):
+    """
+    Run `fn` and print how long it took.
+    """
+    start = time.time()
+    result = fn()
+    elapsed = time.time() - start
+
+    print('%s: %.3fs' % (label, elapsed))
+
+    return elapsed, result
+
+@task
+def compile():
+    """
+    Time a cold and a warm compile of every JS and LESS source.
+    """
+    js_paths = [path[len('www/'):] for path in sorted(glob('www/js/*.js') + glob('www/js/lib/*.js'))]
+    less_paths = sorted(glob('less/*.less'))
+
+    def compress_all():
+        with app.app.test_request_context(path='/'):
+            js = JavascriptIncluder()
+            css = CSSIncluder()
+
+            for path in js_paths:
+                js.push(path)
+
+            for path in less_paths:
+                css.push(path)
+
+            return js._compress() + css._compress()
+
+    # Use a throwaway cache so the benchmark doesn't disturb the real one
+    cache_path = compile_cache.CACHE_PATH
+    compile_cache.CACHE_PATH = tempfile.mkdtemp()
+
+    try:
+        print('Compiling %i JS and %i LESS files' % (len(js_paths), len(less_paths)))
+
+        cold, cold_output = _timed('Cold cache', compress_all)
+        warm, warm_output = _timed('Warm cache', compress_all)
+
+        assert cold_output == warm_output
+
+        print('Speedup: %.1fx' % (cold / max(warm, 0.001)))
+    finally:
+        shutil.rmtree(compile_cache.CACHE_PATH)
+        compile_cache.CACHE_PATH = cache_path
+
+def _legacy_convert_to_slug(s):
+    return s.strip().lower().replace('.','').replace(' ','-').replace(',','-').replace('--','-')
+
+def _legacy_contains(value, check):
+    check = check.encode('ascii','ignore').decode('UTF-8')
+    value = value.encode('ascii','ignore').decode('UTF-8')
+    return str(check) in str(value)
+
+def _legacy_nat_sort(l, k):
+    from natsort import natsorted
+    sl = natsorted([(item[k], item) for item in l])
+    return [item[-1] for item in sl]
+
+@task
+def helpers(rows=10000):
+    """
+    Time the slug, contains and nat_sort template helpers per row, before and after memoizing.
+    """
+    rows = int(rows)
+
+    # Typical data: many rows sharing a smaller set of names
+    data = [{ 'name': 'Library District %i, St. Louis ¢' % (i % 500), 'rank': 'Item %i' % (rows - i) } for i in range(rows)]
+    names = [row['name'] for row in data]
+
+    def per_row(label, fn):
+        elapsed, result = _timed(label, fn)
+        print('    %.2fus per row' % (elapsed / rows * 1000000))
+
+        return result
+
+    before = per_row('convert_to_slug (before)', lambda: [_legacy_convert_to_slug(name) for name in names])
+    after = per_row('convert_to_slug (after)', lambda: [render_utils.convert_to_slug(name) for name in names])
+    bulk = per_row('slugify_all', lambda: render_utils.slugify_all(names))
+
+    assert before == after == bulk
+
+    before = per_row('contains (before)', lambda: [_legacy_contains(name, 'Louis') for name in names])
+    after = per_row('contains (after)', lambda: [render_utils.contains(name, 'Louis') for name in names])
+
+    assert before == after
+
+    before = per_row('nat_sort (before)', lambda: _legacy_nat_sort(data, 'rank'))
+    after = per_row('nat_sort (after)', lambda: render_utils.nat_sort(data, 'rank'))
+
+    assert before == after
+
+@task
+def minify(repeat=5):
+    """
+    Time htmlmin against the fast minifier on the rendered index page.
+    """
+    repeat = int(repeat)
+
+    with app.app.test_request_context(path='/'):
+        # Skip the OAuth check and the after_request minifier
+        html = app.index.__wrapped__().get_data(as_text=True)
+
+    print('Minifying index.html (%i bytes) %i times' % (len(html), repeat))
+
+    sizes = {}
+    timings = {}
+
+    for name in ['htmlmin', 'fast']:
+        minify = minifier.MINIFIERS[name]
+
+        elapsed, output = _timed(name, lambda: [minify(html) for i in range(repeat)][-1])
+
+        timings[name] = elapsed / repeat
+        sizes[name] = len(output)
+
+        print('    %.1fms per page, %i bytes' % (timings[name] * 1000, sizes[name]))
+
+    print('Speedup: %.1fx' % (timings['htmlmin'] / max(timings['fast'], 0.000001)))
+
+    minifier._minify.cache_clear()
+
+    _timed('minify_html (cold cache)', lambda: minifier.minify_html(html, 'htmlmin'))
+    _timed('minify_html (warm cache)', lambda: minifier.minify_html(html, 'htmlmin'))
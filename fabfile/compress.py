@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Commands for precompressing the rendered site.
+
+Writes `.gz` and `.br` copies next to every text file in www/, so the
+graphics server (with gzip_static, and brotli_static when
+NGINX_BROTLI_STATIC is on, see confs/nginx.conf) can send them as-is
+instead of compressing on every request.
+
+The copies written are recorded in COMPRESS_MANIFEST_PATH, so copies
+whose source goes away can be cleaned up without touching compressed
+files that were put in www/ by hand. "fab deploy" then deletes them
+from the server too.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import json
+import os
+
+from fabric.api import task
+
+# Brotli is optional. Without it, only .gz files are written
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_ROOT = 'www'
+
+COMPRESS_FILE_TYPES = ['.html', '.js', '.json', '.geojson', '.topojson', '.css', '.xml', '.svg', '.txt', '.csv']
+
+# Files smaller than this don't get smaller enough to be worth it
+COMPRESS_MIN_SIZE = 1024
+
+# Compressed copies written by precompress()
+COMPRESS_MANIFEST_PATH = '.compress-manifest.json'
+
+def _is_up_to_date(src, out_path):
+    """
+    Check whether a compressed copy was made from the current version of
+    its source. Copies are stamped with their source's exact modification
+    time, since sources (e.g. downloaded assets) can be older than a stale copy.
+    """
+    try:
+        return os.stat(out_path).st_mtime_ns == os.stat(src).st_mtime_ns
+    except OSError:
+        return False
+
+def _write(out_path, data, mtime_ns):
+    """
+    Write a compressed copy stamped with its source's modification time,
+    via a temp file so the server never sees half of one.
+    """
+    tmp_path = '%s.tmp' % out_path
+
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, out_path)
+
+def compress_file(src):
+    """
+    Write the compressed copies of one file that are missing or out of date.
+    Returns the paths written.
+    """
+    written = []
+    contents = None
+
+    # Stat before reading, so a source that changes meanwhile looks stale next time
+    mtime_ns = os.stat(src).st_mtime_ns
+
+    variants = [('%s.gz' % src, lambda data: gzip.compress(data, 9, mtime=0))]
+
+    if brotli:
+        variants.append(('%s.br' % src, lambda data: brotli.compress(data, quality=11)))
+
+    for out_path, compress in variants:
+        if _is_up_to_date(src, out_path):
+            continue
+
+        if contents is None:
+            with open(src, 'rb') as f:
+                contents = f.read()
+
+        _write(out_path, compress(contents), mtime_ns)
+        written.append(out_path)
+
+    return written
+
+def _find_files(root):
+    """
+    Find every file under `root` that should be precompressed.
+    """
+    paths = []
+
+    for local_path, subdirs, filenames in os.walk(root):
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+
+            if os.path.splitext(name)[1].lower() not in COMPRESS_FILE_TYPES:
+                continue
+
+            path = os.path.join(local_path, name)
+
+            if os.path.getsize(path) < COMPRESS_MIN_SIZE:
+                continue
+
+            paths.append(path)
+
+    return paths
+
+def _outputs(paths):
+    """
+    The compressed copies precompress() keeps for `paths`.
+    """
+    extensions = ['.gz', '.br'] if brotli else ['.gz']
+
+    return set('%s%s' % (path, extension) for path in paths for extension in extensions)
+
+def _load_written(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+def _save_written(manifest_path, written):
+    tmp_path = '%s.tmp' % manifest_path
+
+    with open(tmp_path, 'w') as f:
+        json.dump(sorted(written), f, indent=4)
+
+    os.replace(tmp_path, manifest_path)
+
+def _find_orphans(paths, written):
+    """
+    Find copies precompress() wrote earlier whose source is gone or no
+    longer compressed (deleted, shrunk below COMPRESS_MIN_SIZE, or .br
+    without brotli), so the server doesn't keep sending them.
+    """
+    outputs = _outputs(paths)
+
+    return sorted(path for path in written if path not in outputs)
+
+@task(default=True)
+def precompress(root=COMPRESS_ROOT, workers=None, manifest_path=COMPRESS_MANIFEST_PATH):
+    """
+    Write .gz and .br copies of text files in www/, in parallel, and
+    remove stale copies. Returns the paths removed.
+    """
+    paths = _find_files(root)
+    written = 0
+
+    with ProcessPoolExecutor(int(workers) if workers else None) as executor:
+        for out_paths in executor.map(compress_file, paths, chunksize=16):
+            for out_path in out_paths:
+                print('Compressed %s' % out_path)
+
+            written += len(out_paths)
+
+    orphans = _find_orphans(paths, _load_written(manifest_path))
+
+    for path in orphans:
+        if os.path.exists(path):
+            os.remove(path)
+            print('Removed %s' % path)
+
+    _save_written(manifest_path, _outputs(paths))
+
+    print('Wrote %i compressed files, %i already up to date, removed %i stale' % (written, len(paths) * (2 if brotli else 1) - written, len(orphans)))
+
+    return orphans
@@ -3,8 +3,12 @@
 """
 Commands that update or process the application data.
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
+import os
+import threading
+import time
 
 from fabric.api import task
 from facebook import GraphAPI
@@ -12,6 +16,19 @@ from twitter import Twitter, OAuth
 
 import app_config
 import copytext
+from render_utils import get_copy
+
+FEATURED_PATH = 'data/featured.json'
+
+TWITTER_API_DOMAIN = 'api.twitter.com'
+TWITTER_API_SECURE = True
+
+# (calls per second, burst) for each API. statuses/show allows 900 calls per 15 minutes
+TWITTER_RATE_LIMIT = (1, 5)
+FACEBOOK_RATE_LIMIT = (5, 10)
+
+# API calls in flight at once
+FETCH_WORKERS = 8
 
 @task(default=True)
 def update():
@@ -20,137 +37,229 @@ def update():
     """
     #update_featured_social()
 
-@task
-def update_featured_social():
+class TokenBucket(object):
     """
-    Update featured tweets
+    Allows `rate` calls per second on average, in bursts of up to `capacity`.
+    acquire() blocks until a call is allowed.
     """
-    COPY = copytext.Copy(app_config.COPY_PATH)
-    secrets = app_config.get_secrets()
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
 
-    # Twitter
-    print('Fetching tweets...')
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-    twitter_api = Twitter(
-        auth=OAuth(
-            secrets['TWITTER_API_OAUTH_TOKEN'],
-            secrets['TWITTER_API_OAUTH_SECRET'],
-            secrets['TWITTER_API_CONSUMER_KEY'],
-            secrets['TWITTER_API_CONSUMER_SECRET']
-        )
-    )
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
 
-    tweets = []
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
 
-    for i in range(1, 4):
-        tweet_url = COPY['share']['featured_tweet%i' % i]
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
 
-        if isinstance(tweet_url, copytext.Error) or str(tweet_url).strip() == '':
-            continue
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+class Fetcher(object):
+    """
+    Runs API calls on a thread pool, each through its API's rate limit.
+    Calls made with a `key` are only made once, however many posts need them.
+    """
+    def __init__(self, limits, workers=FETCH_WORKERS):
+        self.buckets = dict((api, TokenBucket(rate, capacity)) for api, (rate, capacity) in limits.items())
+        self.executor = ThreadPoolExecutor(workers)
+
+        self._cache = {}
+        self._lock = threading.Lock()
 
-        tweet_id = str(tweet_url).split('/')[-1]
+    def _call(self, api, fn, args, kwargs):
+        self.buckets[api].acquire()
 
-        tweet = twitter_api.statuses.show(id=tweet_id)
+        return fn(*args, **kwargs)
 
-        creation_date = datetime.strptime(tweet['created_at'],'%a %b %d %H:%M:%S +0000 %Y')
-        creation_date = '%s %i' % (creation_date.strftime('%b'), creation_date.day)
+    def submit(self, api, fn, *args, **kwargs):
+        """
+        Start an API call, returning a future.
+        """
+        return self.executor.submit(self._call, api, fn, args, kwargs)
+
+    def cached(self, key, api, fn, *args, **kwargs):
+        """
+        Start an API call, or return the future of an identical earlier one.
+        """
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = self.submit(api, fn, *args, **kwargs)
+
+            return self._cache[key]
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def _tweet_link(url, display, tweet_url, action='link'):
+    return '<a href="%s" target="_blank" onclick="_gaq.push([\'_trackEvent\', \'%s\', \'featured-tweet-action\', \'%s\', 0, \'%s\']);">%s</a>' % (url, app_config.PROJECT_SLUG, action, tweet_url, display)
+
+def _format_tweet(tweet):
+    """
+    Convert a tweet from the Twitter API into what we show on the page.
+    """
+    creation_date = datetime.strptime(tweet['created_at'],'%a %b %d %H:%M:%S +0000 %Y')
+    creation_date = '%s %i' % (creation_date.strftime('%b'), creation_date.day)
+
+    tweet_url = 'http://twitter.com/%s/status/%s' % (tweet['user']['screen_name'], tweet['id'])
+
+    photo = None
+    html = tweet['text']
+    subs = {}
+
+    for media in tweet['entities'].get('media', []):
+        original = tweet['text'][media['indices'][0]:media['indices'][1]]
+        subs[original] = _tweet_link(media['url'], media['display_url'], tweet_url)
+
+        if media['type'] == 'photo' and not photo:
+            photo = {
+                'url': media['media_url']
+            }
+
+    for url in tweet['entities'].get('urls', []):
+        original = tweet['text'][url['indices'][0]:url['indices'][1]]
+        subs[original] = _tweet_link(url['url'], url['display_url'], tweet_url)
+
+    for hashtag in tweet['entities'].get('hashtags', []):
+        original = tweet['text'][hashtag['indices'][0]:hashtag['indices'][1]]
+        subs[original] = _tweet_link('https://twitter.com/hashtag/%s' % hashtag['text'], '#%s' % hashtag['text'], tweet_url, 'hashtag')
+
+    for original, replacement in subs.items():
+        html =  html.replace(original, replacement)
+
+    # https://dev.twitter.com/docs/api/1.1/get/statuses/show/%3Aid
+    return {
+        'id': tweet['id'],
+        'url': tweet_url,
+        'html': html,
+        'favorite_count': tweet['favorite_count'],
+        'retweet_count': tweet['retweet_count'],
+        'user': {
+            'id': tweet['user']['id'],
+            'name': tweet['user']['name'],
+            'screen_name': tweet['user']['screen_name'],
+            'profile_image_url': tweet['user']['profile_image_url'],
+            'url': tweet['user']['url'],
+        },
+        'creation_date': creation_date,
+        'photo': photo
+    }
 
-        tweet_url = 'http://twitter.com/%s/status/%s' % (tweet['user']['screen_name'], tweet['id'])
+def _format_facebook_post(post, user, user_picture, likes, comments):
+    """
+    Convert a post and its related Graph API objects into what we show on the page.
+    """
+    creation_date = datetime.strptime(post['created_time'],'%Y-%m-%dT%H:%M:%S+0000')
+    creation_date = '%s %i' % (creation_date.strftime('%b'), creation_date.day)
+
+    # https://developers.facebook.com/docs/graph-api/reference/v2.0/post
+    return {
+        'id': post['id'],
+        'message': post['message'],
+        'link': {
+            'url': post['link'],
+            'name': post['name'],
+            'caption': (post['caption'] if 'caption' in post else None),
+            'description': post['description'],
+            'picture': post['picture']
+        },
+        'from': {
+            'name': user['name'],
+            'link': user['link'],
+            'picture': user_picture['url']
+        },
+        'likes': likes['summary']['total_count'],
+        'comments': comments['summary']['total_count'],
+        #'shares': shares['summary']['total_count'],
+        'creation_date': creation_date
+    }
 
-        photo = None
-        html = tweet['text']
-        subs = {}
+def _featured_ids(COPY, name):
+    """
+    IDs of the featured posts in the share sheet, e.g. featured_tweet1 to featured_tweet3.
+    """
+    ids = []
 
-        for media in tweet['entities'].get('media', []):
-            original = tweet['text'][media['indices'][0]:media['indices'][1]]
-            replacement = '<a href="%s" target="_blank" onclick="_gaq.push([\'_trackEvent\', \'%s\', \'featured-tweet-action\', \'link\', 0, \'%s\']);">%s</a>' % (media['url'], app_config.PROJECT_SLUG, tweet_url, media['display_url'])
+    for i in range(1, 4):
+        url = COPY['share']['%s%i' % (name, i)]
 
-            subs[original] = replacement
+        if isinstance(url, copytext.Error) or str(url).strip() == '':
+            continue
 
-            if media['type'] == 'photo' and not photo:
-                photo = {
-                    'url': media['media_url']
-                }
+        ids.append(str(url).split('/')[-1])
 
-        for url in tweet['entities'].get('urls', []):
-            original = tweet['text'][url['indices'][0]:url['indices'][1]]
-            replacement = '<a href="%s" target="_blank" onclick="_gaq.push([\'_trackEvent\', \'%s\', \'featured-tweet-action\', \'link\', 0, \'%s\']);">%s</a>' % (url['url'], app_config.PROJECT_SLUG, tweet_url, url['display_url'])
+    return ids
 
-            subs[original] = replacement
+def _fetch_facebook_post(fetcher, fb_api, fb_id, post_future, likes_future, comments_future):
+    post = post_future.result()
+    user_id = post['from']['id']
 
-        for hashtag in tweet['entities'].get('hashtags', []):
-            original = tweet['text'][hashtag['indices'][0]:hashtag['indices'][1]]
-            replacement = '<a href="https://twitter.com/hashtag/%s" target="_blank" onclick="_gaq.push([\'_trackEvent\', \'%s\', \'featured-tweet-action\', \'hashtag\', 0, \'%s\']);">%s</a>' % (hashtag['text'], app_config.PROJECT_SLUG, tweet_url, '#%s' % hashtag['text'])
+    # Several featured posts are often from the same page
+    user = fetcher.cached(user_id, 'facebook', fb_api.get_object, user_id)
+    user_picture = fetcher.cached('%s/picture' % user_id, 'facebook', fb_api.get_object, '%s/picture' % user_id)
 
-            subs[original] = replacement
+    return _format_facebook_post(post, user.result(), user_picture.result(), likes_future.result(), comments_future.result())
 
-        for original, replacement in subs.items():
-            html =  html.replace(original, replacement)
+@task
+def update_featured_social():
+    """
+    Update featured tweets and Facebook posts, fetching them concurrently
+    """
+    COPY = get_copy()
+    secrets = app_config.get_secrets()
 
-        # https://dev.twitter.com/docs/api/1.1/get/statuses/show/%3Aid
-        tweets.append({
-            'id': tweet['id'],
-            'url': tweet_url,
-            'html': html,
-            'favorite_count': tweet['favorite_count'],
-            'retweet_count': tweet['retweet_count'],
-            'user': {
-                'id': tweet['user']['id'],
-                'name': tweet['user']['name'],
-                'screen_name': tweet['user']['screen_name'],
-                'profile_image_url': tweet['user']['profile_image_url'],
-                'url': tweet['user']['url'],
-            },
-            'creation_date': creation_date,
-            'photo': photo
-        })
+    tweet_ids = _featured_ids(COPY, 'featured_tweet')
+    fb_ids = _featured_ids(COPY, 'featured_facebook')
 
-    # Facebook
-    print('Fetching Facebook posts...')
+    twitter_api = Twitter(
+        auth=OAuth(
+            secrets['TWITTER_API_OAUTH_TOKEN'],
+            secrets['TWITTER_API_OAUTH_SECRET'],
+            secrets['TWITTER_API_CONSUMER_KEY'],
+            secrets['TWITTER_API_CONSUMER_SECRET']
+        ),
+        domain=TWITTER_API_DOMAIN,
+        secure=TWITTER_API_SECURE
+    )
 
     fb_api = GraphAPI(secrets['FACEBOOK_API_APP_TOKEN'])
 
-    facebook_posts = []
+    fetcher = Fetcher({
+        'twitter': TWITTER_RATE_LIMIT,
+        'facebook': FACEBOOK_RATE_LIMIT
+    })
 
-    for i in range(1, 4):
-        fb_url = COPY['share']['featured_facebook%i' % i]
+    print('Fetching %i tweets and %i Facebook posts...' % (len(tweet_ids), len(fb_ids)))
 
-        if isinstance(fb_url, copytext.Error) or str(fb_url).strip() == '':
-            continue
+    try:
+        tweet_futures = [fetcher.submit('twitter', twitter_api.statuses.show, id=tweet_id) for tweet_id in tweet_ids]
+
+        # Everything but the author can be fetched as soon as we know the post's ID
+        fb_futures = []
 
-        fb_id = str(fb_url).split('/')[-1]
-
-        post = fb_api.get_object(fb_id)
-        user  = fb_api.get_object(post['from']['id'])
-        user_picture = fb_api.get_object('%s/picture' % post['from']['id'])
-        likes = fb_api.get_object('%s/likes' % fb_id, summary='true')
-        comments = fb_api.get_object('%s/comments' % fb_id, summary='true')
-        #shares = fb_api.get_object('%s/sharedposts' % fb_id)
-
-        creation_date = datetime.strptime(post['created_time'],'%Y-%m-%dT%H:%M:%S+0000')
-        creation_date = '%s %i' % (creation_date.strftime('%b'), creation_date.day)
-
-        # https://developers.facebook.com/docs/graph-api/reference/v2.0/post
-        facebook_posts.append({
-            'id': post['id'],
-            'message': post['message'],
-            'link': {
-                'url': post['link'],
-                'name': post['name'],
-                'caption': (post['caption'] if 'caption' in post else None),
-                'description': post['description'],
-                'picture': post['picture']
-            },
-            'from': {
-                'name': user['name'],
-                'link': user['link'],
-                'picture': user_picture['url']
-            },
-            'likes': likes['summary']['total_count'],
-            'comments': comments['summary']['total_count'],
-            #'shares': shares['summary']['total_count'],
-            'creation_date': creation_date
-        })
+        for fb_id in fb_ids:
+            fb_futures.append((
+                fb_id,
+                fetcher.submit('facebook', fb_api.get_object, fb_id),
+                fetcher.submit('facebook', fb_api.get_object, '%s/likes' % fb_id, summary='true'),
+                fetcher.submit('facebook', fb_api.get_object, '%s/comments' % fb_id, summary='true')
+            ))
+
+        tweets = [_format_tweet(future.result()) for future in tweet_futures]
+        facebook_posts = [_fetch_facebook_post(fetcher, fb_api, *futures) for futures in fb_futures]
+    finally:
+        fetcher.shutdown()
 
     # Render to JSON
     output = {
@@ -158,5 +267,10 @@ def update_featured_social():
         'facebook_posts': facebook_posts
     }
 
-    with open('data/featured.json', 'w') as f:
+    # Write to a temp file and rename, so the app never reads half a file
+    tmp_path = '%s.tmp' % FEATURED_PATH
+
+    with open(tmp_path, 'w') as f:
         json.dump(output, f)
+
+    os.replace(tmp_path, FEATURED_PATH)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Manifests of what was last deployed to the graphics server.
+
+"fab deploy" rsyncs www/ to the graphics server. Comparing the tree
+with the manifest of the last deploy tells it which files to send and
+which to delete from the server, without rsync having to compare the
+whole tree over the network.
+"""
+
+from fnmatch import fnmatch
+import json
+import os
+
+from .flat import file_md5
+
+def load_manifest(path):
+    """
+    Load a deploy manifest, or an empty one if it doesn't exist.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
+    """
+    Save a deploy manifest.
+    """
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+def build_manifest(src, ignore=[], previous={}):
+    """
+    Map every file under `src` (relative path) to its modification time,
+    size and MD5. Files whose time and size match `previous` reuse its
+    MD5 instead of being hashed again.
+    """
+    manifest = {}
+
+    for local_path, subdirs, filenames in os.walk(src):
+        for name in filenames:
+            src_path = os.path.join(local_path, name)
+            rel_path = os.path.relpath(src_path, src)
+
+            if any(fnmatch(name, pattern) or fnmatch(rel_path, pattern) for pattern in ignore):
+                continue
+
+            stat = os.stat(src_path)
+            entry = previous.get(rel_path)
+
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                md5 = entry[2]
+            else:
+                md5 = file_md5(src_path)
+
+            manifest[rel_path] = [stat.st_mtime_ns, stat.st_size, md5]
+
+    return manifest
+
+def changed_files(manifest, previous):
+    """
+    List the files in `manifest` that are new or whose contents differ from `previous`.
+    """
+    return sorted(
+        path for path, entry in manifest.items()
+        if path not in previous or previous[path][2] != entry[2]
+    )
+
+def removed_files(manifest, previous):
+    """
+    List the files in `previous` that are no longer in `manifest`.
+    """
+    return sorted(set(previous) - set(manifest))
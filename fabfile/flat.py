@@ -1,20 +1,42 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import copy
-from io import StringIO
 from fnmatch import fnmatch
 import gzip
 import hashlib
 import mimetypes
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 
 import boto
+from boto.exception import BotoClientError, BotoServerError
 from boto.s3.key import Key
 
 import app_config
 
 GZIP_FILE_TYPES = ['.html', '.js', '.json', '.css', '.xml']
 
+# Number of files uploaded at once by deploy_folder()
+DEPLOY_WORKERS = 8
+
+# Failed uploads are retried this many times, waiting
+# DEPLOY_BACKOFF seconds, then twice that, and so on
+DEPLOY_RETRIES = 3
+DEPLOY_BACKOFF = 1.0
+
+# Remembers the MD5 of what was last uploaded for each local file. See DigestCache
+DEPLOY_CACHE_PATH = '.deploy-cache.sqlite'
+
+# Files are read, compressed and hashed this many bytes at a time
+CHUNK_SIZE = 1024 * 1024
+
+# One bucket handle (and so one pooled connection) per upload thread
+_local = threading.local()
+
 class FakeTime:
     def time(self):
         return 1261130520.0
@@ -23,63 +45,177 @@ class FakeTime:
 # See: http://stackoverflow.com/questions/264224/setting-the-gzip-timestamp-from-python
 gzip.time = FakeTime()
 
-def deploy_file(connection, src, dst, headers={}):
+def _get_bucket():
+    """
+    Get this thread's handle on the deployment bucket.
+    """
+    if not hasattr(_local, 'bucket'):
+        connection = boto.connect_s3()
+
+        # validate=False skips a needless request to check the bucket exists
+        _local.bucket = connection.get_bucket(app_config.S3_BUCKET['bucket_name'], validate=False)
+
+    return _local.bucket
+
+def list_md5s(bucket, prefix):
+    """
+    Fetch the MD5 of every file under `prefix` on S3 in one listing,
+    rather than requesting each key separately.
+    """
+    return dict((key.name, key.etag.strip('"')) for key in bucket.list(prefix=prefix))
+
+class DigestCache(object):
+    """
+    Maps a local file (by path, modification time and size) and its
+    destination to the MD5 of what gets uploaded for it, so unchanged
+    files are neither recompressed nor rehashed on the next deploy.
+    """
+    def __init__(self, path=DEPLOY_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests (src TEXT, dst TEXT, mtime INTEGER, size INTEGER, md5 TEXT, PRIMARY KEY (src, dst))')
+
+    def get(self, src, dst, stat):
+        with self.lock:
+            row = self.db.execute('SELECT md5 FROM digests WHERE src = ? AND dst = ? AND mtime = ? AND size = ?', (src, dst, stat.st_mtime_ns, stat.st_size)).fetchone()
+
+        return row[0] if row else None
+
+    def set(self, src, dst, stat, md5):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)', (src, dst, stat.st_mtime_ns, stat.st_size, md5))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+class _HashingWriter(object):
+    """
+    File-like wrapper that hashes everything written through it.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+def _gzip_file(src, dst, output):
+    """
+    Gzip `src` into the file object `output` a chunk at a time,
+    returning the MD5 of the compressed data.
+    """
+    writer = _HashingWriter(output)
+
+    with open(src, 'rb') as f_in:
+        with gzip.GzipFile(filename=dst, mode='wb', fileobj=writer) as f_out:
+            for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+                f_out.write(chunk)
+
+    return writer.md5.hexdigest()
+
+def file_md5(src):
+    """
+    Hash a file a chunk at a time.
+    """
+    md5 = hashlib.md5()
+
+    with open(src, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+def deploy_file(bucket, src, dst, headers={}, s3_md5=None, digests=None):
     """
     Deploy a single file to S3, if the local version is different.
+
+    `s3_md5` is the ETag of the existing file on S3, if any, and `digests`
+    an optional DigestCache. Returns the number of bytes uploaded, or
+    None if the file was skipped.
     """
-    bucket = connection.get_bucket(app_config.S3_BUCKET['bucket_name'])
+    k = Key(bucket)
+    k.key = dst
 
-    k = bucket.get_key(dst)
-    s3_md5 = None
+    stat = os.stat(src)
 
-    if k:
-        s3_md5 = k.etag.strip('"')
-    else:
-        k = Key(bucket)
-        k.key = dst
+    # The cached digest lets us skip unchanged files without reading them
+    if digests and s3_md5 and digests.get(src, dst, stat) == s3_md5:
+        print('Skipping %s (has not changed)' % src)
+        return None
 
     file_headers = copy.copy(headers)
 
     if 'Content-Type' not in headers:
-        file_headers['Content-Type'] = mimetypes.guess_type(src)[0],
+        file_headers['Content-Type'] = mimetypes.guess_type(src)[0]
 
     # Gzip file
     if os.path.splitext(src)[1].lower() in GZIP_FILE_TYPES:
         file_headers['Content-Encoding'] = 'gzip'
 
-        with open(src, 'rb') as f_in:
-            contents = f_in.read()
+        # Compress to disk rather than memory, so large data files use bounded memory
+        with tempfile.TemporaryFile() as output:
+            local_md5 = _gzip_file(src, dst, output)
 
-        output = StringIO()
-        f_out = gzip.GzipFile(filename=dst, mode='wb', fileobj=output)
-        f_out.write(contents)
-        f_out.close()
+            if digests:
+                digests.set(src, dst, stat, local_md5)
 
-        local_md5 = hashlib.md5()
-        local_md5.update(output.getvalue())
-        local_md5 = local_md5.hexdigest()
+            if local_md5 == s3_md5:
+                print('Skipping %s (has not changed)' % src)
+                return None
 
-        if local_md5 == s3_md5:
-            print('Skipping %s (has not changed)' % src)
-        else:
             print('Uploading %s --> %s (gzipped)' % (src, dst))
-            k.set_contents_from_string(output.getvalue(), file_headers, policy='public-read')
+            size = output.tell()
+            output.seek(0)
+            k.set_contents_from_file(output, file_headers, policy='public-read', md5=k.get_md5_from_hexdigest(local_md5))
+
+            return size
     # Non-gzip file
     else:
-        with open(src, 'rb') as f:
-            local_md5 = hashlib.md5()
-            local_md5.update(f.read())
-            local_md5 = local_md5.hexdigest()
+        local_md5 = file_md5(src)
+
+        if digests:
+            digests.set(src, dst, stat, local_md5)
 
         if local_md5 == s3_md5:
             print('Skipping %s (has not changed)' % src)
-        else:
-            print('Uploading %s --> %s' % (src, dst))
-            k.set_contents_from_filename(src, file_headers, policy='public-read')
+            return None
+
+        print('Uploading %s --> %s' % (src, dst))
+        k.set_contents_from_filename(src, file_headers, policy='public-read', md5=k.get_md5_from_hexdigest(local_md5))
 
-def deploy_folder(src, dst, headers={}, ignore=[]):
+        return stat.st_size
+
+def _deploy_file_with_retries(src, dst, headers, s3_md5, digests=None):
+    """
+    Deploy a file from an upload thread, backing off and retrying on errors.
+    """
+    for attempt in range(DEPLOY_RETRIES + 1):
+        try:
+            return deploy_file(_get_bucket(), src, dst, headers, s3_md5, digests)
+        except (BotoClientError, BotoServerError, OSError) as e:
+            if attempt == DEPLOY_RETRIES:
+                raise
+
+            delay = DEPLOY_BACKOFF * (2 ** attempt)
+            print('Retrying %s in %.1fs (%s)' % (src, delay, e))
+            time.sleep(delay)
+
+            # Start over with a fresh connection (if the failure left us one)
+            _local.__dict__.pop('bucket', None)
+
+def deploy_folder(src, dst, headers={}, ignore=[], workers=DEPLOY_WORKERS, digest_cache_path=DEPLOY_CACHE_PATH):
     """
     Deploy a folder to S3, checking each file to see if it has changed.
+
+    Existing files are listed once up front, then changed files
+    are uploaded by a pool of `workers` threads.
     """
     to_deploy = []
 
@@ -109,10 +245,53 @@ def deploy_folder(src, dst, headers={}, ignore=[]):
 
             to_deploy.append((src_path, dst_path))
 
-    s3 = boto.connect_s3()
-
-    for src, dst in to_deploy:
-        deploy_file(s3, src, dst, headers)
+    s3_md5s = list_md5s(_get_bucket(), '%s/' % dst)
+
+    uploaded = 0
+    skipped = 0
+    failed = []
+    uploaded_bytes = 0
+    start = time.time()
+
+    digests = DigestCache(digest_cache_path)
+
+    try:
+        with ThreadPoolExecutor(int(workers)) as executor:
+            futures = {}
+
+            for src_path, dst_path in to_deploy:
+                future = executor.submit(_deploy_file_with_retries, src_path, dst_path, headers, s3_md5s.get(dst_path), digests)
+                futures[future] = src_path
+
+            for future in as_completed(futures):
+                try:
+                    size = future.result()
+                except Exception as e:
+                    print('Failed to upload %s (%s)' % (futures[future], e))
+                    failed.append(futures[future])
+                    continue
+
+                if size is None:
+                    skipped += 1
+                else:
+                    uploaded += 1
+                    uploaded_bytes += size
+    finally:
+        digests.close()
+
+    elapsed = max(time.time() - start, 0.001)
+
+    print('Uploaded %i files (%.1f MB, %.1f MB/s), skipped %i unchanged, %i failed, in %.1fs' % (
+        uploaded,
+        uploaded_bytes / 1048576.0,
+        uploaded_bytes / 1048576.0 / elapsed,
+        skipped,
+        len(failed),
+        elapsed
+    ))
+
+    if failed:
+        raise Exception('%i files failed to upload' % len(failed))
 
 def delete_folder(dst):
     """
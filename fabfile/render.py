@@ -5,14 +5,44 @@ Commands for rendering various parts of the app stack.
 """
 
 from glob import glob
+import hashlib
+import json
+import multiprocessing
 import os
 
-from fabric.api import local, task
+from fabric.api import task
 
-# This is needed in render_all() to minify the HTML content
+# This is needed in less() to minify the compiled CSS
 from htmlmin.main import minify
 
 import app
+import app_config
+import compiler
+from minifier import minify_html
+from render_utils import BetterJSONEncoder, configure_jinja, flatten_app_config, preload_templates, record_dependency
+
+# Compiled JST templates. Served by static._templates_js() during development
+JST_OUTPUT_PATH = 'www/js/templates.js'
+
+# Records what each rendered file read, so unchanged views can be skipped
+RENDER_MANIFEST_PATH = '.render_manifest.json'
+
+# Changes to any of these invalidate every rendered file
+RENDER_GLOBAL_DEPENDENCIES = [
+    'app.py',
+    'app_config.py',
+    'compiler.py',
+    'copy_snapshot.py',
+    'minifier.py',
+    'render_utils.py',
+    'static.py',
+    'fabfile/render.py',
+    'babel.config.js',
+    'package-lock.json',
+]
+
+# Shared state for render_all() worker processes. See _init_render_worker()
+_worker = {}
 
 def _fake_context(path):
     """
@@ -40,16 +70,22 @@ def less():
     """
     Render LESS files to CSS.
     """
-    for path in glob('less/*.less'):
+    paths = glob('less/*.less')
+
+    # Compile every file in one batch
+    try:
+        outputs = compiler.compile_less(paths)
+    except:
+        print('It looks like "lessc" isn\'t installed. Try running: "npm install"')
+        raise
+
+    for path, css in zip(paths, outputs):
         filename = os.path.split(path)[-1]
         name = os.path.splitext(filename)[0]
         out_path = 'www/css/%s.less.css' % name
 
-        try:
-            local('node_modules/less/bin/lessc %s %s' % (path, out_path))
-        except:
-            print('It looks like "lessc" isn\'t installed. Try running: "npm install"')
-            raise
+        with open(out_path, 'w') as f:
+            f.write(css)
 
         # JOSH ADDITION: WRITE A MINIFIED VERSION
         with open(out_path, 'r') as less_css:
@@ -59,22 +95,38 @@ def less():
 
 
 
-@task(default=True)
-def render_all( server_name=None, app_dir=None, project_slug=None ):
+@task
+def jst():
     """
-    Render HTML templates and compile assets.
+    Compile JST templates to www/js/templates.js, so they can be bundled with the other scripts.
     """
-    from flask import g
+    js = compiler.compile_jst()
 
-    less()
+    try:
+        with open(JST_OUTPUT_PATH) as f:
+            if f.read() == js:
+                return
+    except IOError:
+        pass
+
+    with open(JST_OUTPUT_PATH, 'w') as f:
+        f.write(js)
 
-    # Using server name, app dir, and project slug to construct Flask's SERVER_NAME and APPLICATION_ROOT.
-    # Setting these variables will ensure url_for() constructs correct URLs when deploying.
+def _configure_app(server_name=None, app_dir=None, project_slug=None):
+    """
+    Using server name, app dir, and project slug to construct Flask's SERVER_NAME and APPLICATION_ROOT.
+    Setting these variables will ensure url_for() constructs correct URLs when deploying.
+    """
     if server_name and app_dir and project_slug:
         app.app.config['SERVER_NAME'] = server_name
         app.app.config['APPLICATION_ROOT'] = '/' + app_dir + '/' + project_slug
 
-    compiled_includes = {}
+def _render_targets():
+    """
+    Build a list of (rule, endpoint, output filename) tuples for every
+    view that should be rendered to a flat file.
+    """
+    targets = []
 
     # Loop over all views in the app
     for rule in app.app.url_map.iter_rules():
@@ -100,34 +152,252 @@ def render_all( server_name=None, app_dir=None, project_slug=None ):
             print('Skipping %s' % name)
             continue
 
-        # Create the output path
-        dirname = os.path.dirname(filename)
+        targets.append((rule_string, name, filename))
+
+    return targets
+
+def _file_hash(path, hashes):
+    """
+    Hash the contents of a file, memoized in `hashes` for the
+    length of a render. Missing files hash to None.
+    """
+    if path not in hashes:
+        try:
+            with open(path, 'rb') as f:
+                hashes[path] = hashlib.md5(f.read()).hexdigest()
+        except IOError:
+            hashes[path] = None
+
+    return hashes[path]
+
+def _global_hash(hashes, server_name=None, app_dir=None, project_slug=None):
+    """
+    Hash everything that affects every rendered file: application code,
+    build tool versions, app_config values and render arguments.
+    """
+    global_hash = hashlib.md5()
+
+    for path in RENDER_GLOBAL_DEPENDENCIES:
+        global_hash.update(('%s:%s\n' % (path, _file_hash(path, hashes))).encode('utf-8'))
+
+    config = json.dumps(flatten_app_config(), cls=BetterJSONEncoder, sort_keys=True, default=str)
+    global_hash.update(config.encode('utf-8'))
+    global_hash.update(json.dumps([server_name, app_dir, project_slug]).encode('utf-8'))
+
+    return global_hash.hexdigest()
+
+def _load_manifest(global_hash):
+    """
+    Load the render manifest, discarding it if it was recorded
+    against different code or configuration.
+    """
+    try:
+        with open(RENDER_MANIFEST_PATH) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    if manifest.get('global') != global_hash:
+        return {}
+
+    return manifest.get('outputs', {})
+
+def _save_manifest(global_hash, outputs):
+    """
+    Write the render manifest.
+    """
+    with open(RENDER_MANIFEST_PATH, 'w') as f:
+        json.dump({ 'global': global_hash, 'outputs': outputs }, f, indent=4, sort_keys=True)
+
+def _is_fresh(filename, entry, hashes):
+    """
+    Check whether a rendered file and everything it read are unchanged
+    since it was recorded in the manifest.
+    """
+    if not entry or not os.path.exists(filename):
+        return False
+
+    # A view that recorded no inputs read files we don't know about
+    if not entry['inputs']:
+        return False
+
+    for path in entry['outputs']:
+        if not os.path.exists(path):
+            return False
+
+    for path, digest in entry['inputs'].items():
+        if _file_hash(path, hashes) != digest:
+            return False
+
+    return True
+
+def _track_templates():
+    """
+    Record every template the Jinja environment loads, including
+    templates pulled in by {% extends %} and {% include %}.
+    """
+    env = app.app.jinja_env
+
+    if getattr(env, 'tracks_dependencies', False):
+        return
+
+    get_template = env.get_template
+
+    def tracking_get_template(name, parent=None, globals=None):
+        template = get_template(name, parent, globals)
+
+        if template.filename:
+            record_dependency(os.path.relpath(template.filename))
 
-        if not (os.path.exists(dirname)):
-            os.makedirs(dirname)
+        return template
 
-        print('Rendering %s' % (filename))
+    env.get_template = tracking_get_template
+    env.tracks_dependencies = True
 
-        # Render views, reusing compiled assets
-        with _fake_context(rule_string):
-            g.compile_includes = True
-            g.compiled_includes = compiled_includes
+def _render_target(target, compiled_includes, compile_lock=None):
+    """
+    Render a single view to disk, reusing compiled assets.
+
+    Returns the output filename and the dependencies recorded while
+    rendering it.
+    """
+    from flask import g
+
+    rule_string, name, filename = target
+
+    # Create the output path
+    dirname = os.path.dirname(filename)
+
+    if not (os.path.exists(dirname)):
+        os.makedirs(dirname, exist_ok=True)
+
+    print('Rendering %s' % (filename))
+
+    # Render views, reusing compiled assets
+    with _fake_context(rule_string):
+        g.compile_includes = True
+        g.compiled_includes = compiled_includes
+        g.compile_lock = compile_lock
+        g.render_dependencies = { 'inputs': set(), 'outputs': set() }
+
+        view = _view_from_name(name)
+
+        content = view().data
+
+        dependencies = g.render_dependencies
 
-            view = _view_from_name(name)
+    # Make sure content is a Unicode string, not bytes
+    if isinstance(content, (bytes, bytearray)):
+        content = content.decode('utf-8')
 
-            content = view().data
+    # Minify HTML. Comment out the next two lines if you don't want to minify.
+    content = minify_html(content)
 
-            compiled_includes = g.compiled_includes
+    # Write rendered view
+    # NB: Flask response object has utf-8 encoded the data
+    with open(filename, 'w') as f:
+        f.write(content)
 
-        # Make sure content is a Unicode string, not bytes
-        if isinstance(content, (bytes, bytearray)):
-            content = content.decode('utf-8')
+    return filename, dependencies
+
+def _init_render_worker(compiled_includes, compile_lock, deployment_target, server_name, app_dir, project_slug):
+    """
+    Set up a render_all() worker process.
+
+    `compiled_includes` and `compile_lock` are proxies owned by the parent's
+    manager process, so every JS/CSS bundle is still compiled exactly once
+    no matter which worker gets to it first.
+    """
+    # Workers started with "spawn" (the default on macOS) re-import app_config,
+    # losing the target set by e.g. "fab production"
+    if app_config.DEPLOYMENT_TARGET != deployment_target:
+        app_config.configure_targets(deployment_target)
+
+    _configure_app(server_name, app_dir, project_slug)
+    configure_jinja(app.app)
+    _track_templates()
+
+    _worker['compiled_includes'] = compiled_includes
+    _worker['compile_lock'] = compile_lock
+
+def _render_worker(target):
+    """
+    Render one target inside a worker process.
+    """
+    return _render_target(target, _worker['compiled_includes'], _worker['compile_lock'])
+
+def _render_parallel(targets, workers, server_name=None, app_dir=None, project_slug=None):
+    """
+    Shard render targets across a pool of worker processes.
+    """
+    with multiprocessing.Manager() as manager:
+        compiled_includes = manager.dict()
+        compile_lock = manager.Lock()
+
+        initargs = (compiled_includes, compile_lock, app_config.DEPLOYMENT_TARGET, server_name, app_dir, project_slug)
+
+        # Compile templates once here, rather than once per worker
+        preload_templates(app.app.jinja_env)
+
+        with multiprocessing.Pool(workers, _init_render_worker, initargs) as pool:
+            # Hand out small shards so a few slow views don't leave other workers idle
+            chunksize = max(1, len(targets) // (workers * 4))
+
+            return list(pool.imap_unordered(_render_worker, targets, chunksize))
+
+@task(default=True)
+def render_all( server_name=None, app_dir=None, project_slug=None, workers=1, force=False ):
+    """
+    Render HTML templates and compile assets.
+
+    Pass `workers` to render views in parallel, e.g. `fab render.render_all:workers=8`.
+
+    Views whose templates, data files and asset sources have not changed
+    since the last render are skipped. Pass `force=True` to render everything.
+    """
+    less()
+    jst()
+
+    _configure_app(server_name, app_dir, project_slug)
+    configure_jinja(app.app)
+    _track_templates()
+
+    hashes = {}
+    global_hash = _global_hash(hashes, server_name, app_dir, project_slug)
+
+    if str(force).lower() in ('true', '1', 'yes'):
+        manifest = {}
+    else:
+        manifest = _load_manifest(global_hash)
+
+    outputs = {}
+    targets = []
+
+    for target in _render_targets():
+        filename = target[2]
+
+        if _is_fresh(filename, manifest.get(filename), hashes):
+            print('Skipping %s (has not changed)' % filename)
+            outputs[filename] = manifest[filename]
+        else:
+            targets.append(target)
+
+    workers = int(workers)
+
+    if workers > 1 and len(targets) > 1:
+        results = _render_parallel(targets, min(workers, len(targets)), server_name, app_dir, project_slug)
+    else:
+        compiled_includes = {}
+        results = [_render_target(target, compiled_includes) for target in targets]
 
-        # Minify HTML. Comment out the next two lines if you don't want to minify.
-        content = minify(content, remove_optional_attribute_quotes=False)
+    # Hash inputs after rendering, since views may have
+    # been reading files that were written during the render
+    hashes = {}
 
-        # Write rendered view
-        # NB: Flask response object has utf-8 encoded the data
-        with open(filename, 'w') as f:
-            f.write(content)
+    for filename, dependencies in results:
+        outputs[filename] = {
+            'inputs': dict((path, _file_hash(path, hashes)) for path in sorted(dependencies['inputs'])),
+            'outputs': sorted(dependencies['outputs'])
+        }
 
+    _save_manifest(global_hash, outputs)
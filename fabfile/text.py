@@ -14,7 +14,7 @@ from termcolor import colored
 @task(default=True)
 def update():
     """
-    Downloads a Google Doc as an Excel file.
+    Downloads a Google Doc as an Excel file. Returns True if it changed.
     """
     if app_config.COPY_GOOGLE_DOC_KEY == None:
         print(colored('You have set COPY_GOOGLE_DOC_KEY to None. If you want to use a Google Sheet, set COPY_GOOGLE_DOC_KEY  to the key of your sheet in app_config.py', 'blue'))
@@ -25,4 +25,4 @@ def update():
         print(colored('Run `fab app` and visit `http://localhost:8000` to generate credentials.', 'yellow'))
         return
 
-    get_document(app_config.COPY_GOOGLE_DOC_KEY, app_config.COPY_PATH)
+    return get_document(app_config.COPY_GOOGLE_DOC_KEY, app_config.COPY_PATH)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Minify rendered HTML.
+
+Both the dev server and "fab render" minify through minify_html(), so
+pages come out the same either way. Recent outputs are kept in memory,
+so a page the dev server sends again unchanged is only minified once.
+(They aren't put in compile_cache: pages would crowd out compiled
+assets, and "fab render" already skips pages that haven't changed.)
+
+Two minifiers are available, picked by app_config.HTML_MINIFIER:
+
+* 'htmlmin': the htmlmin package. Thorough, but a pure Python HTML
+  parser, so slow on big tables.
+* 'fast': collapses whitespace using a regular expression tokenizer.
+  Leaves <pre>, <textarea>, <script> and <style> alone, keeps comments
+  and attribute quotes (like htmlmin with remove_optional_attribute_quotes=False)
+  and shortens empty attributes, but doesn't strip text inside <title>.
+"""
+
+from functools import lru_cache
+import re
+
+from htmlmin.main import minify as htmlmin_minify
+
+import app_config
+
+# Minified pages kept in memory
+MINIFY_CACHE_SIZE = 64
+
+# Comments, elements whose contents must be left alone, other tags, and text
+_TOKENS = re.compile(r'''
+    (?P<comment><!--.*?-->)
+  | (?P<raw><(?P<raw_name>pre|textarea|script|style)\b[^>]*>.*?</(?P=raw_name)\s*>)
+  | (?P<tag></?(?P<name>[a-zA-Z][^\s/>]*)(?:"[^"]*"|'[^']*'|[^'">])*>)
+  | (?P<text>[^<]+|<)
+''', re.DOTALL | re.IGNORECASE | re.VERBOSE)
+
+# Inside a tag: empty attribute values, quoted values, and runs of whitespace
+_TAG_PARTS = re.compile(r'''(\s*=\s*""|\s*=\s*''(?=[\s/>]))|("[^"]*"|'[^']*')|(\s+)''')
+
+_SPACE = re.compile(r'\s+')
+
+def _minify_tag(tag):
+    def replace(match):
+        empty, quoted, space = match.groups()
+
+        if empty:
+            return ''
+
+        if quoted:
+            return quoted
+
+        return ' '
+
+    tag = _TAG_PARTS.sub(replace, tag)
+
+    # No space before the closing bracket
+    if tag.endswith(' >'):
+        tag = tag[:-2] + '>'
+    elif tag.endswith(' />'):
+        tag = tag[:-3] + '/>'
+
+    return tag
+
+def fast_minify(html):
+    """
+    Collapse whitespace in HTML, without parsing it.
+    """
+    output = []
+    in_head = False
+
+    for match in _TOKENS.finditer(html):
+        text, tag = match.group('text', 'tag')
+
+        if text is not None:
+            text = _SPACE.sub(' ', text)
+
+            # Whitespace between elements in <head> is never displayed
+            if in_head and text == ' ':
+                continue
+
+            output.append(text)
+        elif tag is not None:
+            if match.group('name').lower() == 'head':
+                in_head = not tag.startswith('</')
+
+            output.append(_minify_tag(tag))
+        else:
+            output.append(match.group(0))
+
+    return ''.join(output)
+
+def _htmlmin(html):
+    return htmlmin_minify(html, remove_optional_attribute_quotes=False)
+
+MINIFIERS = {
+    'fast': fast_minify,
+    'htmlmin': _htmlmin
+}
+
+@lru_cache(maxsize=MINIFY_CACHE_SIZE)
+def _minify(html, minifier):
+    return MINIFIERS[minifier](html)
+
+def minify_html(html, minifier=None):
+    """
+    Minify a page, reusing the result if it was minified recently.
+    """
+    if minifier is None:
+        minifier = app_config.HTML_MINIFIER
+
+    return _minify(html, minifier)
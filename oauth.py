@@ -1,15 +1,37 @@
 import app_config
+import copy_snapshot
+import json
 import os
+import tempfile
+import threading
 
 from app_config import authomatic
 from authomatic.adapters import WerkzeugAdapter
+from contextlib import contextmanager
 from flask import Blueprint, make_response, redirect, render_template, url_for
 from functools import wraps
-from render_utils import make_context
+from render_utils import invalidate_copy, make_context
+
+# Only used to stop processes refreshing credentials at the same time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Via: https://developers.google.com/drive/v3/reference/files/export
 # and: https://developers.google.com/drive/v3/web/manage-downloads
 DRIVE_API_EXPORT_TEMPLATE = 'https://www.googleapis.com/drive/v3/files/%s/export?mimeType=%s'
+DRIVE_API_FILE_TEMPLATE = 'https://www.googleapis.com/drive/v3/files/%s?fields=md5Checksum,modifiedTime,version'
+
+# Drive version of each downloaded document, used to skip unchanged exports
+DRIVE_METADATA_PATH = '.drive-metadata.json'
+
+# Refresh credentials this many seconds before they expire
+CREDENTIALS_REFRESH_MARGIN = 300
+
+# Deserialized credentials and the version of the file they came from
+_credentials_cache = {}
+_credentials_lock = threading.RLock()
 
 oauth = Blueprint('_oauth', __name__)
 
@@ -74,46 +96,164 @@ def oauth_required(f):
             return f(*args, **kwargs)
     return decorated_function
 
-def get_credentials():
+def _credentials_path():
+    return os.path.expanduser(app_config.GOOGLE_OAUTH_CREDENTIALS_PATH)
+
+def _credentials_signature(file_path):
     """
-    Read Authomatic credentials object from disk and refresh if necessary.
+    Identify a version of the credentials file by modification time and size.
     """
-    file_path = os.path.expanduser(app_config.GOOGLE_OAUTH_CREDENTIALS_PATH)
-
     try:
-        with open(file_path, 'r') as f:
-            serialized_credentials = f.read()
-    except IOError:
+        stat = os.stat(file_path)
+    except OSError:
         return None
 
-    credentials = authomatic.credentials(serialized_credentials)
+    return (stat.st_mtime_ns, stat.st_size)
 
-    if not credentials.valid:
-        resp = credentials.refresh()
+def _load_credentials(file_path):
+    """
+    Deserialize credentials from disk, reusing the copy in memory if
+    the file hasn't changed. Call with _credentials_lock held.
+    """
+    signature = _credentials_signature(file_path)
 
-        if not resp:
-            raise KeyError("Error! Could not refresh credentials.")
+    if signature is None:
+        _credentials_cache.clear()
 
-        if resp.status != 200:
-            raise KeyError("Error! Could not refresh credentials. Google returned a %s error" % resp.status)
+        return None
+
+    if _credentials_cache.get('signature') != signature:
+        try:
+            with open(file_path, 'r') as f:
+                serialized_credentials = f.read()
+        except IOError:
+            return None
+
+        _credentials_cache['signature'] = signature
+        _credentials_cache['credentials'] = authomatic.credentials(serialized_credentials)
 
-        save_credentials(credentials)
+    return _credentials_cache['credentials']
+
+@contextmanager
+def _refresh_lock(file_path):
+    """
+    Hold an exclusive lock while refreshing, so that several processes
+    (e.g. gunicorn workers) don't all refresh the same credentials.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open('%s.lock' % file_path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def get_credentials():
+    """
+    Get Authomatic credentials, refreshing them shortly before they expire.
+
+    Credentials are kept in memory and only read from disk again when the
+    file changes (e.g. another process refreshed them).
+    """
+    file_path = _credentials_path()
+
+    with _credentials_lock:
+        credentials = _load_credentials(file_path)
+
+        if credentials is None or not credentials.expire_soon(CREDENTIALS_REFRESH_MARGIN):
+            return credentials
+
+        with _refresh_lock(file_path):
+            # Another process may have refreshed while we waited for the lock
+            credentials = _load_credentials(file_path)
+
+            if credentials is None or not credentials.expire_soon(CREDENTIALS_REFRESH_MARGIN):
+                return credentials
+
+            resp = credentials.refresh(force=True)
+
+            if not resp:
+                raise KeyError("Error! Could not refresh credentials.")
+
+            if resp.status != 200:
+                raise KeyError("Error! Could not refresh credentials. Google returned a %s error" % resp.status)
+
+            _save_credentials(credentials)
 
     return credentials
 
-def save_credentials(credentials):
+def _save_credentials(credentials):
     """
-    Take Authomatic credentials object and save to disk.
+    Write credentials to disk and remember them. Call with _credentials_lock held.
     """
-    file_path = os.path.expanduser(app_config.GOOGLE_OAUTH_CREDENTIALS_PATH)
+    file_path = _credentials_path()
     serialized_credentials = credentials.serialize()
 
-    with open(file_path, 'w') as f:
+    # Write to a temp file and rename, so other processes never read half a file
+    tmp_path = '%s.tmp' % file_path
+
+    with open(tmp_path, 'w') as f:
         f.write(serialized_credentials)
 
+    os.replace(tmp_path, file_path)
+
+    _credentials_cache['signature'] = _credentials_signature(file_path)
+    _credentials_cache['credentials'] = credentials
+
+def save_credentials(credentials):
+    """
+    Take Authomatic credentials object and save to disk.
+    """
+    with _credentials_lock:
+        _save_credentials(credentials)
+
+def _file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+def _load_drive_metadata():
+    try:
+        with open(DRIVE_METADATA_PATH) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _save_drive_metadata(metadata):
+    tmp_path = '%s.tmp' % DRIVE_METADATA_PATH
+
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f, indent=4, sort_keys=True)
+
+    os.replace(tmp_path, DRIVE_METADATA_PATH)
+
+def _get_drive_version(credentials, key):
+    """
+    Get what identifies the current version of a Drive file, or None
+    if Drive won't say. Google Docs have no md5Checksum, but do have
+    a modifiedTime and version.
+    """
+    resp = app_config.authomatic.access(credentials, DRIVE_API_FILE_TEMPLATE % key)
+
+    if resp.status != 200 or not isinstance(resp.data, dict):
+        return None
+
+    return dict((field, resp.data.get(field)) for field in ('md5Checksum', 'modifiedTime', 'version'))
+
 def get_document(key, file_path, mimeType=None):
     """
     Uses Authomatic to get the google doc
+
+    The export is skipped when Drive reports the document hasn't changed
+    since it was last downloaded to `file_path`. Returns True if the
+    contents of `file_path` changed.
     """
 
     # Default to spreadsheet if no mimeType is passed
@@ -124,6 +264,17 @@ def get_document(key, file_path, mimeType=None):
 
     credentials = get_credentials()
 
+    metadata = _load_drive_metadata()
+    previous = metadata.get(file_path, {})
+
+    version = _get_drive_version(credentials, key)
+
+    if (version and previous.get('key') == key and previous.get('mimeType') == mimeType
+        and previous.get('version') == version and previous.get('signature') == _file_signature(file_path)):
+        print('%s is up to date' % file_path)
+
+        return False
+
     url = DRIVE_API_EXPORT_TEMPLATE % (
         key,
         mimeType)
@@ -135,8 +286,44 @@ def get_document(key, file_path, mimeType=None):
         else:
             raise KeyError("Error! Google returned a %s error" % resp.status)
 
-    with open(file_path, 'wb') as writefile:
-        writefile.write(resp.content)
+    content = resp.content
+
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+
+    try:
+        with open(file_path, 'rb') as f:
+            changed = f.read() != content
+    except IOError:
+        changed = True
+
+    if changed:
+        # Write to a temp file and rename, so readers never see a partial download
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', prefix='.tmp-')
+
+        with os.fdopen(fd, 'wb') as writefile:
+            writefile.write(content)
+
+        os.replace(tmp_path, file_path)
+
+        # Precompile spreadsheets so they don't have to be parsed at runtime
+        if mimeType == mime:
+            copy_snapshot.write_snapshot(file_path)
+
+        invalidate_copy(file_path)
+    else:
+        print('%s is unchanged' % file_path)
+
+    metadata[file_path] = {
+        'key': key,
+        'mimeType': mimeType,
+        'version': version,
+        'signature': _file_signature(file_path)
+    }
+
+    _save_drive_metadata(metadata)
+
+    return changed
 
 def _has_api_credentials():
     """
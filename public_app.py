@@ -2,12 +2,11 @@
 
 import app_config
 import datetime
-import json
 import logging
 import static
 
 from flask import Flask, make_response, render_template
-from render_utils import make_context, smarty_filter, urlencode_filter
+from render_utils import configure_jinja, load_json, make_context
 from werkzeug.debug import DebuggedApplication
 
 app = Flask(__name__)
@@ -20,8 +19,7 @@ app.logger.setLevel(logging.INFO)
 
 app.register_blueprint(static.static, url_prefix='/%s' % app_config.PROJECT_SLUG)
 
-app.add_template_filter(smarty_filter, name='smarty')
-app.add_template_filter(urlencode_filter, name='urlencode')
+configure_jinja(app)
 
 # Example application views
 @app.route('/%s/test/' % app_config.PROJECT_SLUG, methods=['GET'])
@@ -41,8 +39,7 @@ def index():
     """
     context = make_context(asset_depth=1)
 
-    with open('data/featured.json') as f:
-        context['featured'] = json.load(f)
+    context['featured'] = load_json('data/featured.json')
 
     return make_response(render_template('index.html', **context))
 
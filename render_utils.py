@@ -3,18 +3,53 @@
 # This allows use of unicode characters in my comments below.
 
 import codecs
+from contextlib import nullcontext
 from datetime import datetime
+from functools import lru_cache
+import hashlib
 import json
+import os
+import re
+import threading
 import time
-import urllib
-import subprocess
+import urllib.parse
 
-from flask import Markup, g, render_template, request
+from flask import Markup, g, has_app_context, render_template, request
+from jinja2 import FileSystemBytecodeCache
+from natsort import natsort_keygen
 from smartypants import smartypants
 
 import app_config
+import compiler
+import copy_snapshot
 import copytext
 
+# Number of hex digits of content hash used in fingerprinted filenames
+FINGERPRINT_LENGTH = 10
+
+# Matches filenames written by fingerprint_path(), e.g. app.1a2b3c4d5e.min.js
+_FINGERPRINTED = re.compile(r'^[^.]+\.[0-9a-f]{%i}\.' % FINGERPRINT_LENGTH)
+
+# Compiled templates are cached here between runs
+JINJA_CACHE_PATH = '.jinja_cache'
+
+# Distinct strings remembered by the slug and normalize helpers
+HELPER_CACHE_SIZE = 4096
+
+# Copy text is mostly the same strings over and over
+SMARTY_CACHE_SIZE = 8192
+
+_smartypants = lru_cache(maxsize=SMARTY_CACHE_SIZE)(smartypants)
+
+# Built once, rather than on every nat_sort() call
+_natsort_key = natsort_keygen()
+
+_SLUG_TABLE = str.maketrans({ '.': None, ' ': '-', ',': '-' })
+
+# Parsed copytext, keyed by path. See get_copy()
+_copy_cache = {}
+_copy_lock = threading.Lock()
+
 class BetterJSONEncoder(json.JSONEncoder):
     """
     A JSON encoder that intelligently handles datetimes.
@@ -53,6 +88,12 @@ class Includer(object):
     def _compress(self):
         raise NotImplementedError()
 
+    def _source_paths(self):
+        """
+        Files read when compiling this bundle. See "fab render".
+        """
+        raise NotImplementedError()
+
     def _relativize_path(self, path):
         relative_path = path
         depth = len(request.path.split('/')) - (2 + self.asset_depth)
@@ -65,24 +106,41 @@ class Includer(object):
 
     def render(self, path):
         if getattr(g, 'compile_includes', False):
-            if path in g.compiled_includes:
-                timestamp_path = g.compiled_includes[path]
-            else:
-                # Add a querystring to the rendered filename to prevent caching
-                timestamp_path = '%s?%i' % (path, int(time.time()))
+            # Parallel renders share one lock so each bundle is only compiled once
+            compile_lock = getattr(g, 'compile_lock', None) or nullcontext()
+
+            with compile_lock:
+                if path in g.compiled_includes:
+                    rendered_path = g.compiled_includes[path]
+                else:
+                    output = self._compress()
+
+                    if app_config.FINGERPRINT_ASSETS:
+                        # Put a hash of the content in the filename so unchanged bundles stay cached
+                        rendered_path = fingerprint_path(path, output.encode('utf-8'))
+                        out_path = 'www/%s' % rendered_path
+                    else:
+                        # Add a querystring to the rendered filename to prevent caching
+                        rendered_path = '%s?%i' % (path, int(time.time()))
+                        out_path = 'www/%s' % path
 
-                out_path = 'www/%s' % path
-
-                if path not in g.compiled_includes:
                     print('Rendering %s' % out_path)
 
                     with codecs.open(out_path, 'w', encoding='utf-8') as f:
-                        f.write(self._compress())
+                        f.write(output)
+
+                    if app_config.FINGERPRINT_ASSETS:
+                        update_asset_manifest(path, rendered_path)
+
+                    # See "fab render"
+                    g.compiled_includes[path] = rendered_path
 
-                # See "fab render"
-                g.compiled_includes[path] = timestamp_path
+            for src_path in self._source_paths():
+                record_dependency(src_path)
 
-            markup = Markup(self.tag_string % self._relativize_path(timestamp_path))
+            record_dependency('www/%s' % rendered_path.split('?')[0], output=True)
+
+            markup = Markup(self.tag_string % self._relativize_path(rendered_path))
         else:
             response = ','.join(self.includes)
 
@@ -105,22 +163,23 @@ class JavascriptIncluder(Includer):
 
         self.tag_string = '<script type="text/javascript" src="%s"></script>'
 
+    def _source_paths(self):
+        return ['www/%s' % src for src in self.includes]
+
     def _compress(self):
-        output = []
         src_paths = []
 
         for src in self.includes:
             src_paths.append('www/%s' % src)
             print('- compressing %s' % src)
 
-            # Switched from the Python jsmin module to Babel. It doesn't *truly* minify, but it allows me
-            # to compile ES2015 javascript down to ES5 that IE and other older browsers will accept.
-            try:
-                compressed_src = subprocess.check_output(['node_modules/.bin/babel', 'www/'+src, '--minified'], encoding='UTF-8')
-                output.append(compressed_src)
-            except:
-                print('It looks like "babel" isn\'t installed. Try running: "npm install"')
-                raise
+        # Switched from the Python jsmin module to Babel. It doesn't *truly* minify, but it allows me
+        # to compile ES2015 javascript down to ES5 that IE and other older browsers will accept.
+        try:
+            output = compiler.compile_js(src_paths)
+        except:
+            print('It looks like "babel" isn\'t installed. Try running: "npm install"')
+            raise
 
         context = make_context()
         context['paths'] = src_paths
@@ -139,21 +198,24 @@ class CSSIncluder(Includer):
 
         self.tag_string = '<link rel="stylesheet" type="text/css" href="%s" />'
 
-    def _compress(self):
-        output = []
-
-        src_paths = []
+    def _source_paths(self):
+        paths = []
 
         for src in self.includes:
+            for path in compiler.less_source_paths(src):
+                if path not in paths:
+                    paths.append(path)
+
+        return paths
 
-            src_paths.append('%s' % src)
+    def _compress(self):
+        src_paths = list(self.includes)
 
-            try:
-                compressed_src = subprocess.check_output(['node_modules/less/bin/lessc', '-x', src], encoding='UTF-8')
-                output.append(compressed_src)
-            except:
-                print('It looks like "lessc" isn\'t installed. Try running: "npm install"')
-                raise
+        try:
+            output = compiler.compile_less(src_paths, compress=True)
+        except:
+            print('It looks like "lessc" isn\'t installed. Try running: "npm install"')
+            raise
 
         context = make_context()
         context['paths'] = src_paths
@@ -164,6 +226,54 @@ class CSSIncluder(Includer):
 
         return '\n'.join(output)
 
+def content_hash(data):
+    """
+    Short hash of some bytes, for use in fingerprinted filenames.
+    """
+    return hashlib.md5(data).hexdigest()[:FINGERPRINT_LENGTH]
+
+def fingerprint_path(path, data):
+    """
+    Insert a content hash into a filename, e.g. `js/app.min.js`
+    becomes `js/app.<hash>.min.js`.
+    """
+    dirname, filename = os.path.split(path)
+    name, dot, extensions = filename.partition('.')
+
+    return os.path.join(dirname, '%s.%s%s%s' % (name, content_hash(data), dot, extensions))
+
+def is_fingerprinted(path):
+    """
+    Check whether a filename has a content hash in it, so its contents never change.
+    """
+    return _FINGERPRINTED.match(os.path.basename(path)) is not None
+
+def update_asset_manifest(path, rendered_path):
+    """
+    Map a logical bundle path to its fingerprinted filename in the asset manifest.
+    """
+    try:
+        with open(app_config.ASSET_MANIFEST_PATH) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    manifest[path] = rendered_path
+
+    with open(app_config.ASSET_MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+def _www_path(url):
+    """
+    Resolve a (possibly relative) asset URL to a file under www/.
+    """
+    path = url.split('?')[0].split('#')[0]
+
+    while path.startswith('../'):
+        path = path[3:]
+
+    return 'www/%s' % path.lstrip('/')
+
 def flatten_app_config():
     """
     Returns a copy of app_config containing only
@@ -178,6 +288,70 @@ def flatten_app_config():
 
     return config
 
+def get_copy(path=None):
+    """
+    Get the parsed copytext for `path` (default: COPY_PATH).
+
+    Parsing the spreadsheet is slow, so copy is loaded from its snapshot
+    when possible (see copy_snapshot.py), kept in memory and reused until
+    the file's modification time or size changes.
+    """
+    if path is None:
+        path = app_config.COPY_PATH
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        try:
+            stat = os.stat(copy_snapshot.snapshot_path(path))
+        except OSError:
+            # Let copytext raise its usual CopyException
+            return copytext.Copy(path)
+
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _copy_lock:
+        cached = _copy_cache.get(path)
+
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    copy = copy_snapshot.load_copy(path)
+
+    if app_config.SMARTYPANTS_COPY:
+        typeset_copy(copy)
+
+    with _copy_lock:
+        _copy_cache[path] = (signature, copy)
+
+    return copy
+
+def typeset_copy(copy):
+    """
+    Apply smartypants to every cell of a copytext.Copy, in place.
+    Keys are left alone so lookups keep working.
+    """
+    # /js/copy.js keeps the original text
+    copy.js = copy_snapshot.copy_js(copy)
+
+    for sheet in copy._copy.values():
+        skip = sheet._columns.index('key') if 'key' in sheet._columns else None
+
+        for row in sheet:
+            row._row = [value if i == skip or not isinstance(value, str) else _smartypants(value) for i, value in enumerate(row._row)]
+
+    return copy
+
+def invalidate_copy(path=None):
+    """
+    Drop cached copytext, e.g. after downloading a new spreadsheet.
+    """
+    with _copy_lock:
+        if path is None:
+            _copy_cache.clear()
+        else:
+            _copy_cache.pop(path, None)
+
 def make_context(asset_depth=0):
     """
     Create a base-context for rendering views.
@@ -189,8 +363,10 @@ def make_context(asset_depth=0):
     """
     context = flatten_app_config()
 
+    record_dependency(app_config.COPY_PATH)
+
     try:
-        context['COPY'] = copytext.Copy(app_config.COPY_PATH)
+        context['COPY'] = get_copy()
     except copytext.CopyException:
         pass
 
@@ -199,6 +375,36 @@ def make_context(asset_depth=0):
 
     return context
 
+def record_dependency(path, output=False):
+    """
+    Note that the view currently being rendered read `path`
+    (or wrote it, if `output` is True).
+
+    Only has an effect inside "fab render", which uses these
+    to skip views whose inputs have not changed.
+    """
+    if not has_app_context():
+        return
+
+    dependencies = getattr(g, 'render_dependencies', None)
+
+    if dependencies is None:
+        return
+
+    if output:
+        dependencies['outputs'].add(path)
+    else:
+        dependencies['inputs'].add(path)
+
+def load_json(path):
+    """
+    Load a JSON data file for use in a view.
+    """
+    record_dependency(path)
+
+    with open(path) as f:
+        return json.load(f)
+
 # --------------
 # CUSTOM FILTERS
 # --------------
@@ -207,15 +413,14 @@ def urlencode_filter(s):
     """
     Filter to urlencode strings.
     """
-    if type(s) == 'Markup':
+    if isinstance(s, Markup):
         s = s.unescape()
 
     # Evaulate COPY elements
     if type(s) is not str:
         s = str(s)
 
-    s = s.encode('utf8')
-    s = urllib.quote_plus(s)
+    s = urllib.parse.quote_plus(s)
 
     return Markup(s)
 
@@ -223,15 +428,14 @@ def smarty_filter(s):
     """
     Filter to smartypants strings.
     """
-    if type(s) == 'Markup':
+    if isinstance(s, Markup):
         s = s.unescape()
 
     # Evaulate COPY elements
     if type(s) is not str:
         s = str(s)
 
-    s = s.encode('utf-8')
-    s = smartypants(s)
+    s = _smartypants(s)
 
     try:
         return Markup(s)
@@ -239,59 +443,97 @@ def smarty_filter(s):
         print('This string failed to encode: %s' % s)
         return Markup(s)
 
+def smarty_cache_info():
+    """
+    Hits, misses and size of the smartypants cache.
+    """
+    return _smartypants.cache_info()
+
 def split_semicolon_filter(s):
     """
     Filter to take semicolon-delimited text and convert it to a list
     """
     if s is not None:
-        return s.strip().split(';')
+        return _as_text(s).strip().split(';')
     return None
 
+def _as_text(s):
+    # Evaulate COPY elements
+    if type(s) is not str:
+        s = str(s)
+
+    return s
+
+@lru_cache(maxsize=HELPER_CACHE_SIZE)
+def _slugify(s):
+    return s.strip().lower().translate(_SLUG_TABLE).replace('--', '-')
+
+@lru_cache(maxsize=HELPER_CACHE_SIZE)
+def normalize(s):
+    """
+    Strip non-ASCII characters (e.g. the ¢ in "Jefferson County Library District 8¢ for the Library").
+    """
+    return s.encode('ascii', 'ignore').decode('ascii')
+
 def convert_to_slug(s):
     """
     Very simple filter to slugify a string
     """
     if s is not None:
-        return s.strip().lower().replace('.','').replace(' ','-').replace(',','-').replace('--','-')
+        return _slugify(_as_text(s))
     return None
 
+def slugify_all(values):
+    """
+    Slugify a whole list of strings in one call.
+    """
+    return [convert_to_slug(s) for s in values]
+
 def convert_to_int(s):
     """
     Filter to convert a string to an int    
     """
     if s is not None:
-        return int( s.strip() )
+        return int( _as_text(s).strip() )
     return None
 
+def sort_by(rows, column=None, reverse=False):
+    """
+    Naturally sort rows by one column (or the rows themselves, if no column).
+    Strings with numbers sort the way people expect: "Item 2" before "Item 10".
+    """
+    if column is None:
+        return sorted(rows, key=_natsort_key, reverse=reverse)
+
+    return sorted(rows, key=lambda row: _natsort_key(row[column]), reverse=reverse)
+
 def nat_sort(l,k=None,r=False):
     """
     Filter to apply natsort to a list 
     (This is a better way to sort for sorting strings with numbers)
     """
-    from natsort import natsorted
     if l is not None:
-        sl = []
-        # Create a list of tuples for sorting
-        for item in l:
-            key = item[k]
-            sl.append( (key, item) )
-        # Use natsort to naturally sort the tuples by the key field
-        sl = natsorted( sl, reverse=r )
-        # Convert list of tuples back into normal list (basically throw out the key)
-        sl = [ item[-1] for item in sl ]
-        return sl
+        return sort_by(l, k, r)
     return None
 
 def cache_bust_filter(s):
     """
-    Filter to append a cache-busting timestamp to a URL
+    Filter to append a cache-busting timestamp to a URL.
+
+    When FINGERPRINT_ASSETS is on, local files get a hash of their content instead.
     """
-    if type(s) == 'Markup':
+    if isinstance(s, Markup):
         s = s.unescape()
 
-    # Evaulate COPY elements
-    if type(s) is not str:
-        s = str(s)
+    s = _as_text(s)
+
+    # Bust on content rather than time, so unchanged files stay cached
+    if app_config.FINGERPRINT_ASSETS:
+        try:
+            with open(_www_path(s), 'rb') as f:
+                return Markup( s + str('?') + content_hash(f.read()) )
+        except IOError:
+            pass
 
     timestamp = int(time.time())
     return Markup( s + str('?') + str(timestamp) )
@@ -303,10 +545,53 @@ def cache_bust_filter(s):
 
 def contains(value,check):
     if value is not None and check is not None:
-        # First, encode them all as ASCII to remove problematic unicode characters (e.g. Jefferson County Library District 8¢ for the Library)
-        # In Python3, this will convert them to bytes. So next, decode the bytes back to unicode text.
-        check = check.encode('ascii','ignore').decode('UTF-8')
-        value = value.encode('ascii','ignore').decode('UTF-8')
-        if str(check) in str(value):
+        # Compare ASCII-only copies, to ignore problematic unicode characters
+        if normalize(_as_text(check)) in normalize(_as_text(value)):
             return True
     return False
+
+TEMPLATE_FILTERS = {
+    'cache_bust': cache_bust_filter,
+    'contains': contains,
+    'nat_sort': nat_sort,
+    'slug': convert_to_slug,
+    'slugify_all': slugify_all,
+    'smarty': smarty_filter,
+    'sort_by': sort_by,
+    'split_semicolon': split_semicolon_filter,
+    'to_int': convert_to_int,
+    'urlencode': urlencode_filter
+}
+
+TEMPLATE_TESTS = {
+    'contains': contains
+}
+
+def configure_jinja(app):
+    """
+    Set up a Flask app's Jinja environment: register every filter and
+    test, cache compiled templates on disk and, outside of debug mode,
+    stop checking templates for changes. Safe to call again after
+    app_config.configure_targets().
+    """
+    app.config['TEMPLATES_AUTO_RELOAD'] = app_config.DEBUG
+
+    env = app.jinja_env
+
+    env.filters.update(TEMPLATE_FILTERS)
+    env.tests.update(TEMPLATE_TESTS)
+    env.auto_reload = app.templates_auto_reload
+
+    if not isinstance(env.bytecode_cache, FileSystemBytecodeCache):
+        os.makedirs(JINJA_CACHE_PATH, exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_PATH)
+
+    return env
+
+def preload_templates(env):
+    """
+    Load every template into the environment's in-memory cache, so
+    processes forked afterwards don't each compile them again.
+    """
+    for name in env.list_templates(filter_func=lambda name: not name.startswith('.')):
+        env.get_template(name)
@@ -1,25 +1,184 @@
 #!/usr/bin/env python
 
+from functools import lru_cache
+from glob import glob
+import gzip
+import hashlib
 import json
 from mimetypes import guess_type
 import os
-import subprocess
+import threading
+import time
 
-from flask import abort, make_response
+from flask import abort, make_response, request, send_file
+from werkzeug.security import safe_join
+
+# Brotli is optional. Without it, payloads are only precompressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import app_config
-import copytext
+import compiler
+import copy_snapshot
 from flask import Blueprint
-from render_utils import BetterJSONEncoder, flatten_app_config
+from render_utils import BetterJSONEncoder, flatten_app_config, get_copy, is_fingerprinted
 
 static = Blueprint('static', __name__)
 
+class CachedPayload(object):
+    """
+    A generated response body that is only rebuilt when its source changes.
+
+    `source` returns whatever the body is generated from, and `build`
+    turns that into text. The body is kept in memory along with an ETag
+    and gzip/brotli variants, so most requests are answered without
+    regenerating or recompressing anything.
+    """
+    def __init__(self, content_type, source, build):
+        self.content_type = content_type
+        self.source = source
+        self.build = build
+
+        self._source = None
+        self._built = False
+        self._lock = threading.Lock()
+
+    def _rebuild(self, source):
+        body = self.build(source).encode('utf-8')
+
+        variants = {
+            'identity': body,
+            'gzip': gzip.compress(body, 9)
+        }
+
+        if brotli:
+            variants['br'] = brotli.compress(body)
+
+        self._source = source
+        self._variants = variants
+        self._etag = hashlib.md5(body).hexdigest()
+        self._last_modified = time.time()
+        self._built = True
+
+    def refresh(self):
+        """
+        Rebuild the body now if its source has changed, e.g. from a
+        background thread so requests don't have to wait for it.
+        """
+        source = self.source()
+
+        with self._lock:
+            if not self._built or source != self._source:
+                self._rebuild(source)
+
+    def response(self):
+        """
+        Build a response for the current request, honoring
+        Accept-Encoding, If-None-Match and If-Modified-Since.
+        """
+        self.refresh()
+
+        with self._lock:
+            variants = self._variants
+            etag = self._etag
+            last_modified = self._last_modified
+
+        encoding = 'identity'
+
+        for candidate in ('br', 'gzip'):
+            if candidate in variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+
+        response = make_response(variants[encoding], 200, { 'Content-Type': self.content_type })
+        response.vary.add('Accept-Encoding')
+
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+
+        # Each encoding is a different representation, so it needs its own ETag
+        response.set_etag('%s-%s' % (etag, encoding))
+        response.last_modified = last_modified
+
+        return response.make_conditional(request)
+
+def _build_app_config_js(deployment_target):
+    config = flatten_app_config()
+
+    return 'window.APP_CONFIG = ' + json.dumps(config, cls=BetterJSONEncoder)
+
+# app_config only changes at runtime through configure_targets()
+_app_config_js_payload = CachedPayload(
+    'application/javascript',
+    lambda: app_config.DEPLOYMENT_TARGET,
+    _build_app_config_js
+)
+
+# get_copy() returns the same object until the spreadsheet changes
+_copy_js_payload = CachedPayload(
+    'application/javascript',
+    get_copy,
+    copy_snapshot.copy_js
+)
+
+# Only recompiled when a template in jst/ changes
+_templates_js_payload = CachedPayload(
+    'application/javascript',
+    compiler.jst_signature,
+    lambda signature: compiler.compile_jst()
+)
+
 # Render JST templates on-demand
 @static.route('/js/templates.js')
 def _templates_js():
-    r = subprocess.check_output(["node_modules/universal-jst/bin/jst.js", "--template", "underscore", "jst"])
+    return _templates_js_payload.response()
+
+# Compiled LESS entry files, keyed by (path, compress)
+_less_payloads = {}
+
+def _less_payload(src, compress=False):
+    key = (src, compress)
+
+    if key not in _less_payloads:
+        _less_payloads.setdefault(key, CachedPayload(
+            'text/css',
+            lambda: compiler.less_signature(src),
+            lambda signature: compiler.compile_less([src], compress=compress)[0]
+        ))
+
+    return _less_payloads[key]
+
+def less_response(src, compress=False):
+    """
+    Serve a compiled LESS file. It is only recompiled when a file in its
+    import graph changes, so most requests don't reach Node at all.
+    """
+    return _less_payload(src, compress).response()
+
+def refresh_less():
+    """
+    Recompile any LESS entry file whose import graph has changed,
+    including ones that haven't been requested yet.
+    """
+    for src in sorted(glob('less/*.less')):
+        _less_payload(src)
+
+    for payload in list(_less_payloads.values()):
+        payload.refresh()
 
-    return make_response(r, 200, { 'Content-Type': 'application/javascript' })
+def refresh_templates_js():
+    """
+    Rebuild /js/templates.js if a template in jst/ has changed.
+    """
+    _templates_js_payload.refresh()
+
+def refresh_copy_js():
+    """
+    Rebuild /js/copy.js if the spreadsheet has changed.
+    """
+    _copy_js_payload.refresh()
 
 # Render LESS files on-demand
 @static.route('/less/<string:filename>')
@@ -27,30 +186,48 @@ def _less(filename):
     if not os.path.exists('less/%s' % filename):
         abort(404)
 
-    r = subprocess.check_output(["node_modules/less/bin/lessc", "less/%s" % filename])
-
-    return make_response(r, 200, { 'Content-Type': 'text/css' })
+    return less_response('less/%s' % filename)
 
 # Render application configuration
 @static.route('/js/app_config.js')
 def _app_config_js():
-    config = flatten_app_config()
-    js = 'window.APP_CONFIG = ' + json.dumps(config, cls=BetterJSONEncoder)
-
-    return make_response(js, 200, { 'Content-Type': 'application/javascript' })
+    return _app_config_js_payload.response()
 
 # Render copytext
 @static.route('/js/copy.js')
 def _copy_js():
-    copy = 'window.COPY = ' + copytext.Copy(app_config.COPY_PATH).json()
+    return _copy_js_payload.response()
+
+# Served by _static()
+STATIC_ROOT = 'www'
 
-    return make_response(copy, 200, { 'Content-Type': 'application/javascript' })
+@lru_cache(maxsize=4096)
+def _resolve_static(path):
+    """
+    Map a request path to a file under www/ and its MIME type.
+    Paths that would escape www/ resolve to None.
+    """
+    filename = safe_join(STATIC_ROOT, path)
+
+    if filename is None:
+        return None, None
+
+    return os.path.abspath(filename), guess_type(path)[0]
 
 # Server arbitrary static files on-demand
 @static.route('/<path:path>')
 def _static(path):
-    try:
-        with open('www/%s' % path, 'rb') as f:
-            return make_response(f.read(), 200, { 'Content-Type': guess_type(path)[0] })
-    except IOError:
+    filename, mimetype = _resolve_static(path)
+
+    if filename is None or not os.path.isfile(filename):
         abort(404)
+
+    # Only content-hashed bundles are safe to cache long after a deploy
+    if is_fingerprinted(filename):
+        max_age = app_config.FINGERPRINTED_MAX_AGE
+    else:
+        max_age = app_config.ASSETS_MAX_AGE
+
+    # Streams the file (with sendfile, where the server supports it) and
+    # handles ETags, Last-Modified and Range requests
+    return send_file(filename, mimetype=mimetype, conditional=True, cache_timeout=max_age)
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
+import gzip
 import json
+import os
+import shutil
+import tempfile
 import unittest
 
+from werkzeug.exceptions import NotFound
+
 import app
 import app_config
+import compiler
+import static
 
 class IndexTestCase(unittest.TestCase):
     """
@@ -51,5 +59,150 @@ class AppConfigTestCase(unittest.TestCase):
         
         app_config.configure_targets('staging')
 
+    def test_app_config_etag(self):
+        response = self.client.get('/js/app_config.js')
+        etag = response.headers['ETag']
+
+        response = self.client.get('/js/app_config.js', headers={ 'If-None-Match': etag })
+
+        assert response.status_code == 304
+
+    def test_app_config_gzip(self):
+        response = self.client.get('/js/app_config.js')
+        gzipped = self.client.get('/js/app_config.js', headers={ 'Accept-Encoding': 'gzip' })
+
+        assert gzipped.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(gzipped.data) == response.data
+        assert gzipped.headers['ETag'] != response.headers['ETag']
+
+class StaticTestCase(unittest.TestCase):
+    """
+    Test serving files from www/.
+    """
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.client = app.app.test_client()
+
+        with open('www/js/app.js', 'rb') as f:
+            self.content = f.read()
+
+    def test_static_file(self):
+        response = self.client.get('/js/app.js')
+
+        assert response.status_code == 200
+        assert response.data == self.content
+        assert 'javascript' in response.headers['Content-Type']
+        assert response.cache_control.max_age == app_config.ASSETS_MAX_AGE
+
+    def test_static_range(self):
+        response = self.client.get('/js/app.js', headers={ 'Range': 'bytes=0-9' })
+
+        assert response.status_code == 206
+        assert response.data == self.content[:10]
+
+    def test_static_etag(self):
+        response = self.client.get('/js/app.js')
+
+        response = self.client.get('/js/app.js', headers={ 'If-None-Match': response.headers['ETag'] })
+
+        assert response.status_code == 304
+
+    def test_static_missing(self):
+        with app.app.test_request_context('/js/does-not-exist.js'):
+            with self.assertRaises(NotFound):
+                static._static('js/does-not-exist.js')
+
+    def test_static_traversal(self):
+        assert static._resolve_static('../app_config.py') == (None, None)
+
+        with app.app.test_request_context('/'):
+            with self.assertRaises(NotFound):
+                static._static('../app_config.py')
+
+class StaticMaxAgeTestCase(unittest.TestCase):
+    """
+    Test only fingerprinted files are cached for long.
+    """
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.client = app.app.test_client()
+
+        self.static_root = static.STATIC_ROOT
+        static.STATIC_ROOT = tempfile.mkdtemp()
+        static._resolve_static.cache_clear()
+
+        for name in ['app.0123456789.min.js', 'app.js']:
+            with open(os.path.join(static.STATIC_ROOT, name), 'w') as f:
+                f.write('var a = 1;')
+
+        app_config.configure_targets('production')
+
+    def tearDown(self):
+        app_config.configure_targets('staging')
+
+        shutil.rmtree(static.STATIC_ROOT)
+        static.STATIC_ROOT = self.static_root
+        static._resolve_static.cache_clear()
+
+    def test_fingerprinted(self):
+        response = self.client.get('/app.0123456789.min.js')
+
+        assert response.cache_control.max_age == app_config.FINGERPRINTED_MAX_AGE
+
+    def test_not_fingerprinted(self):
+        # Files that keep their names across deploys must not be cached for long
+        response = self.client.get('/app.js')
+
+        assert response.cache_control.max_age == app_config.ASSETS_MAX_AGE < app_config.FINGERPRINTED_MAX_AGE
+
+class TemplatesJSTestCase(unittest.TestCase):
+    """
+    Test serving compiled JST templates from memory.
+    """
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.client = app.app.test_client()
+
+        self.compile_jst = compiler.compile_jst
+        self.compiles = 0
+
+        def compile_jst():
+            self.compiles += 1
+
+            return 'window.JST = {};'
+
+        compiler.compile_jst = compile_jst
+        static._templates_js_payload._built = False
+
+    def tearDown(self):
+        compiler.compile_jst = self.compile_jst
+        static._templates_js_payload._built = False
+
+    def test_templates_js(self):
+        response = self.client.get('/js/templates.js')
+
+        assert response.data == b'window.JST = {};'
+        assert 'javascript' in response.headers['Content-Type']
+
+    def test_compiles_once(self):
+        response = self.client.get('/js/templates.js')
+        response = self.client.get('/js/templates.js', headers={ 'If-None-Match': response.headers['ETag'] })
+
+        assert response.status_code == 304
+        assert self.compiles == 1
+
+class LessTestCase(unittest.TestCase):
+    """
+    Test requests for LESS files that don't exist.
+    """
+    def test_missing(self):
+        payloads = dict(static._less_payloads)
+
+        with app.app.test_request_context('/css/missing.less.css'):
+            with self.assertRaises(NotFound):
+                app.less('missing.less.css')
+
+        assert static._less_payloads == payloads
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import boto
+from boto.s3.bucket import Bucket
+from moto import mock_s3_deprecated
+
+import app_config
+from fabfile import assets
+
+class SyncTestCase(unittest.TestCase):
+    """
+    Test syncing assets with a local S3 stand-in.
+    """
+    def setUp(self):
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+
+        self.assets_bucket = app_config.ASSETS_S3_BUCKET
+        self.assets_slug = app_config.ASSETS_SLUG
+        self.assets_root = assets.ASSETS_ROOT
+        self.cache_path = assets.ASSETS_CACHE_PATH
+        self.prompt = assets.prompt
+
+        app_config.ASSETS_S3_BUCKET = { 'bucket_name': 'test-assets' }
+        app_config.ASSETS_SLUG = 'project'
+
+        self.bucket = boto.connect_s3().create_bucket('test-assets')
+        assets._local.__dict__.clear()
+
+        self.root = tempfile.mkdtemp()
+        assets.ASSETS_ROOT = self.root
+        assets.ASSETS_CACHE_PATH = os.path.join(self.root, '.assets-cache.sqlite')
+
+        self.write('assetsignore', b'.assets-cache.sqlite\nassetsignore\n')
+
+        self.answers = []
+        assets.prompt = lambda *args, **kwargs: self.answers.pop(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        assets._local.__dict__.clear()
+
+        app_config.ASSETS_S3_BUCKET = self.assets_bucket
+        app_config.ASSETS_SLUG = self.assets_slug
+        assets.ASSETS_ROOT = self.assets_root
+        assets.ASSETS_CACHE_PATH = self.cache_path
+        assets.prompt = self.prompt
+
+        self.mock.stop()
+
+    def write(self, name, contents):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            return f.read()
+
+    def upload(self, name, contents):
+        key = self.bucket.new_key('project/%s' % name)
+        key.set_metadata('md5', key.compute_md5(io.BytesIO(contents))[0])
+        key.set_contents_from_string(contents)
+
+    def remote(self):
+        return dict((key.name, key.get_contents_as_string()) for key in self.bucket.list())
+
+    def test_sync(self):
+        self.upload('remote.jpg', b'remote')
+        self.upload('same.jpg', b'same')
+        self.write('same.jpg', b'same')
+        self.write('img/local.jpg', b'local')
+
+        self.answers = ['ua']
+
+        assets.sync()
+
+        self.assertEqual(self.read('remote.jpg'), b'remote')
+        self.assertEqual(self.remote(), {
+            'project/remote.jpg': b'remote',
+            'project/same.jpg': b'same',
+            'project/img/local.jpg': b'local'
+        })
+
+        # Nothing left to ask about
+        assets.sync()
+
+    def test_sync_conflicts(self):
+        self.upload('a.jpg', b'remote a')
+        self.upload('b.jpg', b'remote b')
+        self.write('a.jpg', b'local a')
+        self.write('b.jpg', b'local b')
+
+        self.answers = ['r', 'l']
+
+        assets.sync()
+
+        self.assertEqual(self.read('a.jpg'), b'remote a')
+        self.assertEqual(self.remote()['project/b.jpg'], b'local b')
+
+    def test_sync_cancel(self):
+        self.upload('a.jpg', b'remote a')
+        self.upload('new.jpg', b'new')
+        self.write('a.jpg', b'local a')
+        self.write('local.jpg', b'local')
+
+        # Take the remote copy, then cancel on the next question
+        self.answers = ['r', 'c']
+
+        assets.sync()
+
+        # Nothing is transferred until every question is answered
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'new.jpg')))
+        self.assertEqual(self.read('a.jpg'), b'local a')
+        self.assertNotIn('project/local.jpg', self.remote())
+
+    def test_sync_failures_raise(self):
+        self.upload('remote.jpg', b'remote')
+        self.upload('other.jpg', b'other')
+
+        download_path = assets._assets_download_path
+
+        def failing_download_path(local_path, size=None):
+            if local_path.endswith('remote.jpg'):
+                raise IOError('Connection reset')
+
+            return download_path(local_path, size)
+
+        assets._assets_download_path = failing_download_path
+
+        try:
+            with self.assertRaises(Exception):
+                assets.sync()
+        finally:
+            assets._assets_download_path = download_path
+
+        # The other transfers still happen
+        self.assertEqual(self.read('other.jpg'), b'other')
+
+    def test_download_uses_listed_size(self):
+        self.upload('remote.jpg', b'remote')
+
+        fetched = []
+        get_key = Bucket.get_key
+
+        def tracking_get_key(bucket, key_name, *args, **kwargs):
+            if kwargs.get('validate', True):
+                fetched.append(key_name)
+
+            return get_key(bucket, key_name, *args, **kwargs)
+
+        Bucket.get_key = tracking_get_key
+
+        try:
+            assets.sync()
+        finally:
+            Bucket.get_key = get_key
+
+        # No HEAD request just to find the size
+        self.assertEqual(fetched, [])
+        self.assertEqual(self.read('remote.jpg'), b'remote')
+
+    def test_remote_deleted_while_syncing(self):
+        self.upload('a.jpg', b'remote a')
+        self.write('a.jpg', b'local a')
+
+        remote_md5 = assets._assets_remote_md5
+
+        def deleting_remote_md5(key_name):
+            # Someone deletes the key between listing and fetching it
+            self.bucket.delete_key(key_name)
+
+            return remote_md5(key_name)
+
+        assets._assets_remote_md5 = deleting_remote_md5
+        self.answers = ['u']
+
+        try:
+            assets.sync()
+        finally:
+            assets._assets_remote_md5 = remote_md5
+
+        # Treated as a file that doesn't exist on S3
+        self.assertEqual(self.remote()['project/a.jpg'], b'local a')
+
+    def test_local_md5_cached(self):
+        self.write('a.jpg', b'apple')
+
+        digests = assets.DigestCache(assets.ASSETS_CACHE_PATH)
+        path = os.path.join(self.root, 'a.jpg')
+
+        try:
+            md5 = assets._assets_local_md5(path, digests)
+
+            digests.set(path, 'md5', os.stat(path), 'cached')
+
+            self.assertEqual(md5, '1f3870be274f6c49b3e31a0c6728957f')
+            self.assertEqual(assets._assets_local_md5(path, digests), 'cached')
+        finally:
+            digests.close()
+
+class MultipartTestCase(unittest.TestCase):
+    """
+    Test multipart, resumable transfers of large assets.
+    """
+    def setUp(self):
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+
+        self.assets_bucket = app_config.ASSETS_S3_BUCKET
+        self.settings = (assets.ASSETS_MULTIPART_THRESHOLD, assets.ASSETS_PART_SIZE, assets.ASSETS_PART_WORKERS, assets.ASSETS_JOURNAL_PATH)
+
+        app_config.ASSETS_S3_BUCKET = { 'bucket_name': 'test-assets' }
+
+        self.bucket = boto.connect_s3().create_bucket('test-assets')
+        assets._local.__dict__.clear()
+
+        self.root = tempfile.mkdtemp()
+
+        # The smallest part size S3 allows
+        assets.ASSETS_MULTIPART_THRESHOLD = 5 * 1024 * 1024
+        assets.ASSETS_PART_SIZE = 5 * 1024 * 1024
+        assets.ASSETS_JOURNAL_PATH = os.path.join(self.root, 'journal')
+
+        # moto's fake sockets mix up large request bodies sent from several threads
+        assets.ASSETS_PART_WORKERS = 1
+
+        self.path = os.path.join(self.root, 'video.mp4')
+        self.contents = os.urandom(assets.ASSETS_PART_SIZE * 2 + 1024)
+
+        with open(self.path, 'wb') as f:
+            f.write(self.contents)
+
+        self.key = self.bucket.get_key('project/video.mp4', validate=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        assets._local.__dict__.clear()
+
+        app_config.ASSETS_S3_BUCKET = self.assets_bucket
+        assets.ASSETS_MULTIPART_THRESHOLD, assets.ASSETS_PART_SIZE, assets.ASSETS_PART_WORKERS, assets.ASSETS_JOURNAL_PATH = self.settings
+
+        self.mock.stop()
+
+    def interrupt(self, name, part_number):
+        """
+        Make one part of the next transfer fail, recording which parts were sent.
+        """
+        original = getattr(assets, name)
+        sent = []
+        failed = []
+
+        def transfer(*args):
+            offset = args[-2]
+
+            if offset == (part_number - 1) * assets.ASSETS_PART_SIZE and not failed:
+                failed.append(offset)
+                raise IOError('Connection reset')
+
+            sent.append(offset // assets.ASSETS_PART_SIZE + 1)
+
+            return original(*args)
+
+        setattr(assets, name, transfer)
+        self.addCleanup(setattr, assets, name, original)
+
+        return sent
+
+    def test_upload(self):
+        assets._assets_upload(self.path, self.key)
+
+        key = self.bucket.get_key('project/video.mp4')
+
+        self.assertEqual(key.get_contents_as_string(), self.contents)
+        self.assertEqual(key.get_metadata('md5'), hashlib.md5(self.contents).hexdigest())
+        self.assertEqual(os.listdir(assets.ASSETS_JOURNAL_PATH), [])
+
+    def test_upload_resume(self):
+        sent = self.interrupt('_assets_upload_part', 2)
+
+        with self.assertRaises(IOError):
+            assets._assets_upload(self.path, self.key)
+
+        del sent[:]
+
+        assets._assets_upload(self.path, self.key)
+
+        # Parts that made it the first time aren't sent again
+        self.assertNotIn(1, sent)
+        self.assertEqual(self.bucket.get_key('project/video.mp4').get_contents_as_string(), self.contents)
+
+    def test_download(self):
+        assets._assets_upload(self.path, self.key)
+        os.remove(self.path)
+
+        assets._assets_download(self.key, self.path)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+
+    def test_download_resume(self):
+        assets._assets_upload(self.path, self.key)
+        os.remove(self.path)
+
+        sent = self.interrupt('_assets_download_part', 2)
+
+        with self.assertRaises(IOError):
+            assets._assets_download(self.key, self.path)
+
+        self.assertFalse(os.path.exists(self.path))
+
+        del sent[:]
+
+        assets._assets_download(self.key, self.path)
+
+        self.assertNotIn(1, sent)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+
+    def test_download_resume_corrupt_part(self):
+        assets._assets_upload(self.path, self.key)
+        os.remove(self.path)
+
+        self.interrupt('_assets_download_part', 3)
+
+        with self.assertRaises(IOError):
+            assets._assets_download(self.key, self.path)
+
+        # Damage the first part while we were away
+        data_path = [name for name in os.listdir(assets.ASSETS_JOURNAL_PATH) if name.endswith('.data')][0]
+
+        with open(os.path.join(assets.ASSETS_JOURNAL_PATH, data_path), 'r+b') as f:
+            f.write(b'garbage')
+
+        assets._assets_download(self.key, self.path)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+
+if __name__ == '__main__':
+    unittest.main()
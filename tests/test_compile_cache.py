@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import compile_cache
+
+class CompileCacheTestCase(unittest.TestCase):
+    """
+    Test the on-disk compiled asset cache.
+    """
+    def setUp(self):
+        self.cache_path = compile_cache.CACHE_PATH
+        compile_cache.CACHE_PATH = tempfile.mkdtemp()
+
+        fd, self.source_path = tempfile.mkstemp(suffix='.js')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write('var a = 1;')
+
+    def tearDown(self):
+        shutil.rmtree(compile_cache.CACHE_PATH)
+        compile_cache.CACHE_PATH = self.cache_path
+
+        os.remove(self.source_path)
+
+    def compile(self):
+        self.compiles += 1
+
+        return 'compiled %i' % self.compiles
+
+    def test_hit_skips_compile(self):
+        self.compiles = 0
+
+        first = compile_cache.cached('less', ['-x'], [self.source_path], self.compile)
+        second = compile_cache.cached('less', ['-x'], [self.source_path], self.compile)
+
+        assert first == second == 'compiled 1'
+        assert self.compiles == 1
+
+    def test_source_change_misses(self):
+        self.compiles = 0
+
+        compile_cache.cached('less', ['-x'], [self.source_path], self.compile)
+
+        with open(self.source_path, 'w') as f:
+            f.write('var a = 2;')
+
+        output = compile_cache.cached('less', ['-x'], [self.source_path], self.compile)
+
+        assert output == 'compiled 2'
+
+    def test_options_change_misses(self):
+        self.compiles = 0
+
+        compile_cache.cached('less', ['-x'], [self.source_path], self.compile)
+        compile_cache.cached('less', [], [self.source_path], self.compile)
+
+        assert self.compiles == 2
+
+    def test_evict_least_recently_used(self):
+        compile_cache.put('old', 'x' * 100)
+        compile_cache.put('new', 'y' * 100)
+
+        os.utime(os.path.join(compile_cache.CACHE_PATH, 'old'), (0, 0))
+
+        compile_cache.evict(150)
+
+        assert compile_cache.get('old') is None
+        assert compile_cache.get('new') == 'y' * 100
+
+    def test_evicted_while_reading_misses(self):
+        compile_cache.put('entry', 'x')
+
+        utime = os.utime
+
+        def evict_then_utime(path, times):
+            # Another process evicts the entry between our read and utime()
+            os.remove(path)
+            utime(path, times)
+
+        os.utime = evict_then_utime
+
+        try:
+            assert compile_cache.get('entry') is None
+        finally:
+            os.utime = utime
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import compile_cache
+import compiler
+
+# Stands in for compile_server.js: upper-cases the filename of each job,
+# fails jobs for files named "broken..." and exits without answering
+# when asked to compile "crash"
+FAKE_SERVER = '''
+import json, sys
+
+for line in sys.stdin:
+    request = json.loads(line)
+
+    if any(job['filename'] == 'crash' for job in request['jobs']):
+        sys.exit(1)
+
+    results = [{ 'error': 'Unexpected token' } if job['filename'].startswith('broken') else { 'code': job['filename'].upper() } for job in request['jobs']]
+    print(json.dumps({ 'id': request['id'], 'results': results }), flush=True)
+'''
+
+class CompileServerTestCase(unittest.TestCase):
+    """
+    Test the compile server protocol and lifecycle.
+    """
+    def setUp(self):
+        self.server = compiler.CompileServer([sys.executable, '-c', FAKE_SERVER])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_batch(self):
+        results = self.server.compile([
+            { 'type': 'babel', 'filename': 'a.js', 'options': {} },
+            { 'type': 'babel', 'filename': 'b.js', 'options': {} },
+        ])
+
+        assert [r['code'] for r in results] == ['A.JS', 'B.JS']
+
+    def test_reuses_process(self):
+        self.server.compile([{ 'type': 'babel', 'filename': 'a.js', 'options': {} }])
+        pid = self.server.process.pid
+
+        self.server.compile([{ 'type': 'babel', 'filename': 'b.js', 'options': {} }])
+
+        assert self.server.process.pid == pid
+
+    def test_restarts_after_crash(self):
+        self.server.compile([{ 'type': 'babel', 'filename': 'a.js', 'options': {} }])
+        self.server.process.kill()
+        self.server.process.wait()
+
+        results = self.server.compile([{ 'type': 'babel', 'filename': 'b.js', 'options': {} }])
+
+        assert results[0]['code'] == 'B.JS'
+
+    def test_gives_up_on_repeated_crash(self):
+        with self.assertRaises(compiler.CompileError):
+            self.server.compile([{ 'type': 'babel', 'filename': 'crash', 'options': {} }])
+
+    def test_errors(self):
+        with self.assertRaises(compiler.CompileError):
+            self.server.compile([{ 'type': 'babel', 'filename': 'broken.js', 'options': {} }])
+
+    def test_stop(self):
+        self.server.compile([{ 'type': 'babel', 'filename': 'a.js', 'options': {} }])
+        process = self.server.process
+
+        self.server.stop()
+
+        assert process.poll() is not None
+
+class CompileCachedTestCase(unittest.TestCase):
+    """
+    Test a failed job doesn't stop the rest of its batch being cached.
+    """
+    def setUp(self):
+        self.settings = (compiler._server, compile_cache.CACHE_PATH)
+
+        compiler._server = compiler.CompileServer([sys.executable, '-c', FAKE_SERVER])
+        compile_cache.CACHE_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        compiler._server.stop()
+        shutil.rmtree(compile_cache.CACHE_PATH)
+
+        compiler._server, compile_cache.CACHE_PATH = self.settings
+
+    def test_caches_successes(self):
+        with self.assertRaises(compiler.CompileError):
+            compiler.compile_js(['a.js', 'broken.js', 'b.js'])
+
+        requests = compiler._server.request_id
+
+        assert compiler.compile_js(['a.js', 'b.js']) == ['A.JS', 'B.JS']
+        assert compiler._server.request_id == requests
+
+# Stands in for compile_server.js compiling LESS: inlines `@import "file";`
+# lines and reports every imported file, like less.render() does
+FAKE_LESS_SERVER = '''
+import json, os, sys
+
+def compile(filename, imports):
+    lines = []
+
+    for line in open(filename):
+        if line.startswith('@import'):
+            path = os.path.abspath(os.path.join(os.path.dirname(filename), line.split('"')[1]))
+            imports.append(path)
+            lines.append(compile(path, imports))
+        else:
+            lines.append(line.strip())
+
+    return ' '.join(lines)
+
+for line in sys.stdin:
+    request = json.loads(line)
+    results = []
+
+    for job in request['jobs']:
+        imports = []
+        results.append({ 'code': compile(job['filename'], imports), 'imports': imports })
+
+    print(json.dumps({ 'id': request['id'], 'results': results }), flush=True)
+'''
+
+class LessImportsTestCase(unittest.TestCase):
+    """
+    Test LESS outputs are keyed on each entry file's import graph.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+
+        self.settings = (compiler._server, compile_cache.CACHE_PATH, dict(compiler._less_imports))
+
+        compiler._server = compiler.CompileServer([sys.executable, '-c', FAKE_LESS_SERVER])
+        compile_cache.CACHE_PATH = os.path.join(self.tmp_dir, 'cache')
+        compiler._less_imports.clear()
+
+        self.write('less/app.less', '@import "base/_type.less";\n.app {}')
+        self.write('less/base/_type.less', 'body { font: serif; }')
+        self.write('less/other.less', '.other {}')
+
+    def tearDown(self):
+        compiler._server.stop()
+
+        compiler._server, compile_cache.CACHE_PATH, less_imports = self.settings
+        compiler._less_imports.clear()
+        compiler._less_imports.update(less_imports)
+
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, contents):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'w') as f:
+            f.write(contents)
+
+        # Make sure the change is visible even within one mtime tick
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def test_records_imports(self):
+        assert compiler.compile_less(['less/app.less']) == ['body { font: serif; } .app {}']
+        assert compiler.less_source_paths('less/app.less') == ['less/app.less', 'less/base/_type.less']
+
+    def test_cache_hit_after_recording_imports(self):
+        compiler.compile_less(['less/app.less'])
+        requests = compiler._server.request_id
+
+        compiler.compile_less(['less/app.less'])
+
+        assert compiler._server.request_id == requests
+
+    def test_signature(self):
+        compiler.compile_less(['less/app.less'])
+        signature = compiler.less_signature('less/app.less')
+
+        # Not imported by app.less
+        self.write('less/other.less', '.changed {}')
+        assert compiler.less_signature('less/app.less') == signature
+
+        self.write('less/base/_type.less', 'body { font: sans-serif; }')
+        assert compiler.less_signature('less/app.less') != signature
+
+        assert compiler.compile_less(['less/app.less']) == ['body { font: sans-serif; } .app {}']
+
+# Stands in for universal-jst: lists the templates and counts its runs in "runs"
+FAKE_JST = '''
+import glob
+
+with open('runs', 'a') as f:
+    f.write('.')
+
+print('window.JST = %r;' % sorted(glob.glob('jst/*.html')))
+'''
+
+class JSTTestCase(unittest.TestCase):
+    """
+    Test compiled JST templates are cached by content.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+
+        self.settings = (compiler.JST_COMMAND, compile_cache.CACHE_PATH)
+
+        compiler.JST_COMMAND = [sys.executable, '-c', FAKE_JST]
+        compile_cache.CACHE_PATH = os.path.join(self.tmp_dir, 'cache')
+
+        os.mkdir('jst')
+        self.write('jst/example.html', '<p><%= config %></p>')
+
+    def tearDown(self):
+        compiler.JST_COMMAND, compile_cache.CACHE_PATH = self.settings
+
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def runs(self):
+        with open('runs') as f:
+            return len(f.read())
+
+    def test_compile(self):
+        assert compiler.compile_jst() == "window.JST = ['jst/example.html'];\n"
+
+    def test_cached(self):
+        compiler.compile_jst()
+        compiler.compile_jst()
+
+        assert self.runs() == 1
+
+    def test_recompiles_changed_template(self):
+        compiler.compile_jst()
+        signature = compiler.jst_signature()
+
+        self.write('jst/other.html', '<p></p>')
+
+        assert compiler.jst_signature() != signature
+        assert compiler.compile_jst() == "window.JST = ['jst/example.html', 'jst/other.html'];\n"
+        assert self.runs() == 2
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabfile import compress
+
+class PrecompressTestCase(unittest.TestCase):
+    """
+    Test writing precompressed copies of the rendered site.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+        self.write('index.html', b'<p>hello</p>' * 1000)
+        self.write('small.js', b'var a;')
+        self.write('img/photo.jpg', b'\xff' * 5000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, contents):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def test_find_files(self):
+        assert compress._find_files(self.root) == [os.path.join(self.root, 'index.html')]
+
+    def test_compress_file(self):
+        src = os.path.join(self.root, 'index.html')
+
+        written = compress.compress_file(src)
+
+        assert '%s.gz' % src in written
+
+        with open('%s.gz' % src, 'rb') as f:
+            assert gzip.decompress(f.read()) == b'<p>hello</p>' * 1000
+
+        if compress.brotli:
+            with open('%s.br' % src, 'rb') as f:
+                assert compress.brotli.decompress(f.read()) == b'<p>hello</p>' * 1000
+
+    def test_skips_up_to_date(self):
+        src = os.path.join(self.root, 'index.html')
+
+        compress.compress_file(src)
+
+        assert compress.compress_file(src) == []
+
+        # Touching the source makes its copies stale
+        os.utime(src, (os.path.getmtime(src) + 10, os.path.getmtime(src) + 10))
+
+        assert '%s.gz' % src in compress.compress_file(src)
+
+    def test_older_source_is_stale(self):
+        src = os.path.join(self.root, 'index.html')
+
+        compress.compress_file(src)
+
+        # e.g. a downloaded file that kept an older remote timestamp
+        self.write('index.html', b'<p>goodbye</p>' * 1000)
+        os.utime(src, (0, 0))
+
+        assert '%s.gz' % src in compress.compress_file(src)
+
+        with open('%s.gz' % src, 'rb') as f:
+            assert gzip.decompress(f.read()) == b'<p>goodbye</p>' * 1000
+
+    def test_removes_orphans(self):
+        manifest_path = os.path.join(self.root, '.compress-manifest.json')
+
+        self.write('deleted.html', b'<p>bye</p>' * 1000)
+        self.write('small.js', b'var a;' * 1000)
+
+        # Supplied already compressed, with no source next to it
+        self.write('data/data.json.gz', b'not ours')
+
+        compress.precompress(self.root, workers=1, manifest_path=manifest_path)
+
+        os.remove(os.path.join(self.root, 'deleted.html'))
+        self.write('small.js', b'var a;')
+
+        removed = compress.precompress(self.root, workers=1, manifest_path=manifest_path)
+
+        assert os.path.join(self.root, 'deleted.html.gz') in removed
+        assert os.path.exists(os.path.join(self.root, 'index.html.gz'))
+        assert not os.path.exists(os.path.join(self.root, 'deleted.html.gz'))
+        assert not os.path.exists(os.path.join(self.root, 'small.js.gz'))
+        assert os.path.exists(os.path.join(self.root, 'data/data.json.gz'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from openpyxl import Workbook
+
+import copy_snapshot
+
+class CopySnapshotTestCase(unittest.TestCase):
+    """
+    Test precompiled copytext snapshots.
+    """
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_path, 'copy.xlsx')
+
+        self.write_copy('Hello')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def write_copy(self, headline):
+        book = Workbook()
+
+        sheet = book.active
+        sheet.title = 'content'
+        sheet.append(['key', 'value'])
+        sheet.append(['headline', headline])
+        sheet.append(['byline', None])
+
+        sheet = book.create_sheet('people')
+        sheet.append(['name', 'title'])
+        sheet.append(['Ada', 'Engineer'])
+        sheet.append(['Grace', 'Admiral'])
+
+        book.save(self.path)
+
+    def test_snapshot_matches_xlsx(self):
+        parsed = copy_snapshot.write_snapshot(self.path)
+        loaded = copy_snapshot.read_snapshot(self.path)
+
+        assert isinstance(loaded, copy_snapshot.SnapshotCopy)
+        assert loaded.json() == parsed.json()
+        assert str(loaded['content']['headline']) == 'Hello'
+        assert not loaded['content']['byline']
+        assert [row['name'] for row in loaded['people']] == ['Ada', 'Grace']
+        assert copy_snapshot.copy_js(loaded) == copy_snapshot.copy_js(parsed)
+
+    def test_stale_snapshot_is_ignored(self):
+        copy_snapshot.write_snapshot(self.path)
+
+        # Make sure the modification time moves
+        time.sleep(0.01)
+        self.write_copy('Goodbye')
+
+        assert copy_snapshot.read_snapshot(self.path) is None
+
+        copy = copy_snapshot.load_copy(self.path)
+
+        assert str(copy['content']['headline']) == 'Goodbye'
+        assert copy_snapshot.read_snapshot(self.path) is not None
+
+    def test_missing_snapshot(self):
+        assert copy_snapshot.read_snapshot(self.path) is None
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from urllib.parse import urlparse, parse_qs
+
+import facebook
+from openpyxl import Workbook
+
+import app_config
+from fabfile import data
+
+TWEETS = {
+    '1001': {
+        'id': 1001,
+        'created_at': 'Mon Jun 02 15:30:00 +0000 2014',
+        'text': 'Read this http://t.co/abc #news',
+        'entities': {
+            'urls': [{ 'url': 'http://t.co/abc', 'display_url': 'npr.org/abc', 'indices': [10, 25] }],
+            'hashtags': [{ 'text': 'news', 'indices': [26, 31] }]
+        },
+        'favorite_count': 3,
+        'retweet_count': 2,
+        'user': { 'id': 1, 'name': 'NPR', 'screen_name': 'npr', 'profile_image_url': 'http://example.com/npr.png', 'url': 'http://npr.org' }
+    }
+}
+
+TWEETS['1002'] = dict(TWEETS['1001'], id=1002, text='No links here', entities={})
+
+POSTS = {
+    '2001': {
+        'id': '2001',
+        'from': { 'id': '10' },
+        'created_time': '2014-06-02T15:30:00+0000',
+        'message': 'First post',
+        'link': 'http://npr.org/1',
+        'name': 'One',
+        'description': 'The first',
+        'picture': 'http://example.com/1.png'
+    }
+}
+
+POSTS['2002'] = dict(POSTS['2001'], id='2002', message='Second post')
+
+USERS = {
+    '10': { 'id': '10', 'name': 'NPR', 'link': 'http://facebook.com/npr' }
+}
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the Twitter and Graph APIs, slowly.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+
+        with self.server.lock:
+            self.server.requests.append(url.path)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+
+        time.sleep(0.05)
+
+        if parts[-1].endswith('.json'):
+            # /1.1/statuses/show/<id>.json
+            body = TWEETS[parts[-1][:-len('.json')]]
+        elif parts[-1] == 'picture':
+            body = { 'url': 'http://example.com/%s.png' % parts[-2] }
+        elif parts[-1] in ('likes', 'comments'):
+            assert parse_qs(url.query)['summary'] == ['true']
+            body = { 'data': [], 'summary': { 'total_count': 7 if parts[-1] == 'likes' else 4 } }
+        else:
+            body = POSTS.get(parts[-1]) or USERS[parts[-1]]
+
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+        payload = json.dumps(body).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+class FeaturedSocialTestCase(unittest.TestCase):
+    """
+    Test featured posts are fetched concurrently and written in one piece.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.server = ThreadingHTTPServer(('localhost', 0), StubAPIHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        host = 'localhost:%i' % self.server.server_address[1]
+
+        copy_path = os.path.join(self.tmp_dir, 'copy.xlsx')
+
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = 'share'
+        sheet.append(['key', 'value'])
+        sheet.append(['featured_tweet1', 'https://twitter.com/npr/status/1001'])
+        sheet.append(['featured_tweet2', 'https://twitter.com/npr/status/1002'])
+        sheet.append(['featured_tweet3', ''])
+        sheet.append(['featured_facebook1', 'https://www.facebook.com/npr/posts/2001'])
+        sheet.append(['featured_facebook2', 'https://www.facebook.com/npr/posts/2002'])
+        workbook.save(copy_path)
+
+        self.saved = {
+            (app_config, 'COPY_PATH'): copy_path,
+            (app_config, 'get_secrets'): lambda: {
+                'TWITTER_API_OAUTH_TOKEN': 'token',
+                'TWITTER_API_OAUTH_SECRET': 'secret',
+                'TWITTER_API_CONSUMER_KEY': 'key',
+                'TWITTER_API_CONSUMER_SECRET': 'secret',
+                'FACEBOOK_API_APP_TOKEN': 'token'
+            },
+            (data, 'FEATURED_PATH'): os.path.join(self.tmp_dir, 'featured.json'),
+            (data, 'TWITTER_API_DOMAIN'): host,
+            (data, 'TWITTER_API_SECURE'): False,
+            (data, 'TWITTER_RATE_LIMIT'): (100, 10),
+            (data, 'FACEBOOK_RATE_LIMIT'): (100, 10),
+            (facebook, 'FACEBOOK_GRAPH_URL'): 'http://%s/' % host
+        }
+
+        for (module, name), value in self.saved.items():
+            self.saved[(module, name)] = getattr(module, name)
+            setattr(module, name, value)
+
+    def tearDown(self):
+        for (module, name), value in self.saved.items():
+            setattr(module, name, value)
+
+        self.server.shutdown()
+        self.server.server_close()
+
+        shutil.rmtree(self.tmp_dir)
+
+    def test_update_featured_social(self):
+        data.update_featured_social()
+
+        with open(data.FEATURED_PATH) as f:
+            featured = json.load(f)
+
+        self.assertEqual([tweet['id'] for tweet in featured['tweets']], [1001, 1002])
+        self.assertEqual(featured['tweets'][0]['creation_date'], 'Jun 2')
+        self.assertIn('href="http://t.co/abc"', featured['tweets'][0]['html'])
+        self.assertIn('href="https://twitter.com/hashtag/news"', featured['tweets'][0]['html'])
+        self.assertEqual(featured['tweets'][1]['html'], 'No links here')
+
+        self.assertEqual([post['message'] for post in featured['facebook_posts']], ['First post', 'Second post'])
+        self.assertEqual(featured['facebook_posts'][0]['from']['picture'], 'http://example.com/10.png')
+        self.assertEqual(featured['facebook_posts'][0]['likes'], 7)
+        self.assertEqual(featured['facebook_posts'][0]['comments'], 4)
+
+        self.assertFalse(os.path.exists('%s.tmp' % data.FEATURED_PATH))
+
+    def test_calls_are_concurrent(self):
+        data.update_featured_social()
+
+        self.assertGreater(self.server.max_in_flight, 1)
+
+    def test_user_lookups_cached(self):
+        data.update_featured_social()
+
+        # Both posts are from the same user: 2 tweets, 2 x (post, likes, comments), 1 user, 1 picture
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertEqual(len([path for path in self.server.requests if path.endswith('/10')]), 1)
+        self.assertEqual(len([path for path in self.server.requests if path.endswith('/10/picture')]), 1)
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Test the token bucket limits call rate after its burst.
+    """
+    def test_burst(self):
+        bucket = data.TokenBucket(1, 3)
+
+        start = time.monotonic()
+
+        for i in range(3):
+            bucket.acquire()
+
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_rate(self):
+        bucket = data.TokenBucket(20, 1)
+
+        start = time.monotonic()
+
+        for i in range(5):
+            bucket.acquire()
+
+        # The first call uses the burst, the other 4 wait 1/20s each
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_threads_share_bucket(self):
+        bucket = data.TokenBucket(20, 1)
+
+        start = time.monotonic()
+
+        threads = [threading.Thread(target=bucket.acquire) for i in range(5)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+if __name__ == '__main__':
+    unittest.main()
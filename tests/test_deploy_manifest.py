@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import os
+import shlex
+import shutil
+import tempfile
+import unittest
+
+from fabric.state import env
+
+import app_config
+import fabfile
+from fabfile import compress, deploy_manifest
+
+class DeployManifestTestCase(unittest.TestCase):
+    """
+    Test working out which files changed since the last deploy.
+    """
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+
+        self.write('index.html', b'<html></html>')
+        self.write('js/app.js', b'var a;')
+        self.write('js/.DS_Store', b'junk')
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+
+    def write(self, name, contents):
+        path = os.path.join(self.src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def test_first_deploy_sends_everything(self):
+        manifest = deploy_manifest.build_manifest(self.src, ['.DS_Store'])
+
+        assert deploy_manifest.changed_files(manifest, {}) == ['index.html', 'js/app.js']
+
+    def test_only_changed_files(self):
+        previous = deploy_manifest.build_manifest(self.src, ['.DS_Store'])
+
+        self.write('js/app.js', b'var b;')
+        self.write('js/new.js', b'var c;')
+
+        manifest = deploy_manifest.build_manifest(self.src, ['.DS_Store'], previous)
+
+        assert deploy_manifest.changed_files(manifest, previous) == ['js/app.js', 'js/new.js']
+
+    def test_touched_but_unchanged(self):
+        previous = deploy_manifest.build_manifest(self.src)
+
+        self.write('index.html', b'<html></html>')
+
+        manifest = deploy_manifest.build_manifest(self.src, [], previous)
+
+        assert deploy_manifest.changed_files(manifest, previous) == []
+
+    def test_removed_files(self):
+        previous = deploy_manifest.build_manifest(self.src)
+
+        os.remove(os.path.join(self.src, 'js/app.js'))
+
+        manifest = deploy_manifest.build_manifest(self.src, [], previous)
+
+        assert deploy_manifest.removed_files(manifest, previous) == ['js/app.js']
+
+class DeployToGraphicsTestCase(unittest.TestCase):
+    """
+    Test deploys send changed files and delete removed ones.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+
+        self.write('confs/exclude-from.txt', b'.DS_Store\n')
+        self.write('www/index.html', b'<html></html>')
+        self.write('www/js/app.js', b'var a;')
+
+        self.commands = []
+        self.remote_exists = True
+
+        def run(command):
+            self.commands.append(('run', command))
+
+            return FakeResult(command.startswith('test -d') and not self.remote_exists)
+
+        def local(command):
+            self.commands.append(('local', command))
+
+        self.saved = (fabfile.run, fabfile.local, env.get('settings'), app_config.DEPLOYMENT_TARGET)
+
+        fabfile.run = run
+        fabfile.local = local
+        env.settings = 'staging'
+        app_config.configure_targets('staging')
+
+    def tearDown(self):
+        fabfile.run, fabfile.local, env.settings, deployment_target = self.saved
+        app_config.configure_targets(deployment_target)
+
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, contents):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+
+        with open(name, 'wb') as f:
+            f.write(contents)
+
+    def rsyncs(self):
+        return [command for kind, command in self.commands if kind == 'local']
+
+    def test_first_deploy_is_full(self):
+        self.remote_exists = False
+
+        fabfile._deploy_to_graphics()
+
+        assert '--delete' in self.rsyncs()[0]
+
+    def test_deletes_removed_files(self):
+        fabfile._deploy_to_graphics()
+        self.commands = []
+
+        os.remove('www/js/app.js')
+        fabfile._deploy_to_graphics()
+
+        assert self.rsyncs() == []
+        assert self.commands[-1] == ('run', 'cd %s && rm -f -- js/app.js' % shlex.quote(app_config.S3_BASE_URL))
+
+    def test_deletes_stale_compressed_copies(self):
+        self.write('www/big.html', b'<p>big</p>' * 1000)
+
+        compress.precompress('www', workers=1, manifest_path='.compress-manifest.json')
+        fabfile._deploy_to_graphics()
+        self.commands = []
+
+        # The page is gone, so nginx mustn't keep sending its compressed copy
+        os.remove('www/big.html')
+        compress.precompress('www', workers=1, manifest_path='.compress-manifest.json')
+        fabfile._deploy_to_graphics()
+
+        assert 'big.html.gz' in self.commands[-1][1]
+
+    def test_nothing_changed(self):
+        fabfile._deploy_to_graphics()
+        self.commands = []
+
+        fabfile._deploy_to_graphics()
+
+        assert self.rsyncs() == []
+        assert not any('rm -f' in command for kind, command in self.commands)
+
+class FakeResult(object):
+    def __init__(self, failed):
+        self.failed = failed
+
+if __name__ == '__main__':
+    unittest.main()
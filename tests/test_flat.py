@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import boto
+from moto import mock_s3_deprecated
+
+import app_config
+from fabfile import flat
+
+class DeployFolderTestCase(unittest.TestCase):
+    """
+    Test deploying a folder to a local S3 stand-in.
+    """
+    def setUp(self):
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+
+        self.s3_bucket = app_config.S3_BUCKET
+        app_config.S3_BUCKET = { 'bucket_name': 'test-bucket' }
+
+        self.bucket = boto.connect_s3().create_bucket('test-bucket')
+
+        # Throw away connections made against other buckets
+        flat._local.__dict__.clear()
+
+        self.src = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.cache_dir, 'deploy-cache.sqlite')
+
+        self.write('a.txt', b'apple')
+        self.write('img/b.png', b'banana')
+        self.write('.hidden', b'secret')
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.cache_dir)
+        flat._local.__dict__.clear()
+
+        app_config.S3_BUCKET = self.s3_bucket
+
+        self.mock.stop()
+
+    def write(self, name, contents):
+        path = os.path.join(self.src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def remote(self):
+        return dict((key.name, key.get_contents_as_string()) for key in self.bucket.list())
+
+    def test_deploy_folder(self):
+        flat.deploy_folder(self.src, 'project', workers=2, digest_cache_path=self.cache_path)
+
+        assert self.remote() == {
+            'project/a.txt': b'apple',
+            'project/img/b.png': b'banana',
+        }
+
+    def test_skips_unchanged(self):
+        flat.deploy_folder(self.src, 'project', digest_cache_path=self.cache_path)
+
+        self.write('a.txt', b'apricot')
+
+        uploaded = []
+        deploy_file = flat.deploy_file
+
+        def tracking_deploy_file(bucket, src, dst, headers={}, s3_md5=None, digests=None):
+            size = deploy_file(bucket, src, dst, headers, s3_md5, digests)
+
+            if size is not None:
+                uploaded.append(dst)
+
+            return size
+
+        flat.deploy_file = tracking_deploy_file
+
+        try:
+            flat.deploy_folder(self.src, 'project', digest_cache_path=self.cache_path)
+        finally:
+            flat.deploy_file = deploy_file
+
+        assert uploaded == ['project/a.txt']
+        assert self.remote()['project/a.txt'] == b'apricot'
+
+    def test_ignore(self):
+        flat.deploy_folder(self.src, 'project', ignore=['*.png'], digest_cache_path=self.cache_path)
+
+        assert list(self.remote().keys()) == ['project/a.txt']
+
+    def test_retries(self):
+        attempts = []
+        deploy_file = flat.deploy_file
+
+        def flaky_deploy_file(bucket, src, dst, headers={}, s3_md5=None, digests=None):
+            attempts.append(dst)
+
+            if len(attempts) == 1:
+                raise OSError('Connection reset')
+
+            return deploy_file(bucket, src, dst, headers, s3_md5, digests)
+
+        flat.deploy_file = flaky_deploy_file
+        backoff = flat.DEPLOY_BACKOFF
+        flat.DEPLOY_BACKOFF = 0
+
+        try:
+            flat._deploy_file_with_retries(os.path.join(self.src, 'a.txt'), 'project/a.txt', {}, None)
+        finally:
+            flat.deploy_file = deploy_file
+            flat.DEPLOY_BACKOFF = backoff
+
+        assert attempts == ['project/a.txt', 'project/a.txt']
+        assert self.remote()['project/a.txt'] == b'apple'
+
+    def test_retries_connection_failure(self):
+        attempts = []
+        get_bucket = flat._get_bucket
+
+        def flaky_get_bucket():
+            attempts.append(True)
+
+            # Fails before a bucket is ever set for this thread
+            if len(attempts) == 1:
+                raise OSError('Connection refused')
+
+            return get_bucket()
+
+        flat._get_bucket = flaky_get_bucket
+        backoff = flat.DEPLOY_BACKOFF
+        flat.DEPLOY_BACKOFF = 0
+
+        try:
+            flat._deploy_file_with_retries(os.path.join(self.src, 'a.txt'), 'project/a.txt', {}, None)
+        finally:
+            flat._get_bucket = get_bucket
+            flat.DEPLOY_BACKOFF = backoff
+
+        assert len(attempts) == 2
+        assert self.remote()['project/a.txt'] == b'apple'
+
+    def test_gzip(self):
+        self.write('data/big.json', b'[' + b'1,' * 100000 + b'1]')
+
+        flat.deploy_folder(self.src, 'project', digest_cache_path=self.cache_path)
+
+        key = self.bucket.get_key('project/data/big.json')
+
+        assert key.content_encoding == 'gzip'
+        assert gzip.decompress(key.get_contents_as_string()) == b'[' + b'1,' * 100000 + b'1]'
+
+    def test_digest_cache_skips_compression(self):
+        self.write('index.html', b'<html></html>')
+
+        flat.deploy_folder(self.src, 'project', digest_cache_path=self.cache_path)
+
+        compressed = []
+        gzip_file = flat._gzip_file
+
+        def tracking_gzip_file(src, dst, output):
+            compressed.append(src)
+
+            return gzip_file(src, dst, output)
+
+        flat._gzip_file = tracking_gzip_file
+
+        try:
+            flat.deploy_folder(self.src, 'project', digest_cache_path=self.cache_path)
+        finally:
+            flat._gzip_file = gzip_file
+
+        assert compressed == []
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import unittest
+
+import minifier
+
+PAGE = """<html>
+<head>
+    <title>Test</title>
+</head>
+<body  class="page"   data-empty="">
+    <p>Hello,
+       world</p>
+    <!-- comment -->
+    <pre>  keep
+  this  </pre>
+    <script>
+        var a  =  1;
+    </script>
+</body>
+</html>"""
+
+class FastMinifyTestCase(unittest.TestCase):
+    """
+    Test the tokenizer-based minifier.
+    """
+    def test_collapses_whitespace(self):
+        html = minifier.fast_minify(PAGE)
+
+        assert '<p>Hello, world</p>' in html
+        assert '<head><title>Test</title></head>' in html
+
+    def test_tags(self):
+        assert '<body class="page" data-empty>' in minifier.fast_minify(PAGE)
+
+    def test_keeps_raw_elements_and_comments(self):
+        html = minifier.fast_minify(PAGE)
+
+        assert '<pre>  keep\n  this  </pre>' in html
+        assert 'var a  =  1;' in html
+        assert '<!-- comment -->' in html
+
+    def test_keeps_quotes(self):
+        assert minifier.fast_minify("<a  href='x  y' title=\"z\">a</a>") == "<a href='x  y' title=\"z\">a</a>"
+
+    def test_matches_htmlmin_text(self):
+        html = '<div>\n  <p>One  two</p>\n  <p>Three</p>\n</div>'
+
+        assert minifier.fast_minify(html) == minifier.MINIFIERS['htmlmin'](html)
+
+class MinifyHTMLTestCase(unittest.TestCase):
+    """
+    Test minified pages are cached in memory by content.
+    """
+    def setUp(self):
+        minifier._minify.cache_clear()
+
+        self.minifiers = minifier.MINIFIERS
+        self.calls = []
+
+        def count(html):
+            self.calls.append(html)
+
+            return html.strip()
+
+        minifier.MINIFIERS = { 'count': count }
+
+    def tearDown(self):
+        minifier._minify.cache_clear()
+
+        minifier.MINIFIERS = self.minifiers
+
+    def test_minifies_once(self):
+        assert minifier.minify_html(' <p>a</p> ', 'count') == '<p>a</p>'
+        assert minifier.minify_html(' <p>a</p> ', 'count') == '<p>a</p>'
+
+        assert len(self.calls) == 1
+
+    def test_different_content(self):
+        minifier.minify_html('<p>a</p>', 'count')
+        minifier.minify_html('<p>b</p>', 'count')
+
+        assert len(self.calls) == 2
+
+    def test_bounded(self):
+        for i in range(minifier.MINIFY_CACHE_SIZE + 1):
+            minifier.minify_html('<p>%i</p>' % i, 'count')
+
+        # The oldest page was dropped
+        minifier.minify_html('<p>0</p>', 'count')
+
+        assert len(self.calls) == minifier.MINIFY_CACHE_SIZE + 2
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from authomatic.core import Credentials
+from authomatic.providers import oauth2
+
+import app_config
+import oauth
+
+class FakeResponse(object):
+    status = 200
+
+class FakeCredentials(object):
+    """
+    Stands in for Authomatic credentials, serialized as "<token>:<expiration time>".
+    """
+    refreshes = []
+
+    def __init__(self, serialized):
+        self.token, expiration_time = serialized.split(':')
+        self.expiration_time = int(expiration_time)
+
+    @property
+    def valid(self):
+        return self.expiration_time > time.time()
+
+    def expire_soon(self, seconds):
+        return self.expiration_time < time.time() + seconds
+
+    def refresh(self, force=False):
+        # Slow enough for other threads to pile up behind us
+        time.sleep(0.05)
+        FakeCredentials.refreshes.append(self.token)
+
+        self.token = 'refreshed'
+        self.expiration_time = int(time.time()) + 3600
+
+        return FakeResponse()
+
+    def serialize(self):
+        return '%s:%i' % (self.token, self.expiration_time)
+
+class CredentialsTestCase(unittest.TestCase):
+    """
+    Test credentials are cached in memory and refreshed once.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.credentials_path = app_config.GOOGLE_OAUTH_CREDENTIALS_PATH
+        app_config.GOOGLE_OAUTH_CREDENTIALS_PATH = os.path.join(self.tmp_dir, 'credentials')
+
+        self.deserialize = oauth.authomatic.credentials
+        self.loads = []
+
+        def deserialize(serialized):
+            self.loads.append(serialized)
+
+            return FakeCredentials(serialized)
+
+        oauth.authomatic.credentials = deserialize
+        oauth._credentials_cache.clear()
+        FakeCredentials.refreshes = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+        app_config.GOOGLE_OAUTH_CREDENTIALS_PATH = self.credentials_path
+        oauth.authomatic.credentials = self.deserialize
+        oauth._credentials_cache.clear()
+
+    def write(self, token, expire_in):
+        with open(app_config.GOOGLE_OAUTH_CREDENTIALS_PATH, 'w') as f:
+            f.write('%s:%i' % (token, time.time() + expire_in))
+
+    def test_missing(self):
+        self.assertIsNone(oauth.get_credentials())
+
+    def test_reads_disk_once(self):
+        self.write('first', 3600)
+
+        credentials = oauth.get_credentials()
+
+        self.assertIs(oauth.get_credentials(), credentials)
+        self.assertEqual(len(self.loads), 1)
+
+    def test_reloads_changed_file(self):
+        self.write('first', 3600)
+        oauth.get_credentials()
+
+        self.write('second token', 3600)
+
+        self.assertEqual(oauth.get_credentials().token, 'second token')
+
+    def test_refreshes_before_expiry(self):
+        self.write('first', oauth.CREDENTIALS_REFRESH_MARGIN - 10)
+
+        self.assertEqual(oauth.get_credentials().token, 'refreshed')
+        self.assertEqual(FakeCredentials.refreshes, ['first'])
+
+        # The refreshed credentials were saved, but aren't read back
+        with open(app_config.GOOGLE_OAUTH_CREDENTIALS_PATH) as f:
+            self.assertTrue(f.read().startswith('refreshed:'))
+
+        oauth.get_credentials()
+
+        self.assertEqual(len(self.loads), 1)
+
+    def test_concurrent_refresh(self):
+        self.write('first', -10)
+
+        threads = [threading.Thread(target=oauth.get_credentials) for i in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(FakeCredentials.refreshes, ['first'])
+
+class DriveHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the Drive API's file metadata and export endpoints.
+    """
+    def do_GET(self):
+        drive = self.server.drive
+        drive['requests'].append(self.path.split('?')[0])
+
+        if self.path.startswith('/files/sheet/export'):
+            body = drive['content']
+            content_type = 'application/octet-stream'
+        elif self.path.startswith('/files/sheet'):
+            body = json.dumps({ 'modifiedTime': drive['modified'], 'version': drive['version'] }).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class GetDocumentTestCase(unittest.TestCase):
+    """
+    Test downloading a Google Doc only when it changed, against a local Drive stand-in.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.server = HTTPServer(('127.0.0.1', 0), DriveHandler)
+        self.server.drive = { 'requests': [], 'content': b'first', 'modified': '2020-01-01T00:00:00Z', 'version': '1' }
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        root = 'http://127.0.0.1:%i/files/' % self.server.server_port
+
+        self.settings = (oauth.DRIVE_API_EXPORT_TEMPLATE, oauth.DRIVE_API_FILE_TEMPLATE, oauth.DRIVE_METADATA_PATH, oauth.get_credentials)
+
+        oauth.DRIVE_API_EXPORT_TEMPLATE = root + '%s/export?mimeType=%s'
+        oauth.DRIVE_API_FILE_TEMPLATE = root + '%s?fields=md5Checksum,modifiedTime,version'
+        oauth.DRIVE_METADATA_PATH = os.path.join(self.tmp_dir, 'drive-metadata.json')
+
+        credentials = Credentials(app_config.authomatic.config, token='token', provider=oauth2.Google(app_config.authomatic, None, None, None))
+        oauth.get_credentials = lambda: credentials
+
+        self.path = os.path.join(self.tmp_dir, 'doc.txt')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+        oauth.DRIVE_API_EXPORT_TEMPLATE, oauth.DRIVE_API_FILE_TEMPLATE, oauth.DRIVE_METADATA_PATH, oauth.get_credentials = self.settings
+
+    def get_document(self):
+        del self.server.drive['requests'][:]
+
+        return oauth.get_document('sheet', self.path, 'text/plain')
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_downloads(self):
+        self.assertTrue(self.get_document())
+        self.assertEqual(self.read(), b'first')
+
+    def test_skips_unchanged(self):
+        self.get_document()
+
+        self.assertFalse(self.get_document())
+        self.assertEqual(self.server.drive['requests'], ['/files/sheet'])
+
+    def test_downloads_changed(self):
+        self.get_document()
+
+        self.server.drive.update(content=b'second', version='2')
+
+        self.assertTrue(self.get_document())
+        self.assertEqual(self.read(), b'second')
+
+    def test_same_content(self):
+        self.get_document()
+        mtime = os.stat(self.path).st_mtime_ns
+
+        # Touched in Drive without changing the export
+        self.server.drive.update(version='2')
+
+        self.assertFalse(self.get_document())
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+
+    def test_local_file_changed(self):
+        self.get_document()
+
+        with open(self.path, 'wb') as f:
+            f.write(b'edited locally')
+
+        self.assertTrue(self.get_document())
+        self.assertEqual(self.read(), b'first')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from flask import Flask, make_response, render_template, render_template_string
+
+import app_config
+from fabfile import render
+from render_utils import record_dependency
+
+PAGE = '''<html>
+    <head><title>{{ title }}</title></head>
+    <body>
+        <p>{{ DEBUG }} {{ S3_BASE_URL }}</p>
+    </body>
+</html>'''
+
+def _page(title):
+    def view():
+        return make_response(render_template_string(PAGE, title=title, DEBUG=app_config.DEBUG, S3_BASE_URL=app_config.S3_BASE_URL))
+
+    view.__name__ = title
+
+    return view
+
+class ParallelRenderTestCase(unittest.TestCase):
+    """
+    Test rendering in worker processes gives the same pages as rendering serially.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        test_app = Flask(__name__)
+        views = {}
+
+        for i in range(6):
+            name = 'page%i' % i
+            views[name] = _page(name)
+            test_app.add_url_rule('/%s.html' % name, name, views[name])
+
+        self.app = render.app
+        render.app = types.SimpleNamespace(app=test_app, **views)
+
+        self.targets = [('/%s.html' % name, name, os.path.join(self.tmp_dir, '%s', '%s.html' % name)) for name in sorted(views)]
+
+        self.deployment_target = app_config.DEPLOYMENT_TARGET
+        app_config.configure_targets('production')
+
+    def tearDown(self):
+        render.app = self.app
+
+        app_config.configure_targets(self.deployment_target)
+
+        shutil.rmtree(self.tmp_dir)
+
+    def _read(self, directory):
+        pages = {}
+
+        for rule, name, filename in self.targets:
+            with open(filename % directory, 'rb') as f:
+                pages[name] = f.read()
+
+        return pages
+
+    def test_parallel_matches_serial(self):
+        serial = [(rule, name, filename % 'serial') for rule, name, filename in self.targets]
+        parallel = [(rule, name, filename % 'parallel') for rule, name, filename in self.targets]
+
+        compiled_includes = {}
+
+        for target in serial:
+            render._render_target(target, compiled_includes)
+
+        render._render_parallel(parallel, 3)
+
+        self.assertEqual(self._read('serial'), self._read('parallel'))
+        self.assertIn(b'False /home/', self._read('parallel')['page0'])
+
+    def test_worker_restores_target(self):
+        # As in a worker started with "spawn", which re-imports app_config
+        app_config.configure_targets(None)
+
+        render._init_render_worker({}, None, 'production', None, None, None)
+
+        self.assertEqual(app_config.DEPLOYMENT_TARGET, 'production')
+        self.assertFalse(app_config.DEBUG)
+
+class IncrementalRenderTestCase(unittest.TestCase):
+    """
+    Test render_all() skips views whose inputs have not changed.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # Render into (and cache in) the temp directory
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        os.makedirs('templates')
+
+        self.template_path = 'templates/page.html'
+        self.data_path = 'data.txt'
+
+        self._write(self.template_path, '<p>{{ data }}</p>')
+        self._write(self.data_path, 'one')
+
+        self.rendered = []
+
+        def template_page():
+            self.rendered.append('template_page')
+
+            return make_response(render_template('page.html', data=''))
+
+        def data_page():
+            self.rendered.append('data_page')
+            record_dependency(self.data_path)
+
+            with open(self.data_path) as f:
+                return make_response(render_template('page.html', data=f.read()))
+
+        def untracked_page():
+            self.rendered.append('untracked_page')
+
+            return make_response('<p>untracked</p>')
+
+        test_app = Flask(__name__, template_folder=os.path.join(self.tmp_dir, 'templates'))
+
+        for view in [template_page, data_page, untracked_page]:
+            test_app.add_url_rule('/%s.html' % view.__name__, view.__name__, view)
+
+        self.saved = {
+            'app': render.app,
+            'less': render.less,
+            'jst': render.jst
+        }
+
+        render.app = types.SimpleNamespace(app=test_app, template_page=template_page, data_page=data_page, untracked_page=untracked_page)
+
+        # Compiling assets needs Node, and isn't what's being tested
+        render.less = lambda: None
+        render.jst = lambda: None
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(render, name, value)
+
+        os.chdir(self.cwd)
+
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def _render(self, force=False):
+        self.rendered = []
+        render.render_all(force=force)
+
+        return sorted(self.rendered)
+
+    def test_unchanged(self):
+        self.assertEqual(self._render(), ['data_page', 'template_page', 'untracked_page'])
+
+        # Only the view with no recorded inputs is rendered again
+        self.assertEqual(self._render(), ['untracked_page'])
+
+    def test_template_changed(self):
+        self._render()
+        self._write(self.template_path, '<div>{{ data }}</div>')
+
+        self.assertEqual(self._render(), ['data_page', 'template_page', 'untracked_page'])
+
+    def test_data_changed(self):
+        self._render()
+        self._write(self.data_path, 'two')
+
+        self.assertEqual(self._render(), ['data_page', 'untracked_page'])
+
+        with open('www/data_page.html') as f:
+            self.assertIn('two', f.read())
+
+    def test_config_changed(self):
+        self._render()
+
+        share_url = app_config.SHARE_URL
+        app_config.SHARE_URL = 'https://example.com/'
+
+        try:
+            self.assertEqual(self._render(), ['data_page', 'template_page', 'untracked_page'])
+        finally:
+            app_config.SHARE_URL = share_url
+
+    def test_force(self):
+        self._render()
+
+        self.assertEqual(self._render(force='true'), ['data_page', 'template_page', 'untracked_page'])
+
+if __name__ == '__main__':
+    unittest.main()
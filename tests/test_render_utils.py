@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask, Markup
+from openpyxl import Workbook
+
+import app_config
+import copytext
+import copy_snapshot
+import render_utils
+
+class FingerprintTestCase(unittest.TestCase):
+    """
+    Test content-hashed bundle filenames.
+    """
+    def test_fingerprint_path(self):
+        path = render_utils.fingerprint_path('js/app.min.js', b'var a = 1;')
+        digest = render_utils.content_hash(b'var a = 1;')
+
+        assert path == 'js/app.%s.min.js' % digest
+
+    def test_fingerprint_path_is_stable(self):
+        a = render_utils.fingerprint_path('css/app.min.css', b'body{}')
+        b = render_utils.fingerprint_path('css/app.min.css', b'body{}')
+        c = render_utils.fingerprint_path('css/app.min.css', b'body{color:red}')
+
+        assert a == b
+        assert a != c
+
+    def test_cache_bust_uses_content_hash(self):
+        with open('www/js/app.js', 'rb') as f:
+            digest = render_utils.content_hash(f.read())
+
+        assert render_utils.cache_bust_filter('../js/app.js') == '../js/app.js?%s' % digest
+
+    def test_cache_bust_markup(self):
+        busted = render_utils.cache_bust_filter(Markup('../js/app.js?a=1&amp;b=2'))
+
+        assert busted.startswith('../js/app.js?a=1&b=2?')
+
+class CopyCacheTestCase(unittest.TestCase):
+    """
+    Test reuse of parsed copytext.
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+
+        self.write_copy('Hello')
+
+    def tearDown(self):
+        render_utils.invalidate_copy()
+        os.remove(self.path)
+
+    def write_copy(self, value):
+        book = Workbook()
+        sheet = book.active
+        sheet.title = 'content'
+        sheet.append(['key', 'value'])
+        sheet.append(['headline', value])
+        book.save(self.path)
+
+    def test_reuses_parsed_copy(self):
+        assert render_utils.get_copy(self.path) is render_utils.get_copy(self.path)
+
+    def test_reloads_changed_file(self):
+        first = render_utils.get_copy(self.path)
+
+        self.write_copy('Goodbye, everyone')
+
+        second = render_utils.get_copy(self.path)
+
+        assert first is not second
+        assert str(second['content']['headline']) == 'Goodbye, everyone'
+
+    def test_invalidate(self):
+        first = render_utils.get_copy(self.path)
+
+        render_utils.invalidate_copy(self.path)
+
+        assert render_utils.get_copy(self.path) is not first
+
+    def test_typeset_copy(self):
+        self.write_copy('"Hello"')
+
+        smartypants_copy = app_config.SMARTYPANTS_COPY
+        app_config.SMARTYPANTS_COPY = True
+
+        try:
+            copy = render_utils.get_copy(self.path)
+        finally:
+            app_config.SMARTYPANTS_COPY = smartypants_copy
+
+        assert str(copy['content']['headline']) == '&#8220;Hello&#8221;'
+        assert '"\\"Hello\\""' in copy_snapshot.copy_js(copy)
+
+class HelpersTestCase(unittest.TestCase):
+    """
+    Test the slug, contains and natural sort template helpers.
+    """
+    def test_convert_to_slug(self):
+        assert render_utils.convert_to_slug(' St. Louis, MO ') == 'st-louis-mo'
+        assert render_utils.convert_to_slug(None) is None
+
+    def test_slugify_all(self):
+        assert render_utils.slugify_all(['St. Louis', 'Kansas City']) == ['st-louis', 'kansas-city']
+
+    def test_contains_ignores_unicode(self):
+        assert render_utils.contains('District 8¢ for the Library', '8 for')
+        assert not render_utils.contains('District 8', 'Library')
+        assert not render_utils.contains(None, 'Library')
+
+    def test_copy_rows(self):
+        sheet = copytext.Sheet('content', [{ 'key': 'numbers', 'value': ' 1;2;3 ' }, { 'key': 'count', 'value': ' 12 ' }], ['key', 'value'])
+
+        assert render_utils.split_semicolon_filter(sheet['numbers']) == ['1', '2', '3']
+        assert render_utils.convert_to_int(sheet['count']) == 12
+
+    def test_sort_by(self):
+        rows = [{ 'name': 'Item 10' }, { 'name': 'Item 2' }, { 'name': 'Item 1' }]
+
+        assert [row['name'] for row in render_utils.sort_by(rows, 'name')] == ['Item 1', 'Item 2', 'Item 10']
+        assert [row['name'] for row in render_utils.nat_sort(rows, 'name', True)] == ['Item 10', 'Item 2', 'Item 1']
+
+class JinjaTestCase(unittest.TestCase):
+    """
+    Test the shared Jinja environment setup.
+    """
+    def setUp(self):
+        self.cache_path = render_utils.JINJA_CACHE_PATH
+        render_utils.JINJA_CACHE_PATH = tempfile.mkdtemp()
+
+        self.app = Flask(__name__, template_folder='../templates')
+        self.env = render_utils.configure_jinja(self.app)
+
+    def tearDown(self):
+        shutil.rmtree(render_utils.JINJA_CACHE_PATH)
+        render_utils.JINJA_CACHE_PATH = self.cache_path
+
+    def test_filters_and_tests(self):
+        template = self.env.from_string("{{ 'a b&c'|urlencode }} {{ 'St. Louis'|slug }} {{ 'abc' is contains('b') }}")
+
+        assert template.render() == 'a+b%26c st-louis True'
+
+    def test_smarty(self):
+        assert self.env.from_string("{{ '\"Hi\"'|smarty }}").render() == '&#8220;Hi&#8221;'
+
+    def test_bytecode_cache(self):
+        render_utils.preload_templates(self.env)
+
+        assert os.listdir(render_utils.JINJA_CACHE_PATH)
+        assert '_base.html' in [template.name for template in self.env.cache.values()]
+
+    def test_configure_again(self):
+        assert render_utils.configure_jinja(self.app) is self.env
+
+class SmartyTestCase(unittest.TestCase):
+    """
+    Test the cached smartypants filter.
+    """
+    def test_cache(self):
+        before = render_utils.smarty_cache_info()
+
+        assert render_utils.smarty_filter('"Cached" -- twice') == render_utils.smarty_filter('"Cached" -- twice')
+
+        after = render_utils.smarty_cache_info()
+
+        assert after.hits == before.hits + 1
+        assert after.misses == before.misses + 1
+
+    def test_markup(self):
+        assert render_utils.smarty_filter(Markup('It&#39;s')) == 'It&#8217;s'
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import watcher
+
+class WatcherTestCase(unittest.TestCase):
+    """
+    Test changed files are handed to the right rebuild functions.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.rebuilt = []
+
+        self.write('less/app.less', '.app {}')
+        self.write('templates/index.html', '<p></p>')
+
+        self.watcher = watcher.Watcher([
+            (os.path.join(self.root, 'less/*'), lambda paths: self.rebuilt.append(('less', paths))),
+            (os.path.join(self.root, 'templates/*'), lambda paths: self.rebuilt.append(('templates', paths)))
+        ], paths=[self.root], use_inotify=False)
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, contents):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+
+        with open(self.path(name), 'w') as f:
+            f.write(contents)
+
+    def test_first_check_builds_everything(self):
+        self.watcher.check()
+
+        assert self.rebuilt == [('less', [self.path('less/app.less')]), ('templates', [self.path('templates/index.html')])]
+
+    def test_warm_up(self):
+        self.watcher.warm_up = [os.path.join(self.root, 'templates/*')]
+        self.watcher.check()
+
+        assert self.rebuilt == [('templates', [self.path('templates/index.html')])]
+
+        # Later changes go to every handler
+        self.write('less/app.less', '.changed {}')
+        self.watcher.check()
+
+        assert self.rebuilt[-1] == ('less', [self.path('less/app.less')])
+
+    def test_only_changed(self):
+        self.watcher.check()
+        del self.rebuilt[:]
+
+        self.write('less/base/_type.less', 'body {}')
+
+        assert self.watcher.check() == set([self.path('less/base/_type.less')])
+        assert self.rebuilt == [('less', [self.path('less/base/_type.less')])]
+
+    def test_no_changes(self):
+        self.watcher.check()
+        del self.rebuilt[:]
+
+        assert self.watcher.check() == set()
+        assert self.rebuilt == []
+
+    def test_deleted(self):
+        self.watcher.check()
+        del self.rebuilt[:]
+
+        os.remove(self.path('templates/index.html'))
+        self.watcher.check()
+
+        assert self.rebuilt == [('templates', [self.path('templates/index.html')])]
+
+    def test_handler_errors(self):
+        def fail(paths):
+            raise ValueError('Broken LESS')
+
+        self.watcher.handlers.insert(0, (os.path.join(self.root, 'less/*'), fail))
+        self.watcher.check()
+
+        # Later handlers still run
+        assert ('templates', [self.path('templates/index.html')]) in self.rebuilt
+
+    def test_background(self):
+        rebuilt = threading.Event()
+
+        self.watcher.handlers = [(self.path('less/*'), lambda paths: rebuilt.set())]
+
+        poll_interval = watcher.POLL_INTERVAL
+        watcher.POLL_INTERVAL = 0.01
+
+        try:
+            self.watcher.start()
+
+            assert rebuilt.wait(5)
+            rebuilt.clear()
+
+            self.write('less/other.less', '.other {}')
+
+            assert rebuilt.wait(5)
+        finally:
+            watcher.POLL_INTERVAL = poll_interval
+
+class RebuildJSTestCase(unittest.TestCase):
+    """
+    Test build outputs in www/js aren't sent back to Babel.
+    """
+    def setUp(self):
+        self.compile_js = watcher.compiler.compile_js
+        self.compiled = []
+
+        watcher.compiler.compile_js = self.compiled.extend
+
+    def tearDown(self):
+        watcher.compiler.compile_js = self.compile_js
+
+    def test_skips_build_outputs(self):
+        watcher._rebuild_js(['www/js/app.js', 'www/js/app.min.js', 'www/js/templates.js'])
+
+        assert self.compiled == ['www/js/app.js']
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+Rebuild compiled assets in the background while the dev server runs.
+
+A Watcher thread notices changes under less/, jst/, www/js/, templates/
+and data/ and hands the changed paths to whichever rebuild functions
+match them, so requests find LESS, JST, copy and templates already compiled
+instead of waiting on Node. Changes are picked up with inotify when
+the optional inotify_simple package is available (Linux only), and by
+polling otherwise.
+
+Started from app.py when `fab app` sets WATCH_FILES.
+"""
+
+from fnmatch import fnmatch
+import os
+import threading
+
+# inotify is optional. Without it, we poll
+try:
+    from inotify_simple import INotify, flags
+except (ImportError, AttributeError, OSError):
+    INotify = None
+
+import compiler
+import render_utils
+import static
+
+WATCH_PATHS = ['less', 'jst', 'www/js', 'templates', 'data']
+
+# Files in www/js that are written by the build, not edited by hand
+JS_BUILD_OUTPUTS = ['www/js/*.min.js', 'www/js/templates.js']
+
+# How often to look for changes when polling
+POLL_INTERVAL = 1.0
+
+# Wait this long after a change for others to follow (e.g. an editor saving several files)
+SETTLE_TIME = 0.1
+
+class Watcher(object):
+    """
+    Calls `handler(changed_paths)` for each (pattern, handler) in
+    `handlers` whose glob pattern matches a changed file.
+
+    The first check treats every file as changed, warming up each handler
+    whose pattern is in `warm_up` (default: all of them).
+    """
+    def __init__(self, handlers, paths=None, use_inotify=True, warm_up=None):
+        self.handlers = handlers
+        self.paths = paths or WATCH_PATHS
+        self.warm_up = warm_up
+
+        self._files = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._watched_dirs = set()
+
+        if use_inotify and INotify is not None:
+            try:
+                self._inotify = INotify()
+            except OSError:
+                self._inotify = None
+
+    def _scan(self):
+        """
+        Find every watched file's modification time and size.
+        """
+        files = {}
+
+        for root in self.paths:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+
+                if self._inotify is not None and dirpath not in self._watched_dirs:
+                    mask = flags.CREATE | flags.DELETE | flags.MODIFY | flags.MOVED_FROM | flags.MOVED_TO | flags.CLOSE_WRITE
+
+                    try:
+                        self._inotify.add_watch(dirpath, mask)
+                        self._watched_dirs.add(dirpath)
+                    except OSError:
+                        pass
+
+                for name in filenames:
+                    if name.startswith('.'):
+                        continue
+
+                    path = os.path.join(dirpath, name)
+
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+
+                    files[path] = (stat.st_mtime_ns, stat.st_size)
+
+        return files
+
+    def check(self):
+        """
+        Look for changes since the last check and rebuild what they affect.
+        Returns the changed paths.
+        """
+        files = self._scan()
+
+        initial = self._files is None
+
+        if initial:
+            changed = set(files)
+        else:
+            changed = set(path for path in set(files) | set(self._files) if files.get(path) != self._files.get(path))
+
+        self._files = files
+
+        if changed:
+            self.dispatch(changed, initial)
+
+        return changed
+
+    def dispatch(self, changed, initial=False):
+        for pattern, handler in self.handlers:
+            if initial and self.warm_up is not None and pattern not in self.warm_up:
+                continue
+
+            paths = sorted(path for path in changed if fnmatch(path, pattern))
+
+            if not paths:
+                continue
+
+            try:
+                handler(paths)
+            except Exception as e:
+                # Keep watching; the request for this asset will show the error
+                print('Rebuilding after changes to %s failed: %s' % (', '.join(paths), e))
+
+    def _wait(self):
+        if self._inotify is not None:
+            # Wake up as soon as something changes, then let the changes settle
+            if self._inotify.read(timeout=int(POLL_INTERVAL * 1000) * 10, read_delay=int(SETTLE_TIME * 1000)):
+                return
+
+        self._stopped.wait(POLL_INTERVAL)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.check()
+            self._wait()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='watcher', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+def _rebuild_less(paths):
+    static.refresh_less()
+
+def _rebuild_jst(paths):
+    static.refresh_templates_js()
+
+def _rebuild_js(paths):
+    # Warm the compile cache for the next render
+    sources = [path for path in paths if not any(fnmatch(path, pattern) for pattern in JS_BUILD_OUTPUTS)]
+
+    compiler.compile_js([path for path in sources if path.endswith('.js') and os.path.exists(path)])
+
+def _rebuild_data(paths):
+    # Reparses (and re-snapshots) the spreadsheet if it changed
+    render_utils.get_copy()
+    static.refresh_copy_js()
+
+def _rebuild_templates(app):
+    def rebuild(paths):
+        for path in paths:
+            if os.path.exists(path):
+                app.jinja_env.get_template(os.path.relpath(path, 'templates'))
+
+    return rebuild
+
+def app_handlers(app):
+    """
+    What to rebuild for the dev server when files change.
+    """
+    return [
+        ('less/*', _rebuild_less),
+        ('jst/*', _rebuild_jst),
+        ('www/js/*.js', _rebuild_js),
+        ('data/*', _rebuild_data),
+        ('templates/*', _rebuild_templates(app))
+    ]
+
+# Rebuilt at startup. Not www/js/: that's every vendored library, which
+# the compile cache mostly already has, and one that fails to compile
+# shouldn't hold up the rest
+WARM_UP_PATTERNS = ['less/*', 'jst/*', 'data/*', 'templates/*']
+
+def watch_app(app):
+    """
+    Start rebuilding `app`'s assets in the background as files change.
+    """
+    watcher = Watcher(app_handlers(app), warm_up=WARM_UP_PATTERNS).start()
+
+    print('Watching %s for changes (%s)' % (', '.join(WATCH_PATHS), 'inotify' if watcher._inotify else 'polling'))
+
+    return watcher